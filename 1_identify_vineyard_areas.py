@@ -1,13 +1,16 @@
+import os
 import pandas as pd
 import numpy as np
 import geopandas as gpd
 import xarray as xr
-from shapely import Polygon
 import rasterio
-from rasterio.features import rasterize
 import rioxarray
 
-from functions import config
+from pydist import config
+from pydist.grid import grid_cells
+from pydist.coverage import coverage_fractions, dominant_coverage
+from pydist.dissolve import dissolve_by_key
+from pydist.polygonize import read_polygons
 
 ##Load data
 minx, miny, maxx, maxy = config.aois["europe"]
@@ -16,29 +19,15 @@ dem = dem.rio.write_crs(4326)
 
 print('Dem loaded')
 
-##Create fishnet grid
-vals, counts = np.unique(np.diff(dem.lat.values), return_counts = True)
-fishnet_res = vals[np.argmax(counts)]
-geoms = []
-for y in dem.lat:
-    for x in dem.lon:
-        x_c, y_c = x-(fishnet_res/2), y-(fishnet_res/2)
-        pl = Polygon([(x_c,y_c), (x_c+fishnet_res,y_c), (x_c+fishnet_res, y_c+fishnet_res), (x_c, y_c+fishnet_res)])
-        geoms.append(pl)
-
-fishnet = gpd.GeoDataFrame(data = {'grid_id': np.arange(len(geoms))}, geometry = geoms, crs = 4326) 
-
-print('Fishnet created')
-
 ##Prepare vineyards
-vineyards_luisa = gpd.read_file('data/vineyards/luisa_vineyards.shp').to_crs(4326).cx[minx:maxx,miny:maxy]
+vineyards_luisa = read_polygons('data/vineyards/luisa_vineyards').to_crs(4326).cx[minx:maxx,miny:maxy]
 vineyards_osm = gpd.read_file('data/vineyards/osm_vineyards.shp').to_crs(4326).cx[minx:maxx,miny:maxy]
-vineyards_shp = gpd.GeoDataFrame({'id': [1], 'geometry': [pd.concat([vineyards_luisa, vineyards_osm]).geometry.union_all()]}, crs = 4326)
 
+##Union of all vineyards within each LAU, computed per LAU in parallel
 gisco_lau = gpd.read_file(config.gisco_lau)[['GISCO_ID', 'geometry']].cx[minx:maxx,miny:maxy]
-vineyards_lau = gpd.overlay(
-    vineyards_shp, gisco_lau, how="intersection", keep_geom_type=True
-)[["GISCO_ID", "geometry"]].dissolve(by="GISCO_ID").reset_index()
+vineyards_lau = dissolve_by_key(
+    pd.concat([vineyards_luisa, vineyards_osm]).geometry, gisco_lau, 'GISCO_ID', n_workers = os.cpu_count()
+)
 
 ##Prepare PDOs
 pdo_shp = gpd.read_file(config.downloader.fetch('EU_PDO.gpkg'))
@@ -48,40 +37,29 @@ pdo_lau = gpd.sjoin(pdo_shp, gisco_points, how = 'inner', predicate = 'intersect
 gisco_pdo_link = pdo_lau.groupby('GISCO_ID', as_index = False).apply(lambda x: ';'.join(x['PDOid']), include_groups=False)
 gisco_pdo_link.rename(columns = {None: 'PDOid'}, inplace = True)
 
-##Intersect with vineyards
-fishnet_inters = gpd.overlay(fishnet, vineyards_lau, how = 'intersection', keep_geom_type=True)
-fishnet_inters['area'] = fishnet_inters.to_crs(3035).geometry.area
+##Fraction of each grid cell covered by the vineyards of each LAU
+vineyards_cov = coverage_fractions(vineyards_lau.geometry, vineyards_lau['GISCO_ID'], dem.lon.values, dem.lat.values)
 
 ##For each grid, select the LAU with highest share of vineyard area
-fishnet_inters = fishnet_inters.sort_values('area', ascending=False).drop_duplicates(['grid_id'], keep = 'first')
+vineyards_cov = dominant_coverage(vineyards_cov).rename(columns = {'coverage': 'area_share'})
 
-##Merge back to restore original fishnet geometry
-fishnet_sub = fishnet.merge(fishnet_inters.drop('geometry', axis = 1), on = 'grid_id', how = 'inner')
-fishnet_sub['area_share'] = fishnet_sub['area'] / fishnet_sub.to_crs(3035).geometry.area
-fishnet_sub.drop(['area', 'grid_id'], axis = 1, inplace = True)
+##Create fishnet polygons only for covered cells
+fishnet = grid_cells(dem.lon.values, dem.lat.values, grid_id = vineyards_cov['row'] * dem.lon.size + vineyards_cov['col'], crs = 4326)
+fishnet_sub = gpd.GeoDataFrame(vineyards_cov[['GISCO_ID', 'area_share', 'row', 'col']], geometry = fishnet.geometry.values, crs = 4326)
 fishnet_sub['id'] = fishnet_sub.groupby('GISCO_ID').ngroup()
 
 ## Add PDOs (drops also polygons outside PDO areas)
 fishnet_sub = fishnet_sub.merge(gisco_pdo_link, on = 'GISCO_ID', how = 'inner')
 
-fishnet_sub.to_file(f'data/vineyards/vineyards_fishnet.shp')
+fishnet_sub.drop(['row', 'col'], axis = 1).to_file(f'data/vineyards/vineyards_fishnet.shp')
 
 print('Fishnet intersected')
 # fishnet_sub = gpd.read_file(f'data/vineyards/vineyards_fishnet.shp')
 ##Rasterize
 for col in ['id', 'area_share']:
-    # create tuples of geometry, value pairs, where value is the attribute value you want to burn
-    geom_value = [(geom,value) for geom, value in zip(fishnet_sub.geometry, fishnet_sub[col])]
-
-    # Rasterize vector using the shape and transform of the raster
-    rasterized = rasterize(
-        geom_value,
-        out_shape=dem.orog.shape,
-        transform=dem.rio.transform(),
-        all_touched=False,
-        fill=0,
-        dtype=np.float64,
-    )
+    # burn the values of the covered cells into the grid of the dem
+    rasterized = np.zeros(dem.orog.shape, dtype=np.float64)
+    rasterized[fishnet_sub['row'].values, fishnet_sub['col'].values] = fishnet_sub[col].values
 
     profile = {
         'driver': 'GTiff',
@@ -3,8 +3,9 @@ import geopandas as gpd
 import numpy as np
 import xarray as xr
 from pathlib import Path
+from contextlib import ExitStack
+from datetime import datetime
 import argparse
-from tempfile import TemporaryDirectory
 import pydist
 import logging
 import logging.config
@@ -25,11 +26,24 @@ def main():
     parser.add_argument('-ys', '--year_start', default = 2000, type = int, help = 'Starting year of climate grids.')
     parser.add_argument('-ye', '--year_end', default = 2001, type = int, help = 'Last year of climate grids. Must be greater than year_start.')
     parser.add_argument('-yc', '--year_chunks', default = 1, type = int, help = 'Number of years that should be processed at once. Depends on RAM of host. Default is to process each year individually.')
-    parser.add_argument('-tr', '--threads', default = 1, type = int, help = 'Number of threads to use for downloading files')
-    parser.add_argument('-d', '--ddir', default = TemporaryDirectory(), help = 'Directory to store downloaded files')
+    parser.add_argument('-tr', '--threads', default = 1, type = int, help = 'Number of simultaneous connections to use for downloading files')
+    parser.add_argument('-d', '--ddir', default = None, help = 'Directory of the persistent download cache. Defaults to the user cache directory.')
+    parser.add_argument('-cq', '--cache_quota', default = None, type = float, help = 'Maximum size of the download cache in GB. Least recently used files are evicted first.')
+    parser.add_argument('-rm', '--remote', action = 'store_true', help = 'Read only the aoi subset of the remote files using HTTP range requests instead of downloading global files')
+    parser.add_argument('-st', '--store', default = None, help = 'Directory with Zarr stores written by pydist.ingest. Years contained in the store for the aoi and resolution are read from it instead of the original files.')
+    parser.add_argument('-pf', '--prefetch', default = 1, type = int, help = 'Number of year chunks that are downloaded and opened ahead of the one being processed, or of months with --streaming. Use 0 to disable prefetching.')
+    parser.add_argument('-sm', '--streaming', action = 'store_true', help = 'Process the climate data month by month with online accumulators instead of loading whole seasons. Not compatible with --use_dask and --sparse.')
+    parser.add_argument('-tl', '--tiled', action = 'store_true', help = 'Process the aoi in spatial tiles sized to --memory instead of loading whole year chunks. Not compatible with --use_dask, --sparse and --streaming.')
+    parser.add_argument('-m', '--memory', default = 4, type = float, help = 'Memory budget in GB for all tiles processed at once with --tiled, or for each block with --use_dask.')
+    parser.add_argument('-w', '--workers', default = 1, type = int, help = 'Number of worker processes for tiles. Only used with --tiled.')
+    parser.add_argument('-po', '--phen_output', default = 'netcdf', choices = ['netcdf', 'zarr'], help = 'Output of veraison dates. netcdf writes one file per variety, zarr a single int16 store with a variety dimension.')
+    parser.add_argument('-pc', '--phen_chunks', default = [1, 128, 128], type = int, nargs = 3, help = 'Chunk sizes (year, lat, lon) of the zarr veraison store. Use -1 for chunks spanning the whole dimension of the first written year chunk.')
+    parser.add_argument('-tm', '--trace_memory', action = 'store_true', help = 'Record the peak Python memory of each stage in the run report using tracemalloc. Slows down the run.')
     parser.add_argument('-da', '--use_dask', action = 'store_true', help = 'Use dask for opening .nc files')
     parser.add_argument('-ic', '--init_slurm', action = 'store_true', help = 'Initialize a SLURM-based dask cluster')
     parser.add_argument('-j', '--n_jobs', default = 1, type = int, help = 'Number of jobs to launch by dask scheduler')
+    parser.add_argument('-e', '--engine', default = 'prefix', choices = ['prefix', 'numba'], help = 'Engine used for veraison dates and window indices. numba uses a fused compiled kernel and requires numba to be installed. Not compatible with --tiled and --streaming.')
+    parser.add_argument('-s', '--sparse', action = 'store_true', help = 'Only process pixels that contain vineyards. Veraison rasters are scattered back to the full grid before writing.')
 
     args = parser.parse_args()
 
@@ -47,15 +61,33 @@ def main():
         raise ValueError('year_start and year_end arguments must both fall within 1979-2016. Values outside this range are not supported.')
     years = np.arange(args.year_start, args.year_end+1)
 
+    if args.streaming and (args.use_dask or args.sparse):
+        raise ValueError('streaming can not be combined with use_dask or sparse.')
+    if args.tiled and (args.use_dask or args.sparse or args.streaming):
+        raise ValueError('tiled can not be combined with use_dask, sparse or streaming.')
+    if (args.tiled or args.streaming) and (args.engine == 'numba'):
+        raise ValueError('The numba engine can not be combined with tiled or streaming.')
+
     if args.year_chunks < 1:
         raise ValueError('year_chunks must at least be 1, smaller values are not allowed.')
-    y_chunks = args.year_chunks
+    ##Streaming holds no more than one month of data and returns results per year
+    y_chunks = 1 if args.streaming else args.year_chunks
 
     out_dir = Path(args.out_dir, resolution)
     out_dir.mkdir(exist_ok=True, parents=True)
     out_phen = Path(out_dir, 'veraison_dates')
     out_phen.mkdir(exist_ok=True, parents=True)
+    phen_store = Path(out_dir, 'veraison_dates.zarr')
+    results = pydist.ResultStore(Path(out_dir, 'climatic_indices'))
+    grid_cache = Path(args.out_dir, '.grid_cache')
+    ##Veraison dates of the current year chunk, written tile by tile with --tiled and dask
+    tile_store = Path(out_dir, '.veraison_tiles.zarr')
+
+    ##Earlier versions appended all results to a single csv, which is imported once
     out_csv = Path(out_dir, 'climatic_indices.csv')
+    if out_csv.is_file() and len(results.done()) == 0:
+        logger.info(f'Importing results of {out_csv} to {results.root}')
+        results.import_csv(out_csv)
 
     # Fixed arguments
     veraison_min, veraison_max = 214, 275
@@ -97,90 +129,192 @@ def main():
     vn_arr_re = vn_arr.copy()
     vn_weights_re = vn_weights.copy()
 
-    for y_group in chunker(years, y_chunks):
-        logger.info(f"Processing year(s): {', '.join(y_group.astype(str))}")
-
-        ##Skip years that were already processed
-        if out_csv.is_file():
-            tbl_processed = pd.read_csv(out_csv)
-            years_processed = [i for i in y_group if i in tbl_processed['year'].unique()]
-            y_group = [i for i in y_group if i not in years_processed]
-
-            if len(years_processed) > 0:
-                logger.info(f"Skipping already processed years: {', '.join([str(i) for i in years_processed])}")
-            if len(y_group) == 0:
-                continue
-
-        ##Load chelsa data
-        logger.info('Loading climate data')
-        ds = pydist.load_chelsa_w5e5(
-            variables,
-            resolution,
-            y_group,
-            months=months,
-            aoi=(minx, miny, maxx, maxy),
-            n_threads=args.threads,
-            download_dir=args.ddir,
-            use_dask = args.use_dask
+    ##Skip years that were already processed for all varieties. Veraison dates are written before the
+    ##results of a variety, except for the zarr store, which is written after all varieties of a year chunk.
+    phen_years = pydist.stored_veraison_years(phen_store) if args.phen_output == 'zarr' else years
+    years_processed = [i for i in years if (i in phen_years) and all(results.is_done(i, v) for v in parker_sub['Prime Name'])]
+    y_groups = [np.array([i for i in y_group if i not in years_processed]) for y_group in chunker(years, y_chunks)]
+    y_groups = [y_group for y_group in y_groups if len(y_group) > 0]
+    if len(years_processed) > 0:
+        logger.info(f"Skipping already processed years: {', '.join([str(i) for i in years_processed])}")
+
+    ##With dask, all varieties of a year chunk are computed in one graph over the spatial chunks
+    blockwise = args.use_dask and (not args.sparse) and (args.engine == 'prefix')
+
+    Fcrits = dict(zip(parker_sub['Prime Name'], parker_sub['F*']))
+    load_kwargs = dict(
+        aoi=(minx, miny, maxx, maxy),
+        n_threads=args.threads,
+        download_dir=args.ddir,
+        cache_quota=None if args.cache_quota is None else int(args.cache_quota * 1e9),
+        remote=args.remote,
+        store=None if args.store is None else pydist.store_path(args.store, args.aoi, resolution),
+    )
+
+    def load_climate(y_group):
+        with pydist.stage('load', years = y_group.tolist()):
+            if args.streaming:
+                ##Results of the next year of the stream, which folds monthly files into per-pixel state
+                logger.info(f"Streaming climate data for year(s): {', '.join(y_group.astype(str))}")
+                _, veraison_doys, lau_idx = next(streamed)
+                return((veraison_doys, lau_idx), lambda: None)
+
+            ##Load chelsa data. Lazily opened files stay pinned in the download cache until the
+            ##year chunk is processed, so prefetching the next chunk can not evict them.
+            logger.info(f"Loading climate data for year(s): {', '.join(y_group.astype(str))}")
+            ds, release = pydist.load_chelsa_w5e5(variables, resolution, y_group, months=months, use_dask = args.use_dask or args.tiled, return_release = True, **load_kwargs)
+            if not (args.use_dask or args.sparse or args.tiled):
+                ds = ds.load()
+                release()
+        return(ds, release)
+
+    if args.streaming and len(y_groups) > 0:
+        ##Indices are aggregated to LAUs while streaming, so the vineyard arrays are aligned to the
+        ##grid of the first monthly file before streaming starts
+        base = pydist.load_chelsa_w5e5(['tas'], resolution, y_groups[0], months=months[:1], **load_kwargs).tas.isel(time = 0, drop = True)
+        vn_stream_arr, vn_stream_weights = pydist.align_arrays(vn_arr, vn_weights, base = base, cache_dir = grid_cache)
+        streamed = pydist.stream_chelsa_indices(
+            Fcrits, vn_stream_arr, vn_stream_weights, variables, resolution, np.concatenate(y_groups), months=months,
+            veraison_min=veraison_min, veraison_max=veraison_max, window=clim_window_length, prefetch_depth=args.prefetch, **load_kwargs
         )
 
-        ##Align weight and climate arrays
-        vn_arr_re, vn_weights_re = pydist.align_arrays(vn_arr, vn_weights, base = ds.isel(time = 0).tas)
-
-        ##Iterate over varieties
-        for v_name, Fcrit in list(zip(parker_sub['Prime Name'], parker_sub['F*'])):
-
-            logger.info(f'Processing variety {parker_sub["Prime Name"].tolist().index(v_name)+1}/{len(parker_sub["Prime Name"])}: {v_name}!')
-
-            ##Calculate array with veraison dates
-            veraison_date = pydist.calc_phen_date(ds.tas, Fcrit).compute()
-            print(veraison_date.chunks)
-            pydist.save_array(veraison_date.dt.dayofyear, Path(f'{out_phen}/{v_name}.nc'), unlimited_dim = 'year')
-
-            ##Find dates that are within veraison_min and veraison_max
-            logger.debug('Masking veraison date')
-            veraison_date = veraison_date.where((veraison_date.dt.dayofyear < veraison_max) & (veraison_date.dt.dayofyear >= veraison_min))
-
-            clim_window = pydist.get_climatic_window(ds, veraison_date, window = clim_window_length)
-
-            logger.debug('Calculating indices')
-            _clim_idx = xr.Dataset({
-                'gdd': (clim_window.tas - 10).clip(min = 0).sum('nr', skipna = True, min_count = 1),
-                'gdd_opt': (clim_window.tas - 25).clip(min = 0).sum('nr', skipna = True, min_count = 1),
-                'pr_sum': (clim_window.pr).sum('nr', skipna = True, min_count = 1),
-                'pr_max': (clim_window.pr).max('nr'),
-
-                'days_max': (clim_window.tasmax > 40).sum('nr', skipna = True, min_count = 1),
-                'days_min': (clim_window.tasmin < 10).sum('nr', skipna = True, min_count = 1),
-                'tasmin': (clim_window.tasmin).mean('nr'),
-                'tasmax': (clim_window.tasmax).mean('nr')
-            })
-            _clim_idx = _clim_idx.assign_coords({'Prime': v_name})
-            _clim_idx = _clim_idx.rio.write_crs(4326)
-
-            ##Aggregate to LAU level
-            logger.debug('Aggregating indices')
-            _clim_agg = (
-                (_clim_idx * vn_weights_re).groupby(vn_arr_re).sum(skipna=True, min_count=1)
-            ) / vn_weights_re.groupby(vn_arr_re).sum(skipna=True, min_count=1).compute()
-
-            # _clim_agg = (_clim_idx * weightmap_re).groupby(vn_arr_re).sum(skipna = True, min_count = 1)
-
-            _clim_agg = _clim_agg.to_dataframe().reset_index()
-            _clim_agg['id'] = _clim_agg['id'].astype(int)
-            # _clim_agg.dropna(subset = 'gdd', inplace = True)
-
-            ##Aggregate to PDO level
-            _clim_pdo = vn_fishnet[['id', 'PDOid']].merge(_clim_agg, on = 'id')
-            _clim_pdo.drop(['id', 'spatial_ref'], axis = 1, inplace = True, errors = 'ignore')
-            _clim_pdo = (
-                _clim_pdo.groupby(["PDOid", "Prime", "year"], as_index=False)
-                .mean(numeric_only=True)
-                .merge(vin_area[["PDOid", "Prime"]], how="inner") #drops rows with varieties that are not authorized in a PDO
-            )
-
-            file_exists = out_csv.exists()
-            _clim_pdo.to_csv(out_csv, header=not file_exists, mode='a' if file_exists else 'w')
+    ##Stage timings are written to a JSON report, with dask additionally to a performance report
+    run_id = datetime.now().strftime('%Y%m%d_%H%M%S')
+    report = pydist.RunReport(meta = {'args': vars(args)}, trace_memory = args.trace_memory)
+
+    try:
+        with ExitStack() as stack:
+            stack.enter_context(report)
+            if args.use_dask:
+                from dask.distributed import performance_report
+                stack.enter_context(performance_report(filename = str(Path(out_dir, f'dask_report_{run_id}.html'))))
+
+            ##Download and open the next year chunk while the current one is processed. Streaming
+            ##computes the indices while loading, so only its months are prefetched.
+            for y_group, (ds, release) in pydist.prefetch(load_climate, y_groups, depth = 0 if args.streaming else args.prefetch):
+                logger.info(f"Processing year(s): {', '.join(y_group.astype(str))}")
+                labels = {'years': y_group.tolist()}
+
+                if args.streaming:
+                    veraison_doys, lau_idx = ds
+
+                ##Align weight and climate arrays
+                base = veraison_doys.isel(variety = 0, year = 0, drop = True) if args.streaming else ds.isel(time = 0).tas
+                with pydist.stage('align', **labels):
+                    vn_arr_re, vn_weights_re = pydist.align_arrays(vn_arr, vn_weights, base = base, cache_dir = grid_cache)
+
+                ##Compress climate and weight arrays to vineyard pixels
+                if args.sparse:
+                    vn_grid = vn_arr_re
+                    ##Same pixels as in build_aggregation_matrices, where only NaN means no vineyard and 0 is a valid LAU id
+                    ds, vn_arr_re, vn_weights_re = pydist.compress_pixels(vn_arr_re.notnull(), ds, vn_arr_re, vn_weights_re)
+                    if args.use_dask:
+                        ##One chunk along time per pixel chunk, as the files are opened with one chunk per month
+                        ds = ds.chunk({'time': -1})
+                    else:
+                        ds = ds.load()
+
+                ##Sparse matrices to aggregate pixels to LAU and PDO level
+                agg_matrices = pydist.build_aggregation_matrices(vn_arr_re, vn_weights_re, vn_fishnet)
+
+                if args.tiled:
+                    ##Veraison dates for all varieties and partial LAU sums per tile
+                    with pydist.stage('indices', **labels):
+                        veraison_doys, lau_idx = pydist.run_tiled(
+                            ds, Fcrits, vn_arr_re, vn_weights_re,
+                            memory_budget = int(args.memory * 1e9), store = tile_store, n_workers = args.workers,
+                            veraison_min = veraison_min, veraison_max = veraison_max, window = clim_window_length
+                        )
+                elif blockwise:
+                    logger.info('Calculating veraison dates and indices')
+                    with pydist.stage('indices', **labels):
+                        veraison_doys, lau_idx = pydist.run_blocks(
+                            ds, Fcrits, vn_arr_re, vn_weights_re, store = tile_store, memory_budget = int(args.memory * 1e9),
+                            veraison_min = veraison_min, veraison_max = veraison_max, window = clim_window_length
+                        )
+                elif (args.engine == 'prefix') and (not args.streaming):
+                    ##Calculate veraison dates for all varieties at once
+                    logger.info('Calculating veraison dates')
+                    with pydist.stage('phen', **labels):
+                        veraison_doys = pydist.calc_phen_dates(ds.tas, Fcrits).compute()
+
+                    ##Cumulative sums for the window indices are shared by all varieties
+                    with pydist.stage('window', **labels):
+                        prefix = pydist.calc_prefix_sums(ds)
+                        if args.use_dask:
+                            prefix = prefix.persist()
+
+                ##Veraison dates of all varieties are written to the zarr store at once
+                veraison_list = []
+                phen_stored = (args.phen_output == 'netcdf') or all(i in pydist.stored_veraison_years(phen_store) for i in y_group)
+
+                def save_veraison(veraison_doy, v_name):
+                    if args.phen_output == 'zarr':
+                        veraison_list.append(veraison_doy.expand_dims(variety = [v_name]))
+                    else:
+                        with pydist.stage('write', variety = v_name, **labels):
+                            ##Years written before an interruption are overwritten
+                            pydist.save_array(veraison_doy, Path(f'{out_phen}/{v_name}.nc'), unlimited_dim = 'year', overwrite = True)
+
+                ##Iterate over varieties
+                for v_name, Fcrit in list(zip(parker_sub['Prime Name'], parker_sub['F*'])):
+
+                    logger.info(f'Processing variety {parker_sub["Prime Name"].tolist().index(v_name)+1}/{len(parker_sub["Prime Name"])}: {v_name}!')
+
+                    ##Skip varieties finished before an interruption
+                    if phen_stored and all(results.is_done(i, v_name) for i in y_group):
+                        logger.info(f'Variety {v_name} already processed. Skipping.')
+                        continue
+
+                    if args.tiled or blockwise or args.streaming:
+                        veraison_doy = veraison_doys.sel(variety = v_name, drop = True).rename('dayofyear')
+                        save_veraison(veraison_doy, v_name)
+                        _clim_idx = lau_idx.sel(variety = v_name, drop = True)
+                    elif args.engine == 'numba':
+                        logger.debug('Calculating veraison date and indices')
+                        with pydist.stage('indices', variety = v_name, **labels):
+                            _clim_out = pydist.calc_veraison_indices(ds, Fcrit, veraison_min, veraison_max, window = clim_window_length).compute()
+                        veraison_doy = _clim_out['veraison'].rename('dayofyear')
+                        save_veraison(pydist.expand_pixels(veraison_doy, vn_grid) if args.sparse else veraison_doy, v_name)
+                        _clim_idx = _clim_out.drop_vars('veraison')
+                    else:
+                        veraison_doy = veraison_doys.sel(variety = v_name, drop = True).rename('dayofyear')
+                        save_veraison(pydist.expand_pixels(veraison_doy, vn_grid) if args.sparse else veraison_doy, v_name)
+
+                        ##Find dates that are within veraison_min and veraison_max
+                        logger.debug('Masking veraison date')
+                        veraison_doy = veraison_doy.where((veraison_doy < veraison_max) & (veraison_doy >= veraison_min))
+
+                        logger.debug('Calculating indices')
+                        with pydist.stage('indices', variety = v_name, **labels):
+                            _clim_idx = pydist.calc_window_indices(ds, veraison_doy, window = clim_window_length, prefix = prefix)
+
+                    _clim_idx = _clim_idx.assign_coords({'Prime': v_name})
+
+                    ##Aggregate to LAU and PDO level
+                    logger.debug('Aggregating indices')
+                    aggregate = pydist.aggregate_lau_to_pdo if (args.tiled or blockwise or args.streaming) else pydist.aggregate_to_pdo
+                    with pydist.stage('aggregation', variety = v_name, **labels):
+                        _clim_pdo = (
+                            aggregate(_clim_idx, agg_matrices)
+                            .merge(vin_area[["PDOid", "Prime"]], how="inner") #drops rows with varieties that are not authorized in a PDO
+                        )
+
+                    with pydist.stage('write', variety = v_name, **labels):
+                        results.write(_clim_pdo, v_name, y_group)
+
+                if not phen_stored:
+                    logger.info(f'Writing veraison dates to {phen_store}')
+                    with pydist.stage('write', **labels):
+                        pydist.write_veraison(
+                            xr.concat(veraison_list, dim = 'variety'), phen_store,
+                            chunks = dict(zip(['year', 'lat', 'lon'], args.phen_chunks))
+                        )
+
+                ##The files of the year chunk may be evicted from the download cache from now on
+                release()
+    finally:
+        report.write(Path(out_dir, f'run_report_{run_id}.json'))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
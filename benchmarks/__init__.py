@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+##The scripts are not installed as a package, so benchmarks import pydist from the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,239 @@
+"""
+Benchmarks of the hot path of 2_climatic_indices.py on synthetic data.
+
+Run with `asv run` or `asv dev` from the repository root. Each setup checks the benchmarked
+function against a reference, so a faster but wrong implementation fails instead of being
+reported as an improvement.
+"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from tempfile import TemporaryDirectory
+from pathlib import Path
+import warnings
+from rasterio.enums import Resampling
+
+import pydist
+from pydist.get_climate import open_climate_dataset
+from pydist.alignment import clear_grid_cache
+
+from .synthetic import make_climate, write_chelsa_files, make_vineyards
+
+##(lat, lon) pixels of the synthetic grids
+GRIDS = [(40, 50), (120, 150)]
+FCRIT = 2700
+VERAISON_MIN, VERAISON_MAX = 214, 275
+WINDOW = 45
+
+def window_indices_reference(clim_window):
+    """
+    Indices from the output of get_climatic_window as calculated in the original script.
+
+    Unlike the original script, days_max and days_min are NaN instead of 0 for pixels without
+    veraison date, as in calc_window_indices.
+    """
+
+    return(xr.Dataset({
+        'gdd': (clim_window.tas - 10).clip(min = 0).sum('nr', skipna = True, min_count = 1),
+        'gdd_opt': (clim_window.tas - 25).clip(min = 0).sum('nr', skipna = True, min_count = 1),
+        'pr_sum': (clim_window.pr).sum('nr', skipna = True, min_count = 1),
+        'pr_max': (clim_window.pr).max('nr'),
+        'days_max': (clim_window.tasmax > 40).where(clim_window.tasmax.notnull()).sum('nr', skipna = True, min_count = 1),
+        'days_min': (clim_window.tasmin < 10).where(clim_window.tasmin.notnull()).sum('nr', skipna = True, min_count = 1),
+        'tasmin': (clim_window.tasmin).mean('nr'),
+        'tasmax': (clim_window.tasmax).mean('nr')
+    }))
+
+def groupby_aggregation(clim_idx, ids, weights, lau_pdo):
+    """Area weighted aggregation to LAU and PDO level as done in the original script."""
+
+    clim_agg = (
+        (clim_idx * weights).groupby(ids).sum(skipna = True, min_count = 1)
+    ) / weights.groupby(ids).sum(skipna = True, min_count = 1)
+
+    clim_agg = clim_agg.to_dataframe().reset_index()
+    clim_agg['id'] = clim_agg['id'].astype(int)
+
+    clim_pdo = lau_pdo[['id', 'PDOid']].merge(clim_agg, on = 'id')
+    clim_pdo = clim_pdo.drop(['id', 'spatial_ref'], axis = 1, errors = 'ignore')
+
+    return(clim_pdo.groupby(['PDOid', 'year'], as_index = False).mean(numeric_only = True))
+
+class OpenClimateDataset:
+    params = [GRIDS]
+    param_names = ['grid']
+
+    def setup(self, grid):
+        self.tmp = TemporaryDirectory()
+        self.ds = make_climate(*grid)
+        self.files = write_chelsa_files(self.ds, self.tmp.name)
+        self.aoi = (
+            float(self.ds.lon.min()), float(self.ds.lat.min()),
+            float(self.ds.lon.max()), float(self.ds.lat.max()),
+        )
+
+        ds = open_climate_dataset(self.files, aoi = self.aoi).load()
+        np.testing.assert_allclose(ds.tas.values - 273.5, self.ds.tas.values, atol = 1e-4)
+        np.testing.assert_allclose(ds.pr.values, self.ds.pr.values)
+
+    def teardown(self, grid):
+        self.tmp.cleanup()
+
+    def time_open_climate_dataset(self, grid):
+        open_climate_dataset(self.files, aoi = self.aoi).load()
+
+    def peakmem_open_climate_dataset(self, grid):
+        open_climate_dataset(self.files, aoi = self.aoi).load()
+
+class PhenDate:
+    params = [GRIDS]
+    param_names = ['grid']
+
+    def setup(self, grid):
+        self.ds = make_climate(*grid, years = (2000, 2001))
+
+        doy_ref = pydist.calc_phen_date(self.ds.tas, FCRIT).dt.dayofyear
+        doy = pydist.calc_phen_dates(self.ds.tas, [FCRIT]).isel(variety = 0, drop = True).transpose(*doy_ref.dims)
+        np.testing.assert_array_equal(doy.isnull().values, doy_ref.isnull().values)
+        np.testing.assert_allclose(doy.values, doy_ref.values.astype(np.float64))
+
+        ##Dask arrays with one chunk per month, as opened by open_mfdataset
+        doy_dask = pydist.calc_phen_dates(self.ds.tas.chunk({'time': 31}), [FCRIT]).isel(variety = 0, drop = True)
+        xr.testing.assert_allclose(doy_dask.compute(), doy)
+
+    def time_calc_phen_date(self, grid):
+        pydist.calc_phen_date(self.ds.tas, FCRIT)
+
+    def peakmem_calc_phen_date(self, grid):
+        pydist.calc_phen_date(self.ds.tas, FCRIT)
+
+    def time_calc_phen_dates(self, grid):
+        pydist.calc_phen_dates(self.ds.tas, [FCRIT])
+
+    def peakmem_calc_phen_dates(self, grid):
+        pydist.calc_phen_dates(self.ds.tas, [FCRIT])
+
+class ClimaticWindow:
+    params = [GRIDS]
+    param_names = ['grid']
+
+    def setup(self, grid):
+        self.ds = make_climate(*grid, years = (2000, 2001))
+
+        phen_date = pydist.calc_phen_date(self.ds.tas, FCRIT)
+        doy = phen_date.dt.dayofyear
+        self.phen_date = phen_date.where((doy < VERAISON_MAX) & (doy >= VERAISON_MIN))
+        self.phen_doy = self.phen_date.dt.dayofyear.where(self.phen_date.notnull())
+
+        ref = window_indices_reference(pydist.get_climatic_window(self.ds, self.phen_date, window = WINDOW))
+        clim_idx = pydist.calc_window_indices(self.ds, self.phen_doy, window = WINDOW).transpose(*ref.gdd.dims)
+        for var in ref.data_vars:
+            np.testing.assert_array_equal(clim_idx[var].isnull().values, ref[var].isnull().values, err_msg = var)
+            np.testing.assert_allclose(clim_idx[var].values, ref[var].values.astype(np.float64), rtol = 1e-5, err_msg = var)
+
+    def time_get_climatic_window(self, grid):
+        window_indices_reference(pydist.get_climatic_window(self.ds, self.phen_date, window = WINDOW))
+
+    def peakmem_get_climatic_window(self, grid):
+        window_indices_reference(pydist.get_climatic_window(self.ds, self.phen_date, window = WINDOW))
+
+    def time_calc_window_indices(self, grid):
+        pydist.calc_window_indices(self.ds, self.phen_doy, window = WINDOW)
+
+    def peakmem_calc_window_indices(self, grid):
+        pydist.calc_window_indices(self.ds, self.phen_doy, window = WINDOW)
+
+class AlignArrays:
+    params = [GRIDS]
+    param_names = ['grid']
+
+    def setup(self, grid):
+        self.base = make_climate(*grid, months = [3]).isel(time = 0).tas
+        self.ids, self.weights, _ = make_vineyards(self.base)
+
+        ##Reference is a plain reprojection, compared to the first and a cached call
+        clear_grid_cache()
+        for _ in range(2):
+            for arr, arr_re in zip([self.ids, self.weights], pydist.align_arrays(self.ids, self.weights, base = self.base)):
+                ref = arr.rio.reproject_match(self.base, resampling = Resampling.bilinear)
+                np.testing.assert_array_equal(arr_re.values, ref.values)
+
+    def time_align_arrays(self, grid):
+        pydist.align_arrays(self.ids, self.weights, base = self.base, cache_size = 0)
+
+    def peakmem_align_arrays(self, grid):
+        pydist.align_arrays(self.ids, self.weights, base = self.base, cache_size = 0)
+
+    def time_align_arrays_cached(self, grid):
+        pydist.align_arrays(self.ids, self.weights, base = self.base)
+
+class Aggregation:
+    params = [GRIDS]
+    param_names = ['grid']
+
+    def setup(self, grid):
+        ds = make_climate(*grid, years = (2000, 2001))
+        self.ids, self.weights, self.lau_pdo = make_vineyards(ds.isel(time = 0).tas)
+        self.ids, self.weights = self.ids.sortby('lat'), self.weights.sortby('lat')
+
+        phen_doy = pydist.calc_phen_dates(ds.tas, [FCRIT]).isel(variety = 0, drop = True)
+        self.clim_idx = pydist.calc_window_indices(ds, phen_doy.where((phen_doy < VERAISON_MAX) & (phen_doy >= VERAISON_MIN)), window = WINDOW)
+        self.matrices = pydist.build_aggregation_matrices(self.ids, self.weights, self.lau_pdo)
+
+        ref = groupby_aggregation(self.clim_idx, self.ids, self.weights, self.lau_pdo)
+        tbl = pydist.aggregate_to_pdo(self.clim_idx, self.matrices)
+        pd.testing.assert_frame_equal(tbl[ref.columns].reset_index(drop = True), ref, check_dtype = False)
+
+    def time_groupby_aggregation(self, grid):
+        groupby_aggregation(self.clim_idx, self.ids, self.weights, self.lau_pdo)
+
+    def peakmem_groupby_aggregation(self, grid):
+        groupby_aggregation(self.clim_idx, self.ids, self.weights, self.lau_pdo)
+
+    def time_aggregate_to_pdo(self, grid):
+        pydist.aggregate_to_pdo(self.clim_idx, self.matrices)
+
+    def peakmem_aggregate_to_pdo(self, grid):
+        pydist.aggregate_to_pdo(self.clim_idx, self.matrices)
+
+class SaveArray:
+    params = [GRIDS, [10, 40]]
+    param_names = ['grid', 'n_years']
+
+    def setup(self, grid, n_years):
+        self.tmp = TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        ny, nx = grid
+
+        self.arrays = [
+            xr.DataArray(
+                np.round(rng.uniform(200, 280, (1, ny, nx))),
+                dims = ('year', 'lat', 'lon'),
+                coords = {'year': [y], 'lat': np.arange(ny, dtype = float), 'lon': np.arange(nx, dtype = float)},
+                name = 'dayofyear',
+            )
+            for y in range(1979, 1979 + n_years)
+        ]
+
+        fname = self._append_all()
+        with xr.open_dataset(fname) as ds:
+            xr.testing.assert_allclose(ds.dayofyear, xr.concat(self.arrays, dim = 'year'))
+
+    def teardown(self, grid, n_years):
+        self.tmp.cleanup()
+
+    def _append_all(self):
+        fname = Path(self.tmp.name, 'veraison.nc')
+        fname.unlink(missing_ok = True)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            for arr in self.arrays:
+                pydist.save_array(arr, fname, unlimited_dim = 'year')
+        return(fname)
+
+    def time_save_array_appends(self, grid, n_years):
+        self._append_all()
+
+    def peakmem_save_array_appends(self, grid, n_years):
+        self._append_all()
@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+from pathlib import Path
+
+##CF attributes as in the CHELSA-W5E5 files, used by rioxarray to detect the spatial dimensions
+LAT_ATTRS = {'standard_name': 'latitude', 'units': 'degrees_north', 'axis': 'Y'}
+LON_ATTRS = {'standard_name': 'longitude', 'units': 'degrees_east', 'axis': 'X'}
+
+def make_climate(ny, nx, years = (2000, ), months = np.arange(3, 13), resolution = 1800, origin = (40, -5), seed = 0):
+    """
+    Synthetic daily CHELSA-W5E5-like climate cube with the variables tas, tasmax, tasmin and pr.
+
+    Temperatures (°C) follow a seasonal cycle that gets cooler to the north, with spatially
+    smooth daily anomalies so veraison dates vary between pixels. Precipitation (mm) falls on
+    roughly 35% of days.
+
+    Parameters:
+      ny, nx : int
+          Number of pixels along lat and lon.
+      years, months :
+          Years and months of the daily time axis.
+      resolution : int, default 1800
+          Pixel size in arcseconds.
+      origin : tuple, default (40, -5)
+          Lower left corner (lat, lon) of the grid.
+
+    Returns:
+      ds : xarray.Dataset
+          Dataset with dimensions (time, lat, lon) in float32 and ascending lat.
+    """
+
+    rng = np.random.default_rng(seed)
+    step = resolution / 3600
+    lat = origin[0] + (np.arange(ny) + 0.5) * step
+    lon = origin[1] + (np.arange(nx) + 0.5) * step
+
+    time = pd.date_range(f'{min(years)}-01-01', f'{max(years)}-12-31', freq = 'D')
+    time = time[time.year.isin(list(years)) & time.month.isin(list(months))]
+    doy = time.dayofyear.values[:, None, None]
+
+    ##Seasonal cycle, latitude gradient and anomalies shared by neighbouring pixels
+    lat_offset = (lat - lat.mean())[None, :, None] / max(ny * step, 1) * 6
+    anomaly = rng.normal(0, 3, (len(time), 1, 1)) + rng.normal(0, 1, (len(time), ny, nx))
+    tas = 13 + 11 * np.sin(2 * np.pi * (doy - 110) / 365) - lat_offset + anomaly
+    spread = np.abs(rng.normal(5, 1.5, (len(time), ny, nx)))
+    pr = np.where(rng.random((len(time), ny, nx)) < 0.35, rng.gamma(0.8, 6, (len(time), ny, nx)), 0)
+
+    dims = ('time', 'lat', 'lon')
+    ds = xr.Dataset(
+        {
+            'tas': (dims, tas.astype(np.float32), {'units': 'degC'}),
+            'tasmax': (dims, (tas + spread).astype(np.float32), {'units': 'degC'}),
+            'tasmin': (dims, (tas - spread).astype(np.float32), {'units': 'degC'}),
+            'pr': (dims, pr.astype(np.float32), {'units': 'mm'}),
+        },
+        coords = {'time': time, 'lat': ('lat', lat, LAT_ATTRS), 'lon': ('lon', lon, LON_ATTRS)},
+    )
+
+    return(ds.rio.write_crs(4326))
+
+def write_chelsa_files(ds, directory, resolution = 1800):
+    """
+    Write ds as monthly files named like the CHELSA-W5E5 downloads, with temperatures in K.
+
+    Returns:
+      files : list
+          Sorted paths of the written files.
+    """
+
+    Path(directory).mkdir(exist_ok = True, parents = True)
+    files = []
+    for var in ds.data_vars:
+        arr = ds[var] + 273.5 if 'tas' in var else ds[var]
+        for (year, month), arr_month in _monthly(arr):
+            fname = Path(directory, f'chelsa-w5e5_obsclim_{var}_{resolution}arcsec_global_daily_{year}{month:02}.nc')
+            arr_month.drop_vars('spatial_ref', errors = 'ignore').rename(var).to_netcdf(fname)
+            files.append(fname)
+
+    return(sorted(files))
+
+def _monthly(arr):
+
+    keys = (arr.time.dt.year * 100 + arr.time.dt.month).values
+    for key in np.unique(keys):
+        yield((key // 100, key % 100), arr.isel(time = keys == key))
+
+def make_vineyards(template, n_lau = 50, n_pdo = 10, coverage = 0.3, seed = 0):
+    """
+    Synthetic vineyard rasters and LAU/PDO links on the grid of template.
+
+    The rasters have descending lat like the rasterized GeoTIFFs, so they need to be aligned
+    to the climate grid first.
+
+    Returns:
+      ids : xarray.DataArray
+          LAU id per pixel, NaN outside vineyards.
+      weights : xarray.DataArray
+          Vineyard area share per pixel.
+      lau_pdo : pandas.DataFrame
+          Columns id and PDOid, with some LAUs belonging to two PDOs.
+    """
+
+    rng = np.random.default_rng(seed)
+    template = template.sortby('lat', ascending = False)
+    ny, nx = template.sizes['lat'], template.sizes['lon']
+
+    ##LAUs as contiguous blocks of pixels
+    block = max(1, int(np.sqrt(ny * nx / n_lau)))
+    lau = (np.arange(ny)[:, None] // block) * (nx // block + 1) + (np.arange(nx)[None, :] // block) + 1
+    ids = np.where(rng.random((ny, nx)) < coverage, lau, np.nan)
+    weights = np.where(np.isnan(ids), np.nan, rng.uniform(0.01, 1, (ny, nx)))
+
+    coords = {'lat': ('lat', template.lat.values, LAT_ATTRS), 'lon': ('lon', template.lon.values, LON_ATTRS)}
+    ids = xr.DataArray(ids, dims = ('lat', 'lon'), coords = coords, name = 'id').rio.write_crs(4326)
+    weights = xr.DataArray(weights, dims = ('lat', 'lon'), coords = coords).rio.write_crs(4326)
+
+    lau_ids = np.unique(lau)
+    lau_pdo = pd.DataFrame({'id': lau_ids, 'PDOid': [f'PDO-{i}' for i in rng.integers(0, n_pdo, len(lau_ids))]})
+    extra = lau_pdo.sample(frac = 0.2, random_state = seed).assign(PDOid = lambda x: [f'PDO-{i}' for i in rng.integers(0, n_pdo, len(x))])
+    lau_pdo = pd.concat([lau_pdo, extra]).drop_duplicates().sort_values(['PDOid', 'id']).reset_index(drop = True)
+
+    return(ids, weights, lau_pdo)
@@ -0,0 +1,31 @@
+import os
+import numpy as np
+import rioxarray
+
+from pydist import config
+from pydist.class_fraction import class_fraction
+
+minx, miny, maxx, maxy = config.aois["europe"]
+
+##CHELSA grids at all resolutions, cropped to the aoi
+grids = {}
+for resolution in [30, 90, 300, 1800]:
+    res = resolution / 3600
+    lon = np.round(np.arange(-180 + res / 2, 180, res), 8)
+    lat = np.round(np.arange(-90 + res / 2, 90, res), 8)
+    grids[resolution] = (lon[(lon >= minx) & (lon <= maxx)], lat[(lat >= miny) & (lat <= maxy)])
+
+##Share of vineyard pixels (class 2210) of LUISA per grid cell, counted in one pass over the raster
+fractions = class_fraction(
+    config.downloader.fetch("LUISA_50m.tif"),
+    value = 2210,
+    grids = grids,
+    tile_size = 4096,
+    n_workers = os.cpu_count(),
+)
+
+for resolution, share in fractions.items():
+    share = share.rio.set_spatial_dims(x_dim = 'lon', y_dim = 'lat').rio.write_crs(4326)
+    share.rio.to_raster(f'data/vineyards/luisa_share_{resolution}arcsec.tif', tiled = True, compress = 'lzw')
+
+    print(f'Vineyard share at {resolution}arcsec written.')
@@ -1,10 +1,13 @@
+import os
 import pandas as pd
 from pathlib import Path
 import numpy as np
 import geopandas as gpd
 import urllib.request
 
-from functions import config
+from pydist import config
+from pydist.dissolve import dissolve_by_key
+from pydist.polygonize import read_polygons
 
 pdo_shp = gpd.read_file(config.downloader.fetch('EU_PDO.gpkg'))
 pdo_varieties = pd.read_csv('data/candiago_2022.csv')
@@ -15,18 +18,15 @@ eurostat_shp = eurostat[["NUTS_ID", "geometry"]].drop_duplicates()
 
 varieties = np.sort(eurostat['Prime Name'].dropna().unique())
 
-vineyards_luisa = gpd.read_file('data/vineyards/luisa_vineyards.shp').to_crs(pdo_shp.crs)
+vineyards_luisa = read_polygons('data/vineyards/luisa_vineyards').to_crs(pdo_shp.crs)
 vineyards_osm = gpd.read_file('data/vineyards/osm_vineyards.shp').to_crs(pdo_shp.crs)
-vineyards_shp = gpd.GeoDataFrame({'id': [1], 'geometry': [pd.concat([vineyards_luisa, vineyards_osm]).geometry.union_all()]}, crs = pdo_shp.crs)
 
-##Intersect PDOs and vineyards
+##Intersect PDOs and vineyards, unioned per PDO in parallel
 pdo_vineyards = (
-    gpd.overlay(pdo_shp, vineyards_shp, how="intersection", keep_geom_type=True)
+    dissolve_by_key(pd.concat([vineyards_luisa, vineyards_osm]).geometry, pdo_shp, 'PDOid', n_workers = os.cpu_count())
     .explode()
 )
 
-del vineyards_shp
-
 pdo_vineyards = (
     pdo_vineyards.loc[pdo_vineyards.geometry.area >= 10000]
     .copy()
@@ -35,45 +35,38 @@ pdo_vineyards = (
 )
 print('Intersected vineyards')
 
-pdo_areas = []
-for var_name in varieties:
-
-    print(f'Processing {var_name}')
-
-    ##Select pdos and nuts that contain variety
-    pdos_var = pdo_varieties.loc[pdo_varieties['Prime Name'] == var_name, 'PDOid'].unique()
-    nuts_var = eurostat.loc[eurostat['Prime Name'] == var_name, 'NUTS_ID'].unique()
-
-    ##Intersect PDO vineyards and Eurostat
-    pdo_vineyards_nuts = gpd.overlay(
-        pdo_vineyards.loc[pdo_vineyards["PDOid"].isin(pdos_var)],
-        eurostat_shp.loc[eurostat_shp["NUTS_ID"].isin(nuts_var)],
-        how="intersection",
-        keep_geom_type=True,
-    )
-
-    if pdo_vineyards_nuts.shape[0] > 0:
-
-        pdo_vineyards_nuts = (
-            pdo_vineyards_nuts.loc[pdo_vineyards_nuts.geometry.area >= 100000]
-            .copy()
-        )
-        pdo_vineyards_nuts['Vin_Area_PDO'] = pdo_vineyards_nuts.geometry.area
-        pdo_vineyards_nuts['Vin_Area_NUTS'] = pdo_vineyards_nuts.groupby('NUTS_ID')['Vin_Area_PDO'].transform("sum")
-        pdo_vineyards_nuts = pdo_vineyards_nuts.merge(
-            eurostat.loc[eurostat["Prime Name"] == var_name, ["NUTS_ID", "Area"]],
-            on="NUTS_ID",
-            how="left",
-        )
-
-        pdo_vineyards_nuts['Cultivation Area'] = pdo_vineyards_nuts['Area'] * (pdo_vineyards_nuts['Vin_Area_PDO'] / pdo_vineyards_nuts['Vin_Area_NUTS'])
-        
-        pdo_cult_area = pdo_vineyards_nuts.groupby('PDOid', as_index = False)['Cultivation Area'].sum()
-        pdo_cult_area['Prime Name'] = var_name
+##Intersect PDO vineyards and Eurostat regions once for all varieties
+pdo_vineyards_nuts = gpd.overlay(
+    pdo_vineyards[["PDOid", "geometry"]],
+    eurostat_shp,
+    how="intersection",
+    keep_geom_type=True,
+)
+pdo_vineyards_nuts = pdo_vineyards_nuts.loc[pdo_vineyards_nuts.geometry.area >= 100000].copy()
+pdo_vineyards_nuts['Vin_Area_PDO'] = pdo_vineyards_nuts.geometry.area
+pdo_vineyards_nuts = pd.DataFrame(pdo_vineyards_nuts[['PDOid', 'NUTS_ID', 'Vin_Area_PDO']])
+print('Intersected Eurostat regions')
+
+##Select pdos and nuts that contain variety
+pdos_var = pdo_varieties[['PDOid', 'Prime Name']].drop_duplicates()
+nuts_var = eurostat.loc[eurostat['Prime Name'].isin(varieties), ['NUTS_ID', 'Prime Name']].drop_duplicates()
+
+pdo_areas = (
+    pdo_vineyards_nuts
+    .merge(pdos_var, on = 'PDOid', how = 'inner')
+    .merge(nuts_var, on = ['NUTS_ID', 'Prime Name'], how = 'inner')
+)
 
-        pdo_areas.append(pdo_cult_area)
+##Distribute the cultivation area of each NUTS region to its PDOs by vineyard area
+pdo_areas['Vin_Area_NUTS'] = pdo_areas.groupby(['Prime Name', 'NUTS_ID'])['Vin_Area_PDO'].transform("sum")
+pdo_areas = pdo_areas.merge(
+    eurostat[['NUTS_ID', 'Prime Name', 'Area']],
+    on=['NUTS_ID', 'Prime Name'],
+    how="left",
+)
+pdo_areas['Cultivation Area'] = pdo_areas['Area'] * (pdo_areas['Vin_Area_PDO'] / pdo_areas['Vin_Area_NUTS'])
 
-pdo_areas = pd.concat(pdo_areas)
+pdo_areas = pdo_areas.groupby(['PDOid', 'Prime Name'], as_index = False)['Cultivation Area'].sum()
 pdo_areas_merge = pdo_varieties.merge(pdo_areas, on = ['PDOid', 'Prime Name'], how = 'left')
 
 pdo_areas_merge.to_csv('data/candiago_2022_area.csv')
\ No newline at end of file
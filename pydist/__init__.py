@@ -1,6 +1,23 @@
 from . import config
-from .get_climatic_window import calc_phen_date, get_climatic_window
+from .get_climatic_window import calc_phen_date, calc_phen_dates, doy_to_date, get_climatic_window, calc_prefix_sums, calc_window_indices
+from .fused_kernel import calc_veraison_indices
 from .save_array import save_array
 from .get_climate import load_chelsa_w5e5
+from .file_cache import FileCache
+from .remote import open_remote_dataset
+from .ingest import ingest_chelsa, open_store, store_path
+from .prefetch import prefetch
+from .streaming import StreamingIndices, stream_chelsa_indices
 from .alignment import align_arrays
 from .cluster import init_cluster
+from .sparse import compress_pixels, expand_pixels
+from .aggregation import build_aggregation_matrices, aggregate_to_lau, aggregate_to_pdo, aggregate_lau_to_pdo, partial_lau_sums, merge_lau_partials
+from .tiling import plan_tiles, run_tiled, run_blocks
+from .result_store import ResultStore
+from .veraison_store import write_veraison, open_veraison, stored_veraison_years
+from .instrument import RunReport, stage, add_bytes
+from .grid import grid_cells, grid_resolution
+from .coverage import coverage_fractions, dominant_coverage
+from .dissolve import dissolve_by_key, partition_union
+from .polygonize import plan_windows, tile_index, block_classes, polygonize_class, read_polygons
+from .class_fraction import class_fraction
@@ -0,0 +1,234 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy import sparse
+from collections import namedtuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+AggregationMatrices = namedtuple(
+    'AggregationMatrices',
+    ['pixels', 'spatial_dims', 'lau_ids', 'lau_weights', 'lau_members', 'pdo_ids', 'pdo_members']
+)
+
+LauPartials = namedtuple('LauPartials', ['lau_ids', 'weight', 'value_sum', 'n_valid', 'template'])
+
+def build_aggregation_matrices(ids, weights, lau_pdo, id_col = 'id', pdo_col = 'PDOid', spatial_dims = None):
+    """
+    Build sparse matrices that aggregate pixel values to LAU and PDO level.
+
+    Parameters:
+      ids : xarray.DataArray
+          LAU id of each pixel, NaN for pixels without vineyards.
+      weights : xarray.DataArray
+          Vineyard area share of each pixel, on the same grid as ids.
+      lau_pdo : pandas.DataFrame
+          Link between LAU ids and PDOs with one row per (id_col, pdo_col) pair.
+      spatial_dims : sequence of str, optional
+          Dimensions of ids that are flattened into pixels. Defaults to all dimensions of ids.
+
+    Returns:
+      matrices : AggregationMatrices
+          pixels holds the flat index of all pixels with an id. lau_weights (LAU x pixel) contains
+          the normalised area weights, lau_members and pdo_members (PDO x LAU) are binary.
+    """
+
+    if spatial_dims is None:
+        spatial_dims = ids.dims
+    spatial_dims = tuple(spatial_dims)
+
+    pixels, lau_ids, lau_idx, w = _pixel_weights(ids, weights, spatial_dims)
+
+    shp = (len(lau_ids), len(pixels))
+    lau_members = sparse.csr_matrix((np.ones(len(pixels)), (lau_idx, np.arange(len(pixels)))), shape = shp)
+
+    ##Normalise weights by the total weight of each LAU
+    w_sum = np.bincount(lau_idx, weights = w, minlength = len(lau_ids))
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        w_norm = w / w_sum[lau_idx]
+    lau_weights = sparse.csr_matrix((np.nan_to_num(w_norm), (lau_idx, np.arange(len(pixels)))), shape = shp)
+
+    ##Link LAUs to PDOs
+    link = lau_pdo[[id_col, pdo_col]].drop_duplicates()
+    link = link.loc[link[id_col].isin(lau_ids)]
+    pdo_ids, pdo_idx = np.unique(link[pdo_col].values, return_inverse = True)
+    pdo_members = sparse.csr_matrix(
+        (np.ones(len(link)), (pdo_idx, np.searchsorted(lau_ids, link[id_col].values.astype(np.int64)))),
+        shape = (len(pdo_ids), len(lau_ids))
+    )
+
+    logger.debug(f'Built aggregation matrices for {len(pixels)} pixels, {len(lau_ids)} LAUs and {len(pdo_ids)} PDOs')
+
+    return(AggregationMatrices(pixels, spatial_dims, lau_ids, lau_weights, lau_members, pdo_ids, pdo_members))
+
+def aggregate_to_lau(clim_idx, matrices):
+    """
+    Calculate the area weighted mean of each variable per LAU.
+
+    Pixels with missing values count towards the total weight of a LAU. LAUs without any valid
+    pixel are NaN.
+
+    Returns:
+      lau_idx : xarray.Dataset
+          Dataset with the spatial dimensions replaced by a dimension 'id'.
+    """
+
+    values, template = _flatten(clim_idx, matrices.pixels, matrices.spatial_dims)
+
+    lau = matrices.lau_weights @ np.nan_to_num(values).T
+    n_valid = matrices.lau_members @ (~np.isnan(values)).T.astype(np.float64)
+    lau[n_valid == 0] = np.nan
+
+    return(_unflatten(lau, template, 'id', matrices.lau_ids))
+
+def aggregate_to_pdo(clim_idx, matrices, pdo_col = 'PDOid'):
+    """
+    Aggregate pixel values to PDO level as the mean over the area weighted LAU values.
+
+    Returns:
+      tbl : pandas.DataFrame
+          One row per PDO and combination of the non-spatial dimensions of clim_idx. Scalar
+          coordinates of clim_idx are added as columns.
+    """
+
+    return(aggregate_lau_to_pdo(aggregate_to_lau(clim_idx, matrices), matrices, pdo_col = pdo_col))
+
+def aggregate_lau_to_pdo(lau, matrices, pdo_col = 'PDOid'):
+    """
+    Aggregate LAU values, e.g. from aggregate_to_lau or merge_lau_partials, to PDO level.
+
+    Returns:
+      tbl : pandas.DataFrame
+          Same as aggregate_to_pdo.
+    """
+
+    lau = lau.reindex(id = matrices.lau_ids)
+    values, template = _flatten(lau, slice(None), ('id', ))
+
+    pdo_sum = matrices.pdo_members @ np.nan_to_num(values).T
+    pdo_n = matrices.pdo_members @ (~np.isnan(values)).T.astype(np.float64)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        pdo = pdo_sum / pdo_n
+
+    ds_pdo = _unflatten(pdo, template, pdo_col, matrices.pdo_ids)
+
+    scalar_coords = [i for i in ds_pdo.coords if (ds_pdo[i].ndim == 0) and (i != 'spatial_ref')]
+    tbl = ds_pdo.drop_vars('spatial_ref', errors = 'ignore').to_dataframe().reset_index()
+    columns = [pdo_col] + scalar_coords + [i for i in template['dims'] if i != pdo_col] + list(ds_pdo.data_vars)
+
+    return(tbl[columns])
+
+def partial_lau_sums(clim_idx, ids, weights, spatial_dims = None):
+    """
+    Unnormalised area weighted sums per LAU for a part of the grid, e.g. one spatial tile.
+
+    The partial sums of all parts are combined with merge_lau_partials, which gives the same
+    result as aggregate_to_lau on the full grid.
+
+    Parameters:
+      clim_idx : xarray.Dataset
+          Pixel values on the same grid as ids.
+      ids, weights, spatial_dims :
+          Same as in build_aggregation_matrices.
+
+    Returns:
+      partials : LauPartials
+          LAU ids of the part with the summed weights (weight), the summed weighted values
+          (value_sum) and the number of valid values (n_valid).
+    """
+
+    if spatial_dims is None:
+        spatial_dims = ids.dims
+    spatial_dims = tuple(spatial_dims)
+
+    pixels, lau_ids, lau_idx, w = _pixel_weights(ids, weights, spatial_dims)
+    values, template = _flatten(clim_idx, pixels, spatial_dims)
+
+    members = sparse.csr_matrix((np.ones(len(pixels)), (lau_idx, np.arange(len(pixels)))), shape = (len(lau_ids), len(pixels)))
+    value_sum = members.multiply(w[None, :]).tocsr() @ np.nan_to_num(values).T
+    n_valid = members @ (~np.isnan(values)).T.astype(np.float64)
+    weight = np.bincount(lau_idx, weights = w, minlength = len(lau_ids))
+
+    return(LauPartials(lau_ids, weight, value_sum, n_valid, template))
+
+def merge_lau_partials(partials, lau_ids = None):
+    """
+    Combine the output of partial_lau_sums into the area weighted mean per LAU.
+
+    Parameters:
+      partials : list of LauPartials
+          Partial sums with the same non-spatial dimensions and variables.
+      lau_ids : array-like, optional
+          LAU ids of the output. Defaults to all ids contained in partials.
+
+    Returns:
+      lau_idx : xarray.Dataset
+          Same as aggregate_to_lau. Without partials, a dataset without variables.
+    """
+
+    if len(partials) == 0:
+        return(xr.Dataset(coords = {'id': np.asarray([] if lau_ids is None else lau_ids, dtype = np.int64)}))
+
+    if lau_ids is None:
+        lau_ids = np.unique(np.concatenate([p.lau_ids for p in partials]))
+    lau_ids = np.asarray(lau_ids)
+
+    n = partials[0].value_sum.shape[1]
+    weight = np.zeros(len(lau_ids))
+    value_sum = np.zeros((len(lau_ids), n))
+    n_valid = np.zeros((len(lau_ids), n))
+
+    ##LAU ids are unique within each part, so the sums can be added with fancy indexing
+    for p in partials:
+        idx = np.searchsorted(lau_ids, p.lau_ids)
+        weight[idx] += p.weight
+        value_sum[idx] += p.value_sum
+        n_valid[idx] += p.n_valid
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        lau = np.where(weight[:, None] > 0, value_sum / weight[:, None], 0)
+    lau[n_valid == 0] = np.nan
+
+    return(_unflatten(lau, partials[0].template, 'id', lau_ids))
+
+def _pixel_weights(ids, weights, spatial_dims):
+
+    ids_flat = ids.transpose(*spatial_dims).values.ravel()
+    weights_flat = weights.transpose(*spatial_dims).values.ravel()
+
+    pixels = np.flatnonzero(~np.isnan(ids_flat))
+    lau_ids, lau_idx = np.unique(ids_flat[pixels].astype(np.int64), return_inverse = True)
+    w = np.nan_to_num(weights_flat[pixels])
+
+    return(pixels, lau_ids, lau_idx, w)
+
+def _flatten(ds, pixels, spatial_dims):
+
+    ds = ds.drop_vars([i for i in ds.coords if set(ds[i].dims) & set(spatial_dims)])
+    other_dims = [i for i in ds.dims if i not in spatial_dims]
+
+    values = []
+    for var in ds.data_vars:
+        arr = ds[var].transpose(*other_dims, *spatial_dims).values
+        arr = arr.reshape(int(np.prod(arr.shape[:len(other_dims)])), -1)[:, pixels]
+        values.append(arr.astype(np.float64))
+
+    template = {
+        'vars': list(ds.data_vars),
+        'dims': other_dims,
+        'shape': [ds.sizes[i] for i in other_dims],
+        'coords': {k: v for k, v in ds.coords.items() if set(v.dims) <= set(other_dims)},
+    }
+
+    return(np.concatenate(values, axis = 0), template)
+
+def _unflatten(values, template, dim, labels):
+
+    n = int(np.prod(template['shape']))
+    data_vars = {}
+    for i, var in enumerate(template['vars']):
+        arr = np.asarray(values[:, i*n:(i+1)*n]).reshape([len(labels)] + template['shape'])
+        data_vars[var] = ([dim] + template['dims'], arr)
+
+    return(xr.Dataset(data_vars, coords = {dim: labels, **template['coords']}))
@@ -1,11 +1,45 @@
 import xarray as xr
+import numpy as np
 import rioxarray
 from rasterio.enums import Resampling
+from collections import OrderedDict
+from pathlib import Path
+import hashlib
+import os
 import logging
 
 logger = logging.getLogger(__name__)
 
-def align_arrays(*objects, base, method = 'bilinear', x_dim = 'lon', y_dim = 'lat'):
+##In-process LRU cache of (source, reprojected) arrays, keyed by source and target grid
+_grid_cache = OrderedDict()
+
+def align_arrays(*objects, base, method = 'bilinear', x_dim = 'lon', y_dim = 'lat', cache_size = 8, cache_dir = None):
+    """
+    Reproject arrays to the grid of base and assign its coordinates.
+
+    Reprojected arrays are cached by the source array and the coordinates, CRS, transform,
+    shape and resampling method of the target grid, so repeated calls on the same grid (e.g. for
+    every year chunk) only reproject once. Arrays opened from a file are identified by the path,
+    modification time and size of the file, other arrays by the object itself. The pixels are
+    never hashed, so arrays opened from a file and modified in place afterwards are not detected.
+
+    Parameters:
+      *objects : xarray.DataArray
+          Arrays to align.
+      base : xarray.DataArray
+          Array defining the target grid.
+      method : str, default 'bilinear'
+          Resampling method. One of nearest, bilinear or cubic.
+      cache_size : int, default 8
+          Number of reprojected arrays kept in memory. Use 0 to disable the in-process cache.
+      cache_dir : str or Path, optional
+          If provided, reprojected arrays of sources opened from a file are additionally stored
+          as NetCDF files in this directory and reused across runs.
+
+    Returns:
+      out : tuple
+          Aligned arrays in the same order as provided.
+    """
 
     res_methods = {
         'nearest': Resampling.nearest,
@@ -13,18 +47,30 @@ def align_arrays(*objects, base, method = 'bilinear', x_dim = 'lon', y_dim = 'la
         'cubic': Resampling.cubic
     }
 
+    if cache_dir is not None:
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(exist_ok = True, parents = True)
+
     out = []
     for arr in objects:
 
         if (arr.rio.crs != base.rio.crs) or (arr.rio.resolution() != base.rio.resolution()):
 
-            logger.debug('Reprojecting climate data')
+            key, persistent = _grid_key(arr, base, method, x_dim = x_dim, y_dim = y_dim)
+            arr_cached = _cache_get(key, cache_dir if persistent else None)
+
+            if arr_cached is None:
+                logger.debug('Reprojecting climate data')
 
-            arr = (
-                arr.rio.set_spatial_dims(x_dim=x_dim, y_dim=y_dim)
-                .rio.reproject_match(base, resampling = res_methods[method])
-                .rename({"x": x_dim, "y": y_dim})
-            )
+                arr_src, arr = arr, (
+                    arr.rio.set_spatial_dims(x_dim=x_dim, y_dim=y_dim)
+                    .rio.reproject_match(base, resampling = res_methods[method])
+                    .rename({"x": x_dim, "y": y_dim})
+                )
+                _cache_put(key, arr_src, arr, cache_dir if persistent else None, cache_size)
+            else:
+                logger.debug('Using cached reprojection')
+                arr = arr_cached
 
         arr_re = arr.assign_coords({
             x_dim: base[x_dim],
@@ -34,3 +80,67 @@ def align_arrays(*objects, base, method = 'bilinear', x_dim = 'lon', y_dim = 'la
         out.append(arr_re)
 
     return(tuple(out))
+
+def clear_grid_cache():
+    _grid_cache.clear()
+
+def _grid_key(arr, base, method, x_dim = 'lon', y_dim = 'lat'):
+
+    base = base.rio.set_spatial_dims(x_dim=x_dim, y_dim=y_dim)
+
+    h = hashlib.sha256()
+
+    ##Source identity: the file it was opened from, or the object for in-memory arrays.
+    ##The in-process cache keeps a reference to the source, so its id is not reused.
+    source = arr.encoding.get('source')
+    persistent = (source is not None) and os.path.isfile(source)
+    if persistent:
+        stat = os.stat(source)
+        h.update(f'{os.path.abspath(source)}:{stat.st_mtime_ns}:{stat.st_size}'.encode())
+    else:
+        h.update(f'id:{id(arr)}'.encode())
+
+    ##Source grid
+    h.update(str(arr.name).encode())
+    h.update(str(arr.rio.crs).encode())
+    h.update(str(arr.rio.transform()).encode())
+    h.update(str(arr.shape).encode())
+    h.update(str(arr.dtype).encode())
+
+    ##Target grid
+    h.update(str(base.rio.crs).encode())
+    h.update(str(tuple(base.rio.transform())).encode())
+    h.update(str(base.rio.shape).encode())
+    h.update(np.ascontiguousarray(base[x_dim].values).tobytes())
+    h.update(np.ascontiguousarray(base[y_dim].values).tobytes())
+    h.update(method.encode())
+
+    return(h.hexdigest(), persistent)
+
+def _cache_get(key, cache_dir = None):
+
+    if key in _grid_cache:
+        _grid_cache.move_to_end(key)
+        return(_grid_cache[key][1])
+
+    if cache_dir is not None:
+        fname = Path(cache_dir, f'{key}.nc')
+        if fname.is_file():
+            with xr.open_dataarray(fname, decode_coords = 'all') as arr:
+                return(arr.load())
+
+    return(None)
+
+def _cache_put(key, source, arr, cache_dir = None, cache_size = 8):
+
+    if cache_size > 0:
+        _grid_cache[key] = (source, arr)
+        _grid_cache.move_to_end(key)
+        while len(_grid_cache) > cache_size:
+            _grid_cache.popitem(last = False)
+
+    if cache_dir is not None:
+        fname = Path(cache_dir, f'{key}.nc')
+        tmp = fname.with_suffix('.nc.tmp')
+        arr.to_netcdf(tmp)
+        tmp.replace(fname)
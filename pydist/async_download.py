@@ -0,0 +1,148 @@
+import aiohttp
+import asyncio
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+def download_files(urls, cache, max_per_host = 4, attempts = 3, progress = None, timeout = 60, chunk_size = 2**20):
+    """
+    Download files concurrently into a FileCache using a single pooled HTTP session.
+
+    Parameters:
+      urls : list
+          Urls to download. Urls already in the cache are not downloaded again.
+      cache : FileCache
+          Cache receiving the files. Interrupted downloads are resumed from its partial files
+          with an If-Range request, so they restart from the beginning if the file changed on
+          the server in the meantime.
+      max_per_host : int, default 4
+          Maximum number of simultaneous connections per host. Connections are kept alive
+          and reused between files.
+      attempts : int, default 3
+          Number of attempts per file. Retries wait with exponential backoff without blocking
+          other downloads.
+      progress : callable, optional
+          Called as progress(url, n_bytes, done, total) after each received chunk, with the
+          size of the chunk, the bytes received for url so far and the expected size of url
+          (None if unknown).
+      timeout : float, default 60
+          Timeout in seconds for connecting and for every read from the connection. The
+          duration of the whole transfer is not limited, so large files are not aborted.
+
+    Returns:
+      results : list
+          Tuples (path, error) in the order of urls. path is the cached file (the url if the
+          download failed) and error is None on success.
+    """
+
+    results = asyncio.run(_download_all(urls, cache, max_per_host, attempts, progress, timeout, chunk_size))
+    cache.flush()
+
+    return(results)
+
+async def _download_all(urls, cache, max_per_host, attempts, progress, timeout, chunk_size):
+
+    connector = aiohttp.TCPConnector(limit = 0, limit_per_host = max_per_host)
+    client_timeout = aiohttp.ClientTimeout(total = None, sock_connect = timeout, sock_read = timeout)
+
+    async with aiohttp.ClientSession(connector = connector, timeout = client_timeout, auto_decompress = False) as session:
+        results = await asyncio.gather(
+            *[_download_file(session, url, cache, attempts, progress, chunk_size) for url in urls]
+        )
+
+    return(results)
+
+async def _download_file(session, url, cache, attempts, progress, chunk_size):
+
+    local_filename = cache.get(url)
+    if local_filename is not None:
+        return(local_filename, None)
+
+    loop = asyncio.get_running_loop()
+
+    for attempt in range(attempts):
+
+        try:
+            part = await _fetch_part(session, url, cache, progress, chunk_size)
+            local_filename = await loop.run_in_executor(None, cache.commit, url, part)
+            return(local_filename, None)
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, IOError) as e:
+            logger.debug(f"Retry {attempt + 1} for {url}: {e}")
+            await asyncio.sleep(2 ** (attempt+1))
+
+    return(url, f"Failed after {attempts} retries")
+
+async def _fetch_part(session, url, cache, progress, chunk_size):
+
+    part, validator_file = cache.part_path(url), cache.validator_path(url)
+    offset = part.stat().st_size if part.is_file() else 0
+    validator = validator_file.read_text() if validator_file.is_file() else None
+
+    ##Resume only if the server can tell whether the file changed since the partial download
+    headers = {'Range': f'bytes={offset}-', 'If-Range': validator} if (offset > 0) and validator else {}
+
+    async with session.get(url, headers = headers) as r:
+
+        ##Range not satisfiable: partial file is corrupt or outdated
+        if r.status == 416:
+            part.unlink()
+            raise IOError(f'Invalid partial file for {url}. Restarting download.')
+        r.raise_for_status()
+
+        if r.status != 206:
+            offset = 0
+            _write_validator(validator_file, r.headers)
+        total = _expected_size(r.headers, offset)
+
+        done = offset
+        with open(part, 'ab' if offset > 0 else 'wb') as f:
+            async for chunk in r.content.iter_chunked(chunk_size):
+                ##Write in a thread to keep the event loop serving the other downloads
+                await asyncio.to_thread(f.write, chunk)
+                done += len(chunk)
+                if progress is not None:
+                    progress(url, len(chunk), done, total)
+
+    if (total is not None) and (done != total):
+        raise IOError(f'Incomplete download of {url}: got {done} of {total} bytes')
+
+    return(part)
+
+def _write_validator(fname, headers):
+
+    ##Weak ETags are not allowed in If-Range
+    etag = headers.get('ETag')
+    validator = etag if (etag is not None) and (not etag.startswith('W/')) else headers.get('Last-Modified')
+    if validator is None:
+        fname.unlink(missing_ok = True)
+    else:
+        fname.write_text(validator)
+
+def _expected_size(headers, offset = 0):
+
+    if 'Content-Range' in headers:
+        total = headers['Content-Range'].split('/')[-1]
+        return(int(total) if total != '*' else None)
+    if 'Content-Length' in headers:
+        return(offset + int(headers['Content-Length']))
+    return(None)
+
+class TransferStats:
+    """
+    Progress callback for download_files that accumulates the downloaded bytes.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.bytes = 0
+        self.files = dict()
+
+    def __call__(self, url, n_bytes, done, total):
+        self.bytes += n_bytes
+        self.files[url] = (done, total)
+
+    def bandwidth(self):
+        """Average bandwidth in bytes per second since the object was created."""
+        return(self.bytes / max(time.time() - self.start, 1e-9))
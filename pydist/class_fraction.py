@@ -0,0 +1,142 @@
+import numpy as np
+import xarray as xr
+import rasterio
+from rasterio.windows import Window
+from pyproj import CRS, Transformer
+from concurrent.futures import ProcessPoolExecutor
+import logging
+
+from .grid import grid_resolution
+from .polygonize import tile_index
+
+logger = logging.getLogger(__name__)
+
+def class_fraction(path, value, grids, tile_size = 4096, n_workers = 1, crs = 4326):
+    """
+    Fraction of the cells of one or several target grids covered by pixels of a class.
+
+    The raster is read window by window, without warping it and without creating polygons.
+    Windows without value are skipped (see tile_index). In the other windows, only the centers
+    of the pixels equal to value are transformed to the crs of the grids and mapped to a cell
+    index of every grid, and the pixels per cell are counted with bincount.
+    The counts are converted to fractions with the pixel area and the area of the cells on the
+    ellipsoid, so the raster must be in an equal-area crs (e.g. EPSG:3035 for LUISA).
+
+    All grids are filled in the same pass over the raster. Windows are processed in a process
+    pool if n_workers > 1 and only the counts of covered cells are returned by the workers.
+
+    Parameters:
+      path : str or Path
+          Path of the raster.
+      value : int
+          Pixel value to count, e.g. 2210 for vineyards in LUISA.
+      grids : dict
+          Target grids as name: (x, y) with the cell center coordinates along x (e.g. lon) and
+          y (e.g. lat) in crs.
+      tile_size : int, default 4096
+          Same as in tile_index.
+      n_workers : int, default 1
+          Number of worker processes.
+      crs : optional, default 4326
+          Geographic crs of the target grids.
+
+    Returns:
+      fractions : dict
+          Fraction of each cell as xarray.DataArray with dimensions (lat, lon), per grid name.
+    """
+
+    tiles = tile_index(path, tile_size = tile_size, value = value, n_workers = n_workers)
+    tiles = tiles.loc[tiles['candidate']]
+
+    grids = {k: (np.asarray(x), np.asarray(y)) for k, (x, y) in grids.items()}
+    specs = {k: _grid_spec(x, y) for k, (x, y) in grids.items()}
+    tasks = [(path, value, window, specs, crs) for window in tiles[['row_off', 'col_off', 'height', 'width']].values.tolist()]
+
+    counts = {k: np.zeros(len(x) * len(y), dtype = np.int64) for k, (x, y) in grids.items()}
+    logger.info(f'Counting pixels of {len(tasks)} windows with {n_workers} worker(s)')
+    if n_workers > 1:
+        with ProcessPoolExecutor(n_workers) as pool:
+            results = pool.map(_count_window, tasks)
+            for res in results:
+                _add_counts(counts, res)
+    else:
+        for task in tasks:
+            _add_counts(counts, _count_window(task))
+
+    with rasterio.open(path) as src:
+        pixel_area = abs(src.transform.a * src.transform.e - src.transform.b * src.transform.d)
+
+    fractions = {}
+    for k, (x, y) in grids.items():
+        cell_area = _cell_area(x, y, crs)
+        frac = counts[k].reshape(len(y), len(x)) * pixel_area / cell_area[:, None]
+        fractions[k] = xr.DataArray(frac, coords = {'lat': y, 'lon': x}, dims = ('lat', 'lon'), name = 'fraction')
+
+    return(fractions)
+
+def _grid_spec(x, y):
+
+    ##Lower edge, resolution, size and orientation along both axes
+    res_x, res_y = abs(grid_resolution(x)), abs(grid_resolution(y))
+    return((x.min() - res_x / 2, res_x, len(x), x[0] > x[-1]), (y.min() - res_y / 2, res_y, len(y), y[0] > y[-1]))
+
+def _cell_index(coords, spec):
+
+    start, res, n, descending = spec
+    idx = np.floor((coords - start) / res).astype(np.int64)
+    valid = (idx >= 0) & (idx < n)
+    if descending:
+        idx = n - 1 - idx
+
+    return(idx, valid)
+
+def _count_window(task):
+
+    path, value, (row_off, col_off, height, width), specs, crs = task
+
+    with rasterio.open(path) as src:
+        data = src.read(1, window = Window(col_off, row_off, width, height))
+        t, src_crs = src.transform, src.crs
+
+    rows, cols = np.nonzero(data == value)
+    del data
+    if len(rows) == 0:
+        return({})
+
+    ##Centers of the class pixels only, in the crs of the grids
+    rows, cols = rows + row_off + 0.5, cols + col_off + 0.5
+    px = t.c + t.a * cols + t.b * rows
+    py = t.f + t.d * cols + t.e * rows
+    lon, lat = Transformer.from_crs(src_crs, crs, always_xy = True).transform(px, py)
+
+    out = {}
+    for k, (spec_x, spec_y) in specs.items():
+        ix, valid_x = _cell_index(lon, spec_x)
+        iy, valid_y = _cell_index(lat, spec_y)
+        valid = valid_x & valid_y
+        cell = iy[valid] * spec_x[2] + ix[valid]
+        if len(cell) == 0:
+            continue
+
+        ##Count over the range of cells touched by the window and keep the covered ones
+        n = np.bincount(cell - cell.min())
+        idx = np.flatnonzero(n)
+        out[k] = (idx + cell.min(), n[idx])
+
+    return(out)
+
+def _add_counts(counts, res):
+    for k, (idx, n) in res.items():
+        counts[k][idx] += n
+
+def _cell_area(x, y, crs):
+
+    ##Area of one cell per row on the ellipsoid of crs
+    geod = CRS.from_user_input(crs).get_geod()
+    res_x, res_y = abs(grid_resolution(x)), abs(grid_resolution(y))
+    area = [
+        abs(geod.polygon_area_perimeter([0, res_x, res_x, 0], [lat - res_y / 2, lat - res_y / 2, lat + res_y / 2, lat + res_y / 2])[0])
+        for lat in y
+    ]
+
+    return(np.asarray(area))
@@ -10,6 +10,9 @@ aois = {
     'alpine_space': [3.69,42.98,17.16,50.56]
 }
 
+climate_cache = pooch.os_cache("sdm") / "chelsa-w5e5"
+block_cache = pooch.os_cache("sdm") / "block_classes"
+
 downloader = pooch.create(
     path=pooch.os_cache("sdm"),
     base_url="",
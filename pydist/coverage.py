@@ -0,0 +1,228 @@
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import CRS, Transformer
+import logging
+
+from .grid import grid_resolution
+
+logger = logging.getLogger(__name__)
+
+def coverage_fractions(geometries, keys, x, y, min_coverage = 1e-9, crs = 4326):
+    """
+    Exact fraction of each raster cell covered by polygons, per key.
+
+    Instead of intersecting cell polygons with the geometries, the covered area is integrated
+    along the polygon edges (Green's theorem, similar to exactextract): every edge is split at
+    the row and column boundaries of the grid and each piece adds the area between itself and
+    the lower boundary of its row to its own cell and a full row height to all cells below it
+    in the same column. Summing the pieces of closed rings gives the covered area of every cell.
+    Cell geometries are never created, so the work scales with the number of polygon vertices
+    and covered cells.
+
+    For geographic grids, the fractions are shares of the area on the ellipsoid, like the area
+    ratio of the intersection and the cell in an equal-area crs (e.g. EPSG:3035). Edges are split
+    in grid coordinates, and every piece is weighted with the area element of the ellipsoid,
+    which only depends on the latitude. For projected grids, areas are computed in the
+    coordinates of the grid.
+
+    Parameters:
+      geometries : geopandas.GeoSeries or array of shapely geometries
+          Polygons or MultiPolygons in the crs of the grid. Overlapping polygons with the same
+          key are counted twice, so dissolve them by key first.
+      keys : array-like
+          Key of each geometry, e.g. the GISCO_ID. If a pandas Series, its name is used as
+          column name.
+      x, y : array-like
+          Cell center coordinates of the grid along x (e.g. lon) and y (e.g. lat).
+      min_coverage : float, default 1e-9
+          Fractions below this value (e.g. from polygons only touching a cell) are dropped.
+      crs : optional, default 4326
+          CRS of the grid and the geometries.
+
+    Returns:
+      fractions : pandas.DataFrame
+          Columns key (or the name of keys), row, col and coverage with one row per key and
+          covered cell. row and col index y and x.
+    """
+
+    key_name = keys.name if (isinstance(keys, pd.Series) and keys.name is not None) else 'key'
+    keys = np.asarray(keys)
+    x, y = np.asarray(x), np.asarray(y)
+    nx, ny = len(x), len(y)
+
+    ##Work in grid units: cells have size 1 and the lower left grid corner is at (0, 0)
+    res_x, res_y = abs(grid_resolution(x)), abs(grid_resolution(y))
+    x0, y0 = x.min() - res_x / 2, y.min() - res_y / 2
+
+    geom_idx, ua, va, ub, vb = _polygon_edges(np.asarray(geometries))
+    ua, ub = (ua - x0) / res_x, (ub - x0) / res_x
+    va, vb = (va - y0) / res_y, (vb - y0) / res_y
+
+    ##Split the edges at all grid lines
+    geom_idx, u1, v1, u2, v2 = _split_edges(geom_idx, ua, va, ub, vb)
+    du = u2 - u1
+    keep = du != 0
+    geom_idx, u1, v1, u2, v2, du = geom_idx[keep], u1[keep], v1[keep], u2[keep], v2[keep], du[keep]
+
+    col = np.floor((u1 + u2) / 2).astype(np.int64)
+    row = np.floor((v1 + v2) / 2).astype(np.int64)
+
+    ##Columns are independent of each other, so pieces outside the grid columns can be dropped.
+    ##Pieces above the grid still add to the cells below them and are kept.
+    keep = (col >= 0) & (col < nx)
+    geom_idx, col, row, v1, v2, du = geom_idx[keep], col[keep], row[keep], v1[keep], v2[keep], du[keep]
+
+    ##Area between the piece and the lower row boundary, and a full row for every cell below
+    own = -_row_fraction(v1, v2, row, y0, res_y, ny, crs) * du
+    below = -du
+
+    cov_geom, cov_row, cov_col, cov = _accumulate_columns(geom_idx, col, row, own, below, nx)
+
+    ##Drop cells outside the grid rows and flip rows for descending y
+    valid = (cov_row >= 0) & (cov_row < ny) & (cov > min_coverage)
+    cov_geom, cov_row, cov_col, cov = cov_geom[valid], cov_row[valid], cov_col[valid], cov[valid]
+    if y[0] > y[-1]:
+        cov_row = ny - 1 - cov_row
+    if x[0] > x[-1]:
+        cov_col = nx - 1 - cov_col
+
+    fractions = pd.DataFrame({key_name: keys[cov_geom], 'row': cov_row, 'col': cov_col, 'coverage': cov})
+    fractions = fractions.groupby([key_name, 'row', 'col'], as_index = False, sort = False)['coverage'].sum()
+
+    logger.debug(f'Calculated coverage of {len(fractions)} cell/key pairs from {len(ua)} polygon edges')
+
+    return(fractions)
+
+def dominant_coverage(fractions, key_name = None):
+    """
+    Select the key with the largest coverage per cell.
+
+    Parameters:
+      fractions : pandas.DataFrame
+          Output of coverage_fractions.
+
+    Returns:
+      dominant : pandas.DataFrame
+          One row per covered cell with the dominant key and its coverage.
+    """
+
+    if key_name is None:
+        key_name = [i for i in fractions.columns if i not in ['row', 'col', 'coverage']][0]
+
+    dominant = (
+        fractions.sort_values(['coverage', key_name], ascending = [False, True], kind = 'stable')
+        .drop_duplicates(['row', 'col'], keep = 'first')
+        .sort_values(['row', 'col'])
+        .reset_index(drop = True)
+    )
+
+    return(dominant)
+
+def _row_fraction(v1, v2, row, y0, res_y, ny, crs):
+
+    ##Mean height of the pieces above the lower boundary of their row, as a fraction of the row
+    frac = (v1 + v2) / 2 - row
+    crs = CRS.from_user_input(crs)
+    if not crs.is_geographic:
+        return(frac)
+
+    ##On the ellipsoid, the height is measured as northing of a cylindrical equal-area projection,
+    ##where the cells are rectangles. Its mean along a piece is integrated with Simpson's rule.
+    geod = crs.get_geod()
+    cea = CRS.from_proj4(f'+proj=cea +a={geod.a} +b={geod.b} +units=m +no_defs')
+    to_cea = Transformer.from_crs(crs, cea, always_xy = True)
+
+    inside = (row >= 0) & (row < ny)
+    r, v = row[inside], np.stack([v1[inside], (v1[inside] + v2[inside]) / 2, v2[inside]])
+    _, northing = to_cea.transform(np.zeros_like(v), y0 + v * res_y)
+    _, bounds = to_cea.transform(np.zeros(ny + 1), y0 + np.arange(ny + 1) * res_y)
+
+    h = (northing - bounds[r]) / (bounds[r + 1] - bounds[r])
+    frac[inside] = (h[0] + 4 * h[1] + h[2]) / 6
+
+    return(frac)
+
+def _polygon_edges(geometries):
+
+    parts, part_geom = shapely.get_parts(geometries, return_index = True)
+    is_polygon = shapely.get_type_id(parts) == 3
+    parts, part_geom = parts[is_polygon], part_geom[is_polygon]
+
+    ##Counter-clockwise exterior rings and clockwise holes, so holes are subtracted
+    parts = shapely.orient_polygons(parts, exterior_cw = False)
+    rings, ring_part = shapely.get_rings(parts, return_index = True)
+    coords, ring_idx = shapely.get_coordinates(rings, return_index = True)
+
+    ##Consecutive vertices of the same ring form an edge
+    same_ring = ring_idx[:-1] == ring_idx[1:]
+    start = np.flatnonzero(same_ring)
+    geom_idx = part_geom[ring_part[ring_idx[start]]]
+
+    return(geom_idx, coords[start, 0], coords[start, 1], coords[start + 1, 0], coords[start + 1, 1])
+
+def _split_edges(geom_idx, ua, va, ub, vb):
+
+    ##Parameters t in (0, 1) where each edge crosses a vertical or horizontal grid line
+    t_u, edge_u = _crossings(ua, ub)
+    t_v, edge_v = _crossings(va, vb)
+
+    n = len(ua)
+    edge = np.concatenate([np.arange(n), np.arange(n), edge_u, edge_v])
+    t = np.concatenate([np.zeros(n), np.ones(n), t_u, t_v])
+    order = np.lexsort((t, edge))
+    edge, t = edge[order], t[order]
+
+    ##Consecutive parameters of the same edge delimit a piece within a single cell
+    same_edge = edge[:-1] == edge[1:]
+    e, t1, t2 = edge[:-1][same_edge], t[:-1][same_edge], t[1:][same_edge]
+
+    du, dv = ub[e] - ua[e], vb[e] - va[e]
+    return(geom_idx[e], ua[e] + t1 * du, va[e] + t1 * dv, ua[e] + t2 * du, va[e] + t2 * dv)
+
+def _crossings(a, b):
+
+    lo = np.floor(np.minimum(a, b)).astype(np.int64) + 1
+    hi = np.ceil(np.maximum(a, b)).astype(np.int64) - 1
+    n = np.maximum(hi - lo + 1, 0)
+
+    edge = np.repeat(np.arange(len(a)), n)
+    k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    line = lo[edge] + k
+
+    return((line - a[edge]) / (b[edge] - a[edge]), edge)
+
+def _accumulate_columns(geom_idx, col, row, own, below, nx):
+
+    ##Sum the pieces per cell, sorted by geometry, column and row
+    group = geom_idx.astype(np.int64) * nx + col
+    r_min = row.min() if len(row) > 0 else 0
+    n_rows = (row.max() - r_min + 1) if len(row) > 0 else 1
+    cell = group * n_rows + (row - r_min)
+
+    cell_u, inv = np.unique(cell, return_inverse = True)
+    own = np.bincount(inv, weights = own, minlength = len(cell_u))
+    below = np.bincount(inv, weights = below, minlength = len(cell_u))
+    group_u, row_u = np.divmod(cell_u, n_rows)
+
+    ##Contribution of all rows above a cell within its column
+    starts = np.flatnonzero(np.r_[True, group_u[1:] != group_u[:-1]])
+    totals = np.add.reduceat(below, starts) if len(below) > 0 else below
+    group_pos = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(group_u)]))
+    cs = np.cumsum(below)
+    cs_before = np.r_[0, cs][starts][group_pos]
+    above = totals[group_pos] - (cs - cs_before)
+
+    ##Enumerate all rows between the lowest and highest piece of each column
+    first, last = row_u[starts], row_u[np.r_[starts[1:], len(row_u)] - 1]
+    n_enum = last - first + 1
+    e_group = np.repeat(group_u[starts], n_enum)
+    e_row = np.repeat(first, n_enum) + np.arange(n_enum.sum()) - np.repeat(np.cumsum(n_enum) - n_enum, n_enum)
+
+    ##Last piece row at or below each enumerated row
+    pos = np.searchsorted(cell_u, e_group * n_rows + e_row, side = 'right') - 1
+    cov = above[pos] + np.where(row_u[pos] == e_row, own[pos], 0)
+
+    e_geom, e_col = np.divmod(e_group, nx)
+
+    return(e_geom, e_row + r_min, e_col, cov)
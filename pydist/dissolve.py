@@ -0,0 +1,161 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+import warnings
+import logging
+
+from .grid import grid_cells
+
+logger = logging.getLogger(__name__)
+
+def dissolve_by_key(geometries, zones, key, n_workers = 1, batch_size = 50000, grid_size = None):
+    """
+    Union geometries within zones and dissolve the result by a zone key.
+
+    Equivalent to intersecting the union of all geometries with the zones and dissolving the
+    intersection by key (e.g. gpd.overlay(union, zones).dissolve(by = key)), but without ever
+    creating the union of all geometries. The geometries intersecting each zone are found with
+    an STRtree, and each key is unioned and clipped on its own. Keys are sorted along a Hilbert
+    curve and split into batches of about batch_size input geometries, which are processed in a
+    process pool if n_workers > 1.
+
+    Only polygonal parts of the intersections are kept, as with keep_geom_type=True in
+    gpd.overlay.
+
+    Parameters:
+      geometries : geopandas.GeoSeries, GeoDataFrame or array of shapely geometries
+          Polygons to union, e.g. vineyards from several sources. Overlaps are allowed.
+      zones : geopandas.GeoDataFrame
+          Zones to clip with, e.g. LAUs or PDOs. Several zones can share the same key.
+      key : str
+          Column of zones to dissolve by.
+      n_workers : int, default 1
+          Number of worker processes.
+      batch_size : int, default 50000
+          Approximate number of input geometries per task.
+      grid_size : float, optional
+          Precision grid passed to the GEOS union and intersection.
+
+    Returns:
+      dissolved : geopandas.GeoDataFrame
+          One row per key with intersecting geometries, with columns key and geometry in the
+          crs of zones.
+    """
+
+    if isinstance(geometries, (gpd.GeoSeries, gpd.GeoDataFrame)):
+        if geometries.crs is not None and zones.crs is not None and geometries.crs != zones.crs:
+            warnings.warn(f'CRS mismatch between geometries ({geometries.crs}) and zones ({zones.crs}).')
+        geometries = geometries.geometry.values
+    geometries = np.asarray(geometries)
+    zone_geoms = np.asarray(zones.geometry.values)
+    codes, uniques = pd.factorize(zones[key])
+
+    ##Candidate geometries of every zone, merged per key
+    tree = shapely.STRtree(geometries)
+    zone_idx, geom_idx = tree.query(zone_geoms, predicate = 'intersects')
+    valid = codes[zone_idx] >= 0
+    zone_idx, geom_idx = zone_idx[valid], geom_idx[valid]
+    pairs = np.unique(np.stack([codes[zone_idx], geom_idx], axis = 1), axis = 0)
+    pair_code, pair_geom = pairs[:, 0], pairs[:, 1]
+
+    ##Keep spatially close keys in the same batch
+    hilbert = pd.Series(zones.geometry.hilbert_distance().values).groupby(codes).min()
+    order = hilbert.loc[np.unique(pair_code)].sort_values(kind = 'stable').index.values
+    n_geoms = np.bincount(pair_code, minlength = len(uniques))[order]
+    batch = np.cumsum(n_geoms) // max(1, batch_size)
+
+    ##Positions of the zones and geometries of each key
+    zone_order = np.argsort(codes, kind = 'stable')
+    zone_bounds = np.searchsorted(codes[zone_order], np.arange(len(uniques) + 1))
+    pair_bounds = np.searchsorted(pair_code, np.arange(len(uniques) + 1))
+
+    tasks = []
+    for b in np.unique(batch):
+        batch_codes = order[batch == b]
+        tasks.append((
+            batch_codes,
+            [zone_geoms[zone_order[zone_bounds[c]:zone_bounds[c + 1]]] for c in batch_codes],
+            [geometries[pair_geom[pair_bounds[c]:pair_bounds[c + 1]]] for c in batch_codes],
+            grid_size,
+        ))
+
+    logger.info(f'Dissolving {len(pair_geom)} geometry/{key} pairs of {len(order)} keys in {len(tasks)} batches with {n_workers} worker(s)')
+    if n_workers > 1:
+        with ProcessPoolExecutor(n_workers) as pool:
+            results = list(pool.map(_dissolve_batch, tasks))
+    else:
+        results = [_dissolve_batch(task) for task in tasks]
+
+    result_codes = np.concatenate([c for c, _ in results]) if len(results) > 0 else np.array([], dtype = int)
+    result_geoms = np.concatenate([g for _, g in results]) if len(results) > 0 else np.array([], dtype = object)
+    keep = ~shapely.is_empty(result_geoms)
+    sort = np.argsort(result_codes[keep], kind = 'stable')
+
+    dissolved = gpd.GeoDataFrame(
+        {key: uniques[result_codes[keep][sort]]},
+        geometry = result_geoms[keep][sort],
+        crs = zones.crs,
+    )
+
+    return(dissolved)
+
+def partition_union(geometries, cell_size, n_workers = 1, batch_size = 50000, grid_size = None, crs = None):
+    """
+    Union geometries on a regular grid of partitions.
+
+    The union is split into one piece per grid cell of size cell_size, so it never exists as a
+    single geometry. Pieces of neighbouring cells share their boundary and can be unioned or
+    dissolved further if needed.
+
+    Parameters:
+      geometries : geopandas.GeoSeries, GeoDataFrame or array of shapely geometries
+          Polygons to union.
+      cell_size : float
+          Size of the partitions in the units of the crs.
+      n_workers, batch_size, grid_size :
+          Same as in dissolve_by_key.
+      crs : optional
+          CRS of the geometries, taken from geometries if not given.
+
+    Returns:
+      pieces : geopandas.GeoDataFrame
+          Columns grid_id (flat index of the partition), row, col and geometry.
+    """
+
+    if crs is None and isinstance(geometries, (gpd.GeoSeries, gpd.GeoDataFrame)):
+        crs = geometries.crs
+    geometries = np.asarray(getattr(geometries, 'geometry', geometries))
+
+    minx, miny, maxx, maxy = shapely.total_bounds(geometries)
+    x = np.arange(minx + cell_size / 2, maxx + cell_size, cell_size)
+    y = np.arange(miny + cell_size / 2, maxy + cell_size, cell_size)
+    cells = grid_cells(x, y, geometries = geometries, crs = crs)
+
+    pieces = dissolve_by_key(geometries, cells, 'grid_id', n_workers = n_workers, batch_size = batch_size, grid_size = grid_size)
+    pieces = pieces.merge(cells[['grid_id', 'row', 'col']], on = 'grid_id', how = 'left')
+
+    return(pieces[['grid_id', 'row', 'col', 'geometry']])
+
+def _dissolve_batch(task):
+
+    codes, zone_geoms, geoms, grid_size = task
+
+    out = np.empty(len(codes), dtype = object)
+    for i, (zone, parts) in enumerate(zip(zone_geoms, geoms)):
+        zone = zone[0] if len(zone) == 1 else shapely.union_all(zone, grid_size = grid_size)
+        out[i] = _polygonal(shapely.intersection(shapely.union_all(parts, grid_size = grid_size), zone, grid_size = grid_size))
+
+    return(np.asarray(codes), out)
+
+def _polygonal(geom):
+
+    ##Drop points and lines on zone boundaries
+    parts = shapely.get_parts(shapely.get_parts(geom))
+    parts = parts[shapely.get_type_id(parts) == 3]
+    if len(parts) == 0:
+        return(shapely.Polygon())
+    elif len(parts) == 1:
+        return(parts[0])
+    return(shapely.multipolygons(parts))
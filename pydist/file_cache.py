@@ -0,0 +1,216 @@
+import hashlib
+from collections import Counter
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+from pathlib import Path
+import logging
+
+logger = logging.getLogger(__name__)
+
+##Caches shared within the process, by resolved root directory
+_shared_caches = dict()
+_shared_lock = threading.Lock()
+
+def shared_cache(root, quota = None):
+    """
+    Return the FileCache of root shared by all callers in this process, creating it if needed.
+
+    Pins only protect files from eviction by the same instance, so concurrent batches (e.g.
+    prefetched year chunks) must use the shared instance. The quota of the latest call applies.
+    """
+
+    key = Path(root).resolve()
+    with _shared_lock:
+        if key not in _shared_caches:
+            _shared_caches[key] = FileCache(root, quota = quota)
+        cache = _shared_caches[key]
+        cache.quota = quota
+
+    return(cache)
+
+class FileCache:
+    """
+    Persistent, content-addressed cache for downloaded files.
+
+    Files are downloaded to a partial file, resumed with HTTP range requests if interrupted and
+    atomically moved to objects/<sha256>/<filename> once complete. A small JSON index maps each
+    url to the checksum, size and last access time of its file. If a quota is set, the least
+    recently used files are evicted once the cache exceeds it. Files of urls pinned with pin()
+    or pinned() are never evicted, so a batch larger than the quota stays complete while it is
+    used. Pins are counted, so overlapping batches can pin the same url.
+
+    The cache is thread-safe, but not safe for concurrent use by several processes.
+
+    Parameters:
+      root : str or Path
+          Directory of the cache.
+      quota : int, optional
+          Maximum size of the cache in bytes. No eviction if None.
+    """
+
+    def __init__(self, root, quota = None):
+
+        self.root = Path(root)
+        self.quota = quota
+        self.objects = Path(self.root, 'objects')
+        self.partial = Path(self.root, 'partial')
+        self.index_file = Path(self.root, 'index.json')
+
+        self.objects.mkdir(exist_ok = True, parents = True)
+        self.partial.mkdir(exist_ok = True, parents = True)
+
+        self._lock = threading.Lock()
+        self._index = self._read_index()
+        self._pins = Counter()
+        self._dirty = False
+
+    def get(self, url):
+        """Return the local path of url if it is cached and intact, otherwise None."""
+
+        with self._lock:
+            entry = self._index.get(url)
+            if entry is None:
+                return(None)
+
+            fname = Path(self.root, entry['path'])
+            if (not fname.is_file()) or (fname.stat().st_size != entry['size']):
+                logger.warning(f'Cached file for {url} is missing or corrupt. Removing it from the index.')
+                del self._index[url]
+                self._write_index()
+                return(None)
+
+            ##Access times are written with the next change of the index or by flush()
+            entry['last_access'] = time.time()
+            self._dirty = True
+
+        return(fname)
+
+    def flush(self):
+        """Write the index if access times changed since it was last written."""
+        with self._lock:
+            if self._dirty:
+                self._write_index()
+
+    def pin(self, urls):
+        """
+        Protect the files of urls from eviction until the returned function is called.
+
+        Returns:
+          release : callable
+              Removes the pins. Calling it more than once has no effect.
+        """
+
+        urls = list(dict.fromkeys(urls))
+        with self._lock:
+            self._pins.update(urls)
+
+        released = threading.Event()
+        def release():
+            with self._lock:
+                if released.is_set():
+                    return
+                released.set()
+                self._pins.subtract(urls)
+                self._pins = +self._pins
+
+        return(release)
+
+    @contextmanager
+    def pinned(self, urls):
+        """Context manager protecting the files of urls from eviction while it is active."""
+
+        release = self.pin(urls)
+        try:
+            yield self
+        finally:
+            release()
+
+    def part_path(self, url):
+        """Path of the partial file used while downloading url."""
+        return(Path(self.partial, f"{hashlib.sha256(url.encode()).hexdigest()}.part"))
+
+    def validator_path(self, url):
+        """Path of the file storing the ETag or Last-Modified header of the partial file of url."""
+        return(self.part_path(url).with_suffix('.validator'))
+
+    def commit(self, url, part):
+        """Move a completely downloaded partial file into the cache and return its final path."""
+
+        part = Path(part)
+        sha256 = _file_checksum(part)
+        size = part.stat().st_size
+
+        fname = Path(self.objects, sha256, url.split('/')[-1])
+        fname.parent.mkdir(exist_ok = True)
+        os.replace(part, fname)
+        self.validator_path(url).unlink(missing_ok = True)
+
+        with self._lock:
+            self._index[url] = {
+                'path': fname.relative_to(self.root).as_posix(),
+                'sha256': sha256,
+                'size': size,
+                'last_access': time.time(),
+            }
+            self._evict(keep = [url])
+            self._write_index()
+
+        return(fname)
+
+    def size(self):
+        """Total size of all cached files in bytes."""
+        with self._lock:
+            return(sum(i['size'] for i in self._index.values()))
+
+    def evict(self):
+        """Evict least recently used files until the cache is within its quota."""
+        with self._lock:
+            self._evict()
+            self._write_index()
+
+    def _evict(self, keep = ()):
+
+        if self.quota is None:
+            return
+
+        keep = set(self._pins).union(keep)
+        total = sum(i['size'] for i in self._index.values())
+        for url, entry in sorted(self._index.items(), key = lambda i: i[1]['last_access']):
+            if total <= self.quota:
+                break
+            if url in keep:
+                continue
+
+            logger.debug(f'Evicting {url} from cache')
+            del self._index[url]
+            total -= entry['size']
+
+            ##Identical content may be referenced by several urls
+            if not any(i['path'] == entry['path'] for i in self._index.values()):
+                Path(self.root, entry['path']).unlink(missing_ok = True)
+
+    def _read_index(self):
+
+        if not self.index_file.is_file():
+            return(dict())
+        with open(self.index_file) as f:
+            return(json.load(f))
+
+    def _write_index(self):
+
+        tmp = self.index_file.with_suffix('.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(tmp, self.index_file)
+        self._dirty = False
+
+def _file_checksum(fname, chunk_size = 2**20):
+
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return(h.hexdigest())
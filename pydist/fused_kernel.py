@@ -0,0 +1,159 @@
+import numpy as np
+import xarray as xr
+from functools import lru_cache
+import logging
+
+logger = logging.getLogger(__name__)
+
+INDICES = ['gdd', 'gdd_opt', 'pr_sum', 'pr_max', 'days_max', 'days_min', 'tasmin', 'tasmax']
+
+def calc_veraison_indices(ds, Fcrit, veraison_min = 214, veraison_max = 275, window = 45, parallel = True):
+    """
+    Calculate the veraison date and the climatic window indices in one compiled pass.
+
+    For each pixel and year the daily series is traversed once: the clipped temperature sum is
+    accumulated from doy 60, the day where Fcrit is reached is stored and, if it falls within
+    veraison_min and veraison_max, the indices are accumulated over the following window days.
+    Requires numba. calc_phen_date and get_climatic_window remain the reference implementation.
+
+    Parameters:
+      ds : xarray.Dataset
+          Daily climate data with the variables tas, tasmax, tasmin and pr in °C and mm.
+      Fcrit : float
+          Critical temperature sum of the variety.
+      veraison_min, veraison_max : int
+          Veraison dates outside [veraison_min, veraison_max) are masked for the indices.
+      window : int
+          Number of days after veraison (including the veraison date) to consider.
+      parallel : bool, default True
+          Distribute the pixels of each block over all cores with numba.prange.
+
+    Returns:
+      ds_out : xarray.Dataset
+          Variable veraison with the unmasked day of year of veraison and the indices gdd,
+          gdd_opt, pr_sum, pr_max, days_max, days_min, tasmin and tasmax with a year dimension.
+    """
+
+    ##Check if necessary dims are present
+    if not 'time' in ds.dims:
+        raise ValueError('Time dimension not found in dataset.')
+
+    kernel = _compile_kernel(parallel)
+
+    ##apply_ufunc needs the core dimension in a single chunk, open_mfdataset creates one per file
+    ds = ds[['tas', 'tasmax', 'tasmin', 'pr']]
+    if len(ds.chunksizes.get('time', ())) > 1:
+        ds = ds.chunk({'time': -1})
+
+    years = np.unique(ds.time.dt.year.values)
+    doy = ds.time.dt.dayofyear.values.astype(np.int64)
+    year_bounds = np.searchsorted(ds.time.dt.year.values, np.append(years, years[-1] + 1), side = 'left')
+
+    def _run(tas, tasmax, tasmin, pr):
+        shp = tas.shape[:-1]
+        n_time = tas.shape[-1]
+        out = kernel(
+            *[np.ascontiguousarray(i.reshape(-1, n_time), dtype = np.float64) for i in (tas, tasmax, tasmin, pr)],
+            doy, year_bounds, float(Fcrit), veraison_min, veraison_max, window
+        )
+        return(tuple(out[..., i].reshape(shp + (len(years), )) for i in range(out.shape[-1])))
+
+    logger.debug('Running fused veraison kernel')
+    out = xr.apply_ufunc(
+        _run,
+        ds.tas, ds.tasmax, ds.tasmin, ds.pr,
+        input_core_dims=[['time']] * 4,
+        output_core_dims=[['year']] * (len(INDICES) + 1),
+        dask='parallelized',
+        output_dtypes=[np.float64] * (len(INDICES) + 1),
+        dask_gufunc_kwargs={'output_sizes': {'year': len(years)}},
+    )
+
+    ds_out = xr.Dataset(dict(zip(['veraison'] + INDICES, out))).assign_coords({'year': years})
+
+    return(ds_out.transpose('year', ...))
+
+@lru_cache(maxsize = None)
+def _compile_kernel(parallel):
+
+    import numba
+
+    @numba.njit(parallel = parallel, nogil = True)
+    def _kernel(tas, tasmax, tasmin, pr, doy, year_bounds, Fcrit, veraison_min, veraison_max, window):
+
+        n_pix = tas.shape[0]
+        n_year = year_bounds.shape[0] - 1
+        out = np.full((n_pix, n_year, 9), np.nan)
+
+        for p in numba.prange(n_pix):
+            for y in range(n_year):
+                y_start, y_end = year_bounds[y], year_bounds[y + 1]
+
+                ##Accumulate clipped tas until Fcrit is reached
+                tas_sum = 0.0
+                t_cross = -1
+                for t in range(y_start, y_end):
+                    if doy[t] < 60:
+                        continue
+                    v = tas[p, t]
+                    if np.isnan(v):
+                        continue
+                    if v > 0:
+                        tas_sum += v
+                    if tas_sum >= Fcrit:
+                        t_cross = t
+                        break
+
+                if t_cross < 0:
+                    continue
+                out[p, y, 0] = doy[t_cross]
+
+                if (doy[t_cross] < veraison_min) or (doy[t_cross] >= veraison_max):
+                    continue
+
+                ##Accumulate indices within the window after veraison
+                gdd = gdd_opt = pr_sum = tmin_sum = tmax_sum = 0.0
+                pr_max = np.nan
+                days_max = days_min = 0
+                n_tas = n_pr = n_tmin = n_tmax = 0
+                for t in range(t_cross, min(t_cross + window, y_end)):
+                    v = tas[p, t]
+                    if not np.isnan(v):
+                        n_tas += 1
+                        gdd += max(v - 10.0, 0.0)
+                        gdd_opt += max(v - 25.0, 0.0)
+                    v = pr[p, t]
+                    if not np.isnan(v):
+                        n_pr += 1
+                        pr_sum += v
+                        if np.isnan(pr_max) or (v > pr_max):
+                            pr_max = v
+                    v = tasmax[p, t]
+                    if not np.isnan(v):
+                        n_tmax += 1
+                        tmax_sum += v
+                        if v > 40.0:
+                            days_max += 1
+                    v = tasmin[p, t]
+                    if not np.isnan(v):
+                        n_tmin += 1
+                        tmin_sum += v
+                        if v < 10.0:
+                            days_min += 1
+
+                if n_tas > 0:
+                    out[p, y, 1] = gdd
+                    out[p, y, 2] = gdd_opt
+                if n_pr > 0:
+                    out[p, y, 3] = pr_sum
+                out[p, y, 4] = pr_max
+                out[p, y, 5] = days_max
+                out[p, y, 6] = days_min
+                if n_tmin > 0:
+                    out[p, y, 7] = tmin_sum / n_tmin
+                if n_tmax > 0:
+                    out[p, y, 8] = tmax_sum / n_tmax
+
+        return(out)
+
+    return(_kernel)
@@ -1,15 +1,26 @@
 import xarray as xr
 import numpy as np
 from itertools import product
-import requests
-import shutil
-from pathlib import Path
 from tempfile import TemporaryDirectory
-from multiprocessing.pool import ThreadPool
-from functools import partial
+from pathlib import Path
 import time
+import sys
 import logging
 
+##Allow running this module as a script (python pydist/get_climate.py). The directory of the
+##script is replaced by the repository root, as modules like pydist/sparse.py would shadow packages
+if __name__ == '__main__' and not __package__:
+    sys.path[0] = str(Path(__file__).resolve().parents[1])
+    import pydist
+    __package__ = 'pydist'
+
+from .file_cache import shared_cache
+from .async_download import download_files, TransferStats
+from .remote import open_remote_dataset
+from .ingest import open_store, stored_years
+from .instrument import stage, add_bytes
+from . import config
+
 logger = logging.getLogger(__name__)
 logging.getLogger('urllib3').setLevel(logging.WARNING)
 logging.getLogger('positron_ipykernel').setLevel(logging.WARNING)
@@ -27,7 +38,22 @@ logging.getLogger('positron_ipykernel').setLevel(logging.WARNING)
 def get_climate():
     pass
 
-def load_chelsa_w5e5(variables, resolution, years, months = np.arange(3, 13), n_threads = 1, download_dir = TemporaryDirectory(), **kwargs):
+def load_chelsa_w5e5(variables, resolution, years, months = np.arange(3, 13), n_threads = 1, download_dir = None, cache_quota = None, remote = False, store = None, return_release = False, **kwargs):
+    """
+    Load CHELSA-W5E5 daily data for the given variables, years and months.
+
+    Files are read from an ingested Zarr store if it contains all years, read remotely for the
+    aoi only if remote is True, or downloaded into the persistent download cache. Downloaded
+    files are pinned in the cache, so other batches cannot evict them. The files are opened
+    lazily, so pass return_release=True to keep them pinned until the data has been read.
+
+    Parameters:
+      return_release : bool, default False
+          If True, (ds, release) is returned and the files stay pinned until release() is
+          called. Otherwise the pins are removed as soon as the files are opened.
+      **kwargs
+          Passed to open_climate_dataset, e.g. aoi or use_dask.
+    """
 
     url_template = "https://files.isimip.org/ISIMIP3a/InputData/climate/atmosphere/obsclim/global/daily/historical/CHELSA-W5E5/chelsa-w5e5_obsclim_{variable}_{resolution}_global_daily_{timestamp}.nc" ##mode=bytes
     
@@ -42,6 +68,15 @@ def load_chelsa_w5e5(variables, resolution, years, months = np.arange(3, 13), n_
     if (min(years) < 1979) or (max(years) > 2016):
         raise ValueError(f'years must fall within 1979-2016. Values outside this range are not supported. Got {", ".join(years)}')
 
+    ##Read directly from an ingested Zarr store if it contains all years
+    if (store is not None) and all(i in stored_years(store) for i in years):
+        logger.info(f'Reading climate data from {store}')
+        with stage('open'):
+            ds = open_store(store, variables = variables, years = years, months = months, aoi = kwargs.get('aoi'))
+            if not kwargs.get('use_dask', False):
+                ds = ds.load()
+        return((ds, _no_release) if return_release else ds)
+
     ##Generate list of urls
     urls = []
     for var in variables:
@@ -52,65 +87,70 @@ def load_chelsa_w5e5(variables, resolution, years, months = np.arange(3, 13), n_
         )
 
     ##Load data
-    dwnloads = _multithreaded_download(urls, n_threads, download_dir = download_dir)
-    dwnloads.sort()
-    ds = open_climate_dataset(dwnloads, **kwargs)
+    if download_dir is None:
+        download_dir = config.climate_cache
+    if isinstance(download_dir, TemporaryDirectory):
+        download_dir = download_dir.name
+
+    release = _no_release
+    if remote:
+        ##Only fetch the chunks of each file that intersect the aoi
+        with stage('download'):
+            ##With dask the aoi subset stays lazy, so the files are closed on release instead
+            chunks = kwargs.get('chunks', {"time": -1, "lat": 'auto', 'lon': 'auto'}) if kwargs.get('use_dask') else None
+            ds = open_remote_dataset(urls, aoi = kwargs.get('aoi', (-180, -90, 180, 90)), cache_dir = Path(download_dir, 'blocks'), n_threads = n_threads, chunks = chunks)
+            if return_release and (chunks is not None):
+                release = ds.close
+    else:
+        ##One cache per directory, so the pins of all batches (e.g. prefetched ones) are respected
+        cache = shared_cache(download_dir, quota = cache_quota)
+        release = cache.pin(urls)
+        try:
+            with stage('download'):
+                dwnloads = _multithreaded_download(urls, n_threads, cache = cache)
+            dwnloads.sort()
+            with stage('open'):
+                ##Size of the opened files, an upper bound of the bytes read for the aoi
+                add_bytes('read', sum(Path(i).stat().st_size for i in dwnloads))
+                ds = open_climate_dataset(dwnloads, **kwargs)
+        except BaseException:
+            release()
+            raise
 
     for var in ds.keys():
         if 'tas' in var:
             logger.debug(f'Transforming data units for var {var}')
             ds[var] = ds[var] - 273.5
     ds = ds.rio.write_crs(4326)
-    
+
+    if return_release:
+        return(ds, release)
+    release()
     return(ds)
 
-def load_cordex():
+def _no_release():
     pass
 
-##https://stackoverflow.com/questions/16694907/download-large-file-in-python-with-requests
-def _download_files(url, download_dir, attempts = 3, overwrite = False):
-
-    if isinstance(download_dir, TemporaryDirectory):
-        local_filename = Path(download_dir.name, url.split('/')[-1])
-    else:
-        local_filename = Path(download_dir, url.split('/')[-1])
-
-    if local_filename.is_file() and (not overwrite):
-        return(local_filename, None)
-
-    # logger.debug(f"Downloading {url} to {local_filename}")
-
-    for attempt in range(attempts):  # Retry up to n times
-
-        try:
-            with requests.get(url, stream=True, timeout=30) as r:
-                r.raise_for_status()  # Raise an error for failed requests
-                with open(local_filename, 'wb') as f:
-                    shutil.copyfileobj(r.raw, f)
-            return (local_filename, None)  # Success, return early
-
-        except requests.exceptions.RequestException as e:
-            logger.debug(f"Retry {attempt + 1} for {url}: {e}")
-            time.sleep(2 ** (attempt+1))
-    return (local_filename, f"Failed after {attempts} retries")  # Fail after retries
+def load_cordex():
+    pass
 
-def _multithreaded_download(urls, n_threads, download_dir):
+def _multithreaded_download(urls, n_threads, cache):
 
-    logger.info(f'Download of {len(urls)} files started using {n_threads} threads')
+    logger.info(f'Download of {len(urls)} files started using up to {n_threads} connections')
     start = time.time()
 
-    dfunc = partial(_download_files, download_dir = download_dir)
-    results = ThreadPool(n_threads).imap_unordered(dfunc, urls)
+    stats = TransferStats()
+    results = download_files(urls, cache, max_per_host = n_threads, progress = stats)
 
     local_files = []
     for fnam, error in results:
         if error is None:
-            logger.info(f"{fnam} fetched after {time.time() - start:.2f}s")
             local_files.append(fnam)
         else:
             logger.error(f"Error fetching {fnam}: {error}")
 
-    logger.info(f"Downloads finished. Elapsed Time: {time.time() - start:.2f}s" )
+    add_bytes('downloaded', stats.bytes)
+    logger.info(f"Downloads finished. Downloaded {stats.bytes / 1e6:.1f} MB at {stats.bandwidth() / 1e6:.2f} MB/s. Elapsed Time: {time.time() - start:.2f}s" )
     return(local_files)
 
 def open_climate_dataset(
@@ -175,8 +215,8 @@ if __name__ == "__main__":
     logger = logging.getLogger(__name__)
 
     import argparse
-    from config import aois
-    from cluster import init_cluster
+    from .config import aois
+    from .cluster import init_cluster
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--variables', default = ['tas'], nargs='+', help = 'Variables to download. Choose one or more of tas, tasmax, tasmin and pr')
@@ -184,11 +224,13 @@ if __name__ == "__main__":
     parser.add_argument('-ys', '--year_start', default = 2000, type = int, help = 'Starting year of climate grids.')
     parser.add_argument('-ye', '--year_end', default = 2001, type = int, help = 'Last year of climate grids. Must be greater than year_start.')
     parser.add_argument('-yc', '--year_chunks', default = 1, type = int, help = 'Number of years that should be processed at once. Depends on RAM of host. Default is to process each year individually.')
-    parser.add_argument('-tr', '--threads', default = 1, type = int, help = 'Number of threads to use for downloading files')
-    parser.add_argument('-d', '--ddir', default = TemporaryDirectory(), help = 'Directory to store downloaded files')
+    parser.add_argument('-tr', '--threads', default = 1, type = int, help = 'Number of simultaneous connections to use for downloading files')
+    parser.add_argument('-d', '--ddir', default = None, help = 'Directory of the persistent download cache. Defaults to the user cache directory.')
+    parser.add_argument('-cq', '--cache_quota', default = None, type = float, help = 'Maximum size of the download cache in GB. Least recently used files are evicted first.')
     parser.add_argument('-da', '--use_dask', action = 'store_true', help = 'Use dask for opening .nc files')
     parser.add_argument('-ic', '--init_slurm', action = 'store_true', help = 'Initialize a SLURM-based dask cluster')
     parser.add_argument('-a', '--aoi', default = 'europe', help = 'Name of area of interest for analysis.')
+    parser.add_argument('-rm', '--remote', action = 'store_true', help = 'Read only the aoi subset of the remote files using HTTP range requests instead of downloading global files')
     parser.add_argument('-j', '--n_jobs', default = 1, type = int, help = 'Number of jobs to launch by dask scheduler')
 
     args = parser.parse_args()
@@ -205,6 +247,8 @@ if __name__ == "__main__":
         aoi=(minx, miny, maxx, maxy),
         n_threads=args.threads,
         download_dir=args.ddir,
+        cache_quota=None if args.cache_quota is None else int(args.cache_quota * 1e9),
+        remote=args.remote,
         use_dask=args.use_dask
     )
 
@@ -1,5 +1,6 @@
 import logging
 import numpy as np
+import pandas as pd
 import xarray as xr
 import matplotlib.pyplot as plt
 import datetime
@@ -67,6 +68,103 @@ def calc_phen_date(tas, Fcrit):
 
     return(phen_date)
 
+def calc_phen_dates(tas, Fcrits, variety_dim = 'variety'):
+    """
+    Calculate the day of year at which Fcrit is reached for several varieties at once.
+
+    The clipped temperature sum from doy 60 is accumulated only once per year and the
+    crossing day of every Fcrit is found with a single sorted search along time.
+
+    Parameters:
+      tas : xarray.DataArray
+          Daily mean temperature in °C with a time dimension.
+      Fcrits : dict, pandas.Series or sequence
+          Critical temperature sums. If a mapping or Series is given, its keys are used
+          as coordinate of the variety dimension.
+      variety_dim : str, default 'variety'
+          Name of the new dimension holding the varieties.
+
+    Returns:
+      phen_doy : xarray.DataArray
+          Day of year when Fcrit is reached with dimensions (variety, year, ...). Pixels
+          that do not reach Fcrit within a year are NaN.
+    """
+
+    ##Check if necessary dims are present
+    if not 'time' in tas.dims:
+        raise ValueError('Time dimension not found in dataset.')
+
+    if hasattr(Fcrits, 'keys'):
+        varieties = list(Fcrits.keys())
+        Fcrits = [Fcrits[i] for i in varieties]
+    else:
+        varieties = np.arange(len(Fcrits))
+    Fcrits = np.asarray(Fcrits, dtype = np.float64)
+
+    logger.debug('Calculating veraison dates for %s varieties', len(Fcrits))
+    tas_sel = tas.sel(time=(tas.time.dt.dayofyear >= 60)).clip(min=0)
+
+    phen_doy = tas_sel.groupby('time.year').map(
+        lambda c: xr.apply_ufunc(
+            _first_crossing_doy,
+            _single_time_chunk(c),
+            input_core_dims=[['time']],
+            output_core_dims=[[variety_dim]],
+            kwargs={'thresholds': Fcrits, 'doy': c.time.dt.dayofyear.values},
+            dask='parallelized',
+            output_dtypes=[np.float64],
+            dask_gufunc_kwargs={'output_sizes': {variety_dim: len(Fcrits)}},
+        )
+    )
+    phen_doy = phen_doy.assign_coords({variety_dim: varieties})
+
+    return(phen_doy.transpose(variety_dim, 'year', ...))
+
+def _single_time_chunk(x):
+
+    ##apply_ufunc needs the core dimension in a single chunk, open_mfdataset creates one per file
+    if len(x.chunksizes.get('time', ())) > 1:
+        return(x.chunk({'time': -1}))
+    return(x)
+
+def _first_crossing_doy(x, thresholds, doy):
+
+    ##Flatten all dimensions except time
+    shp = x.shape[:-1]
+    x = x.reshape(-1, x.shape[-1])
+    n_pix, n_time = x.shape
+
+    valid = ~np.isnan(x).all(axis = -1)
+    tas_sum = np.nancumsum(x, axis = -1, dtype = np.float64)
+
+    ##Shift each pixel by a constant offset so that the flattened cumsum is globally sorted
+    ##and all pixels can be searched with one call to np.searchsorted
+    step = max(np.nanmax(tas_sum, initial = 0), thresholds.max(initial = 0)) + 1
+    offset = np.arange(n_pix, dtype = np.float64)[:, None] * step
+    pos = np.searchsorted(
+        (tas_sum + offset).ravel(),
+        (thresholds[None, :] + offset).ravel(),
+        side = 'left'
+    ).reshape(n_pix, len(thresholds)) - np.arange(n_pix)[:, None] * n_time
+
+    ##Positions equal to the length of the time axis mean that Fcrit was not reached
+    reached = (pos < n_time) & valid[:, None]
+    out = np.where(reached, doy[np.clip(pos, 0, n_time - 1)], np.nan)
+
+    return(out.reshape(shp + (len(thresholds), )))
+
+def doy_to_date(doy, year_dim = 'year'):
+    """
+    Convert an array of day of year values with a year dimension to datetime64.
+    """
+
+    year_start = xr.DataArray(
+        pd.to_datetime(doy[year_dim].values.astype(str), format = '%Y').values,
+        coords = {year_dim: doy[year_dim]},
+    )
+
+    return(year_start + (doy - 1).astype('timedelta64[D]'))
+
 def get_climatic_window(ds, phen_date, window):
 
     ##Check if necessary dims are present
@@ -102,3 +200,176 @@ def get_climatic_window(ds, phen_date, window):
     clim_window = clim_window.where(mask_veraison) 
 
     return(clim_window)
+
+##Cumulative sums required by each index of calc_window_indices, and the dtype of every sum.
+##Counts are stored as int32, which holds far more days than any supported time range.
+_PREFIX_TERMS = {
+    'gdd': ['gdd'],
+    'gdd_opt': ['gdd_opt'],
+    'pr_sum': ['pr_sum'],
+    'pr_max': [],
+    'days_max': ['days_max'],
+    'days_min': ['days_min'],
+    'tasmin': ['tasmin', 'tasmin_n'],
+    'tasmax': ['tasmax', 'tasmax_n'],
+}
+_PREFIX_DTYPES = {
+    'gdd': np.float64, 'gdd_opt': np.float64, 'pr_sum': np.float64, 'tasmin': np.float64, 'tasmax': np.float64,
+    'days_max': np.int32, 'days_min': np.int32, 'tasmin_n': np.int32, 'tasmax_n': np.int32,
+}
+
+def calc_prefix_sums(ds, indices = None, gdd_base = 10, gdd_opt = 25, tasmax_thresh = 40, tasmin_thresh = 10):
+    """
+    Calculate cumulative sums along time of all quantities required by calc_window_indices.
+
+    The sums are calculated one variable at a time, so no float64 copy of the whole dataset is
+    created. Sums of values are float64 and counts of days int32.
+
+    Parameters:
+      ds : xarray.Dataset
+          Daily climate data with the variables tas, tasmax, tasmin and pr in °C and mm.
+      indices : list, optional
+          Indices of calc_window_indices the sums are needed for. Defaults to all indices.
+      gdd_base, gdd_opt : float
+          Base temperatures for the growing degree days and the optimal growing degree days.
+      tasmax_thresh, tasmin_thresh : float
+          Thresholds for counting days with tasmax above and tasmin below.
+
+    Returns:
+      prefix : xarray.Dataset
+          Inclusive cumulative sums with the same time axis as ds. Missing values count as 0.
+    """
+
+    ##Check if necessary dims are present
+    if not 'time' in ds.dims:
+        raise ValueError('Time dimension not found in dataset.')
+
+    if indices is None:
+        indices = list(_PREFIX_TERMS)
+    terms = {
+        'gdd': lambda: (ds.tas - gdd_base).clip(min = 0),
+        'gdd_opt': lambda: (ds.tas - gdd_opt).clip(min = 0),
+        'pr_sum': lambda: ds.pr,
+        'days_max': lambda: ds.tasmax > tasmax_thresh,
+        'days_min': lambda: ds.tasmin < tasmin_thresh,
+        'tasmin': lambda: ds.tasmin,
+        'tasmax': lambda: ds.tasmax,
+        'tasmin_n': lambda: ds.tasmin.notnull(),
+        'tasmax_n': lambda: ds.tasmax.notnull(),
+    }
+
+    logger.debug('Calculating prefix sums')
+    prefix = xr.Dataset()
+    for name in dict.fromkeys(i for index in indices for i in _PREFIX_TERMS[index]):
+        prefix[name] = terms[name]().cumsum('time', skipna = True, dtype = _PREFIX_DTYPES[name])
+
+    return(prefix)
+
+def calc_window_indices(ds, phen_doy, window, prefix = None, indices = None, **kwargs):
+    """
+    Calculate climatic indices within a window of days after the veraison date.
+
+    Instead of extracting the window for each pixel, every sum is taken as the difference of
+    two gathers from the cumulative sums of calc_prefix_sums. Memory use is therefore
+    independent of the window length. Windows do not extend beyond the end of a year.
+
+    Parameters:
+      ds : xarray.Dataset
+          Daily climate data with the variables tas, tasmax, tasmin and pr.
+      phen_doy : xarray.DataArray
+          Day of year of veraison with a year dimension, as returned by calc_phen_dates.
+          Additional dimensions, e.g. variety, are kept.
+      window : int
+          Number of days after veraison (including the veraison date) to consider.
+      prefix : xarray.Dataset, optional
+          Precomputed output of calc_prefix_sums. Pass it when calculating indices for
+          several varieties on the same dataset.
+      indices : list, optional
+          Indices to calculate. Defaults to all indices.
+      **kwargs
+          Passed to calc_prefix_sums if prefix is None.
+
+    Returns:
+      clim_idx : xarray.Dataset
+          Indices gdd, gdd_opt, pr_sum, pr_max, days_max, days_min, tasmin and tasmax, or the
+          selected indices. Pixels without a veraison date are NaN.
+    """
+
+    ##Check if necessary dims are present
+    if not 'time' in ds.dims:
+        raise ValueError('Time dimension not found in dataset.')
+    if not 'year' in phen_doy.dims:
+        raise ValueError('Year dimension not found in phen_doy.')
+
+    if indices is None:
+        indices = list(_PREFIX_TERMS)
+    if prefix is None:
+        prefix = calc_prefix_sums(ds, indices = indices, **kwargs)
+
+    ##Encode dates as year * 1000 + doy to locate the window bounds with a sorted search
+    time_keys = (ds.time.dt.year * 1000 + ds.time.dt.dayofyear).values
+    phen_key = phen_doy['year'] * 1000 + phen_doy
+
+    def _gather(func, arr):
+        return(
+            xr.apply_ufunc(
+                func,
+                _single_time_chunk(arr),
+                phen_key,
+                input_core_dims=[['time'], []],
+                kwargs={'time_keys': time_keys, 'window': window},
+                dask='parallelized',
+                output_dtypes=[np.float64],
+            )
+        )
+
+    logger.debug('Gathering window sums')
+    sums = {var: _gather(_window_sum, prefix[var]) for var in dict.fromkeys(i for index in indices for i in _PREFIX_TERMS[index])}
+
+    clim_idx = xr.Dataset()
+    for index in indices:
+        if index == 'pr_max':
+            clim_idx[index] = _gather(_window_max, ds.pr)
+        elif index in ['tasmin', 'tasmax']:
+            clim_idx[index] = sums[index] / sums[f'{index}_n']
+        else:
+            clim_idx[index] = sums[index]
+
+    return(clim_idx)
+
+def _window_bounds(phen_key, time_keys, window):
+
+    valid = ~np.isnan(phen_key)
+    phen_key = np.where(valid, phen_key, 0)
+
+    start = np.searchsorted(time_keys, phen_key, side = 'left')
+    year_end = np.searchsorted(time_keys, (phen_key // 1000 + 1) * 1000, side = 'left')
+    stop = np.minimum(start + window, year_end)
+    valid &= start < stop
+
+    return(start, stop, valid)
+
+def _window_sum(cs, phen_key, time_keys, window):
+
+    start, stop, valid = _window_bounds(phen_key, time_keys, window)
+    cs = np.broadcast_to(cs, start.shape + cs.shape[-1:])
+
+    upper = np.take_along_axis(cs, np.maximum(stop - 1, 0)[..., None], axis = -1)[..., 0]
+    lower = np.take_along_axis(cs, np.maximum(start - 1, 0)[..., None], axis = -1)[..., 0]
+    lower = np.where(start > 0, lower, 0)
+
+    return(np.where(valid, upper - lower, np.nan))
+
+def _window_max(x, phen_key, time_keys, window):
+
+    start, stop, valid = _window_bounds(phen_key, time_keys, window)
+    x = np.broadcast_to(x, start.shape + x.shape[-1:])
+
+    ##Running maximum over the window, one gather per day
+    out = np.full(start.shape, np.nan)
+    for i in range(window):
+        pos = start + i
+        day = np.take_along_axis(x, np.minimum(pos, x.shape[-1] - 1)[..., None], axis = -1)[..., 0]
+        out = np.where(pos < stop, np.fmax(out, day), out)
+
+    return(np.where(valid, out, np.nan))
@@ -0,0 +1,93 @@
+import numpy as np
+import geopandas as gpd
+import shapely
+import logging
+
+logger = logging.getLogger(__name__)
+
+def grid_resolution(coords):
+    """Most frequent spacing of regularly spaced cell center coordinates."""
+
+    vals, counts = np.unique(np.diff(np.asarray(coords)), return_counts = True)
+    return(vals[np.argmax(counts)])
+
+def grid_cells(x, y, geometries = None, grid_id = None, crs = 4326):
+    """
+    Build polygons of the cells of a regular raster grid.
+
+    All cells are created with a single vectorised shapely.box call. If geometries are given,
+    only cells that intersect the bounding box of at least one geometry are created, so the
+    number of polygons scales with the area covered by the geometries instead of the grid size.
+
+    Parameters:
+      x, y : array-like
+          Cell center coordinates along x (e.g. lon) and y (e.g. lat). Can be ascending or
+          descending.
+      geometries : geopandas.GeoSeries or array of shapely geometries, optional
+          Geometries in the same crs as the grid. Multi-part geometries should be exploded
+          first, so the bounding boxes stay small.
+      grid_id : array-like, optional
+          Flat indices (row * len(x) + col) of the cells to create, in the given order. Takes
+          precedence over geometries.
+      crs : optional
+          CRS of the output.
+
+    Returns:
+      cells : geopandas.GeoDataFrame
+          Columns grid_id (row-major flat index y * len(x) + x), row, col and geometry.
+    """
+
+    x, y = np.asarray(x), np.asarray(y)
+    res_x, res_y = abs(grid_resolution(x)), abs(grid_resolution(y))
+
+    if grid_id is not None:
+        grid_id = np.asarray(grid_id, dtype = np.int64)
+    elif geometries is None:
+        grid_id = np.arange(len(y) * len(x))
+    else:
+        grid_id = _candidate_cells(x, y, res_x, res_y, shapely.bounds(np.asarray(geometries)))
+
+    row, col = np.divmod(grid_id, len(x))
+    geoms = shapely.box(
+        x[col] - res_x / 2, y[row] - res_y / 2,
+        x[col] + res_x / 2, y[row] + res_y / 2,
+    )
+    logger.debug(f'Created {len(grid_id)} of {len(y) * len(x)} grid cells')
+
+    return(gpd.GeoDataFrame({'grid_id': grid_id, 'row': row, 'col': col}, geometry = geoms, crs = crs))
+
+def _candidate_cells(x, y, res_x, res_y, bounds):
+
+    bounds = bounds[~np.isnan(bounds).any(axis = 1)]
+    c0, c1 = _index_range(x, res_x, bounds[:, 0], bounds[:, 2])
+    r0, r1 = _index_range(y, res_y, bounds[:, 1], bounds[:, 3])
+
+    ##Drop boxes outside the grid
+    valid = (c1 >= c0) & (r1 >= r0)
+    c0, c1, r0, r1 = c0[valid], c1[valid], r0[valid], r1[valid]
+
+    ##Enumerate the cells of all boxes at once: box i covers n_cols[i] * n_rows[i] cells
+    n_cols, n_rows = c1 - c0 + 1, r1 - r0 + 1
+    n_cells = n_cols * n_rows
+    box = np.repeat(np.arange(len(n_cells)), n_cells)
+    k = np.arange(n_cells.sum()) - np.repeat(np.cumsum(n_cells) - n_cells, n_cells)
+    rows = r0[box] + k // n_cols[box]
+    cols = c0[box] + k % n_cols[box]
+
+    return(np.unique(rows * len(x) + cols))
+
+def _index_range(coords, res, lower, upper):
+
+    ##Index of the first and last cell whose extent overlaps [lower, upper], counted from the lower end
+    n = len(coords)
+    start = min(coords[0], coords[-1]) - res / 2
+    i0 = np.floor((lower - start) / res).astype(np.int64)
+    i1 = (np.ceil((upper - start) / res) - 1).astype(np.int64)
+    outside = (i1 < 0) | (i0 > n - 1)
+    i0, i1 = np.clip(i0, 0, n - 1), np.clip(i1, 0, n - 1)
+
+    ##Flip for descending coordinates
+    if coords[0] > coords[-1]:
+        i0, i1 = n - 1 - i1, n - 1 - i0
+
+    return(i0, np.where(outside, i0 - 1, i1))
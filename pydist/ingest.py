@@ -0,0 +1,138 @@
+import xarray as xr
+import numpy as np
+from pathlib import Path
+import logging
+
+logger = logging.getLogger(__name__)
+
+def store_path(root, aoi, resolution):
+    """Path of the Zarr store for an aoi name and a resolution such as '30arcsec'."""
+    return(Path(root, f'chelsa-w5e5_{aoi}_{resolution}.zarr'))
+
+def stored_years(store):
+    """Years contained in a Zarr store. Empty if the store does not exist."""
+
+    if not Path(store).exists():
+        return([])
+    with xr.open_zarr(store, consolidated = True) as ds:
+        return(np.unique(ds.time.dt.year.values).tolist())
+
+def ingest_chelsa(store, variables, resolution, years, aoi, months = np.arange(3, 13), tile_size = 64, **kwargs):
+    """
+    Convert CHELSA-W5E5 files into an AOI-cropped, pixel-chunked Zarr store.
+
+    Each year is loaded with load_chelsa_w5e5, converted to float32 and appended along time.
+    Chunks span the full season along time and tile_size x tile_size pixels in space, so the
+    full time series of a pixel is read with few chunk reads. Years already in the store are
+    skipped and must therefore be ingested in increasing order.
+
+    Parameters:
+      store : str or Path
+          Path of the Zarr store, e.g. from store_path.
+      variables, resolution, years, months :
+          Passed to load_chelsa_w5e5.
+      aoi : tuple
+          A tuple (minx, miny, maxx, maxy) the data is cropped to.
+      tile_size : int, default 64
+          Size of the spatial chunks in pixels.
+      **kwargs
+          Passed to load_chelsa_w5e5, e.g. n_threads or download_dir.
+    """
+
+    from .get_climate import load_chelsa_w5e5
+
+    if isinstance(years, int):
+        years = [years]
+
+    done = stored_years(store)
+    for year in years:
+
+        if year in done:
+            logger.info(f'Year {year} already contained in {store}. Skipping.')
+            continue
+        if (len(done) > 0) and (year < max(done)):
+            raise ValueError(f'Years must be appended in increasing order. Got {year} but store already contains {max(done)}.')
+
+        logger.info(f'Ingesting year {year} into {store}')
+        ds, release = load_chelsa_w5e5(variables, resolution, [year], months = months, aoi = aoi, return_release = True, **kwargs)
+        ds = ds.drop_vars('spatial_ref', errors = 'ignore').astype(np.float32)
+        for var in ds.data_vars:
+            if 'tas' in var:
+                ds[var].attrs['units'] = 'degC'
+        ds.attrs['crs'] = 'EPSG:4326'
+
+        ds = ds.chunk({'time': -1, 'lat': tile_size, 'lon': tile_size})
+        if len(done) == 0:
+            ds.to_zarr(
+                store, mode = 'w', consolidated = True,
+                encoding = {'time': {'units': 'days since 1979-01-01', 'dtype': 'int32'}}
+            )
+        else:
+            ds.to_zarr(store, append_dim = 'time', consolidated = True)
+        release()
+
+        done.append(year)
+
+def open_store(store, variables = None, years = None, months = None, aoi = None):
+    """
+    Lazily open a Zarr store written by ingest_chelsa.
+
+    Parameters:
+      variables : list, optional
+          Variables to select.
+      years, months : list, optional
+          Years and months to select.
+      aoi : tuple, optional
+          A tuple (minx, miny, maxx, maxy) to further crop the data.
+
+    Returns:
+      ds : xarray.Dataset
+          Dask-backed dataset with temperatures in °C.
+    """
+
+    ds = xr.open_zarr(store, consolidated = True)
+
+    if variables is not None:
+        ds = ds[list(variables)]
+    if years is not None:
+        ds = ds.sel(time = ds.time.dt.year.isin(list(years)))
+    if months is not None:
+        ds = ds.sel(time = ds.time.dt.month.isin(list(months)))
+    if aoi is not None:
+        minx, miny, maxx, maxy = aoi
+        ds = ds.sel(lat=slice(miny, maxy), lon=slice(minx, maxx))
+
+    return(ds.rio.write_crs(4326))
+
+if __name__ == "__main__":
+
+    import logging.config
+    import argparse
+    from .config import aois
+
+    logging.config.fileConfig(".config/logging.conf", disable_existing_loggers=False)
+
+    parser = argparse.ArgumentParser(description = 'Ingest CHELSA-W5E5 files into an AOI-cropped Zarr store.')
+    parser.add_argument('root', help = 'Directory where the Zarr stores are written')
+    parser.add_argument('-v', '--variables', default = ['tas', 'tasmax', 'tasmin', 'pr'], nargs='+', help = 'Variables to ingest')
+    parser.add_argument('-a', '--aoi', default = 'europe', help = 'Name of area of interest.')
+    parser.add_argument('-r', '--resolution', default = 1800, type = int, help = 'Resolution of climate grids in arcseconds.')
+    parser.add_argument('-ys', '--year_start', default = 2000, type = int, help = 'Starting year of climate grids.')
+    parser.add_argument('-ye', '--year_end', default = 2001, type = int, help = 'Last year of climate grids.')
+    parser.add_argument('-t', '--tile_size', default = 64, type = int, help = 'Size of the spatial chunks in pixels')
+    parser.add_argument('-tr', '--threads', default = 1, type = int, help = 'Number of simultaneous connections to use for downloading files')
+    parser.add_argument('-d', '--ddir', default = None, help = 'Directory of the persistent download cache. Defaults to the user cache directory.')
+
+    args = parser.parse_args()
+
+    resolution = f"{args.resolution}arcsec"
+    ingest_chelsa(
+        store_path(args.root, args.aoi, resolution),
+        args.variables,
+        resolution,
+        np.arange(args.year_start, args.year_end + 1),
+        aoi = tuple(aois[args.aoi]),
+        tile_size = args.tile_size,
+        n_threads = args.threads,
+        download_dir = args.ddir,
+    )
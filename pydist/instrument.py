@@ -0,0 +1,167 @@
+import json
+import os
+import platform
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+import logging
+
+logger = logging.getLogger(__name__)
+
+##Report that receives the records of stage(), set by RunReport.__enter__
+_active = None
+_local = threading.local()
+
+class RunReport:
+    """
+    Collect wall time, CPU time, memory and transferred bytes of named processing stages.
+
+    Stages are recorded with the module-level stage() context manager while the report is
+    active (inside a with block). Stages can be nested and inherit the labels of the enclosing
+    stage, e.g. the year chunk. Without an active report, stage() does nothing.
+
+    CPU time is the process time of all threads. Memory is the peak resident set size of the
+    process at the end of a stage, which only grows over the run, and the increase of that
+    peak during the stage. With trace_memory, the peak of memory allocated through Python
+    (including numpy) during the stage is recorded as well, at the cost of slower allocations.
+
+    Parameters:
+      meta : dict, optional
+          Information about the run written to the report, e.g. the script arguments.
+      trace_memory : bool, default False
+          Record the tracemalloc peak of each stage.
+    """
+
+    def __init__(self, meta = None, trace_memory = False):
+
+        self.meta = dict(meta or {})
+        self.trace_memory = trace_memory
+        self.records = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+
+        global _active
+        _active = self
+        self.start = time.time()
+        if self.trace_memory:
+            tracemalloc.start()
+        return(self)
+
+    def __exit__(self, *exc):
+
+        global _active
+        _active = None
+        self.end = time.time()
+        if self.trace_memory:
+            tracemalloc.stop()
+
+    def summary(self):
+        """Totals per stage name over all records."""
+
+        out = {}
+        for rec in self.records:
+            s = out.setdefault(rec['stage'], {'count': 0, 'wall': 0, 'cpu': 0, 'max_rss': 0, 'bytes': {}})
+            s['count'] += 1
+            s['wall'] += rec['wall']
+            s['cpu'] += rec['cpu']
+            s['max_rss'] = max(s['max_rss'], rec['max_rss'])
+            for k, v in rec['bytes'].items():
+                s['bytes'][k] = s['bytes'].get(k, 0) + v
+
+        return(out)
+
+    def write(self, filename):
+        """Write the meta data, all records and the summary as JSON."""
+
+        report = {
+            'meta': {
+                **self.meta,
+                'host': platform.node(),
+                'pid': os.getpid(),
+                'start': datetime.fromtimestamp(self.start).isoformat(),
+                'end': datetime.fromtimestamp(getattr(self, 'end', time.time())).isoformat(),
+            },
+            'summary': self.summary(),
+            'stages': self.records,
+        }
+
+        Path(filename).parent.mkdir(exist_ok = True, parents = True)
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent = 2, default = str)
+        logger.info(f'Wrote run report to {filename}')
+
+    def _add(self, rec):
+        with self._lock:
+            self.records.append(rec)
+
+@contextmanager
+def stage(name, **labels):
+    """
+    Record a processing stage in the active RunReport.
+
+    Parameters:
+      name : str
+          Name of the stage, e.g. download, align or phen.
+      **labels
+          Additional labels such as the year chunk or the variety.
+    """
+
+    report = _active
+    if report is None:
+        yield
+        return
+
+    stack = _stack()
+    parent = stack[-1] if len(stack) > 0 else None
+    rec = {
+        'stage': name,
+        'path': f"{parent['path']}/{name}" if parent is not None else name,
+        'labels': {**(parent['labels'] if parent is not None else {}), **labels},
+        'bytes': {},
+    }
+
+    if report.trace_memory and tracemalloc.is_tracing():
+        if parent is not None:
+            parent['_traced_peak'] = max(parent.get('_traced_peak', 0), tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+
+    rss_start = _max_rss()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    stack.append(rec)
+
+    try:
+        yield
+    finally:
+        stack.pop()
+        rec['wall'] = time.perf_counter() - wall_start
+        rec['cpu'] = time.process_time() - cpu_start
+        rec['max_rss'] = _max_rss()
+        rec['rss_increase'] = rec['max_rss'] - rss_start
+
+        if report.trace_memory and tracemalloc.is_tracing():
+            rec['traced_peak'] = max(rec.pop('_traced_peak', 0), tracemalloc.get_traced_memory()[1])
+            if parent is not None:
+                parent['_traced_peak'] = max(parent.get('_traced_peak', 0), rec['traced_peak'])
+
+        report._add(rec)
+        logger.debug(f"Stage {rec['path']} took {rec['wall']:.2f}s")
+
+def add_bytes(kind, n_bytes):
+    """Add transferred bytes, e.g. kind='downloaded', to all running stages of the current thread."""
+
+    for rec in _stack():
+        rec['bytes'][kind] = rec['bytes'].get(kind, 0) + int(n_bytes)
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return(_local.stack)
+
+def _max_rss():
+    ##ru_maxrss is given in kilobytes on Linux
+    return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
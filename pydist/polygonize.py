@@ -0,0 +1,300 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import rasterio
+from rasterio.features import shapes
+from rasterio.windows import Window
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import hashlib
+from pathlib import Path
+import logging
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+def plan_windows(width, height, tile_size):
+    """
+    Split a raster into square windows.
+
+    Returns:
+      tiles : pandas.DataFrame
+          Columns tile_row, tile_col, row_off, col_off, height and width with one row per window.
+    """
+
+    row_off, col_off = np.meshgrid(np.arange(0, height, tile_size), np.arange(0, width, tile_size), indexing = 'ij')
+    row_off, col_off = row_off.ravel(), col_off.ravel()
+
+    return(pd.DataFrame({
+        'tile_row': row_off // tile_size,
+        'tile_col': col_off // tile_size,
+        'row_off': row_off,
+        'col_off': col_off,
+        'height': np.minimum(tile_size, height - row_off),
+        'width': np.minimum(tile_size, width - col_off),
+    }))
+
+def tile_index(path, tile_size = 4096, value = None, n_workers = 1, cache_dir = None):
+    """
+    Find the windows of a raster that may contain a value, using the blocks of the file.
+
+    Blocks of a sparse GeoTIFF (e.g. written with SPARSE_OK=TRUE) that only hold nodata are not
+    written to the file and have no offset. Windows consisting of such blocks only are skipped
+    without reading any pixels. If value is given, windows are also skipped if none of their
+    blocks contains value according to block_classes, which also works for rasters with all
+    blocks written. Both checks are on whole blocks, so a window with the value is never
+    skipped. For other formats than GeoTIFF, only the check of value is used.
+
+    Parameters:
+      path : str or Path
+          Path of the raster.
+      tile_size : int, default 4096
+          Size of the windows in pixels.
+      value : int, optional
+          Pixel value of interest.
+      n_workers, cache_dir :
+          Passed to block_classes.
+
+    Returns:
+      tiles : pandas.DataFrame
+          Output of plan_windows with the additional boolean column candidate.
+    """
+
+    with rasterio.open(path) as src:
+        tiles = plan_windows(src.width, src.height, tile_size)
+        bh, bw = src.block_shapes[0]
+        n_by, n_bx = -(-src.height // bh), -(-src.width // bw)
+
+        ##Blocks with an offset in the file, indexed by block row and column
+        if src.driver == 'GTiff':
+            candidate = np.array([
+                [src.get_tag_item(f'BLOCK_OFFSET_{j}_{i}', 'TIFF', bidx = 1) is not None for j in range(n_bx)]
+                for i in range(n_by)
+            ]).reshape(n_by, n_bx)
+        else:
+            candidate = np.ones((n_by, n_bx), dtype = bool)
+
+    if value is not None:
+        classes, present = block_classes(path, n_workers = n_workers, cache_dir = cache_dir)
+        candidate &= present[:, :, classes == value].any(axis = 2)
+
+    tiles['candidate'] = [
+        bool(candidate[r // bh:(r + h - 1) // bh + 1, c // bw:(c + w - 1) // bw + 1].any())
+        for r, c, h, w in tiles[['row_off', 'col_off', 'height', 'width']].values.tolist()
+    ]
+    logger.info(f'{tiles.candidate.sum()} of {len(tiles)} windows contain candidate blocks')
+
+    return(tiles)
+
+def block_classes(path, n_workers = 1, cache_dir = None):
+    """
+    Pixel values contained in each block of the first band of a raster.
+
+    The raster is read once, one row of blocks at a time, and the result is cached in
+    cache_dir, keyed by the path, size and modification time of the file. Later calls, e.g. for
+    another value or tile size, only read the cache.
+
+    Parameters:
+      path : str or Path
+          Path of the raster.
+      n_workers : int, default 1
+          Number of worker processes reading rows of blocks.
+      cache_dir : str or Path, optional
+          Directory of the cache. Defaults to config.block_cache.
+
+    Returns:
+      classes : numpy.ndarray
+          Sorted pixel values contained in the raster.
+      present : numpy.ndarray
+          Boolean array (block row, block column, class) that is True if the block contains the
+          class.
+    """
+
+    if cache_dir is None:
+        cache_dir = config.block_cache
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(exist_ok = True, parents = True)
+
+    stat = os.stat(path)
+    key = hashlib.sha256(f'{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}'.encode()).hexdigest()
+    fname = Path(cache_dir, f'{key}.npz')
+    if fname.is_file():
+        with np.load(fname) as cached:
+            return(cached['classes'], cached['present'])
+
+    with rasterio.open(path) as src:
+        bh, bw = src.block_shapes[0]
+        tasks = [(path, row_off, bh, bw) for row_off in range(0, src.height, bh)]
+
+    logger.info(f'Reading the classes of {len(tasks)} rows of blocks of {path} with {n_workers} worker(s)')
+    if n_workers > 1:
+        with ProcessPoolExecutor(n_workers) as pool:
+            rows = list(pool.map(_block_row_classes, tasks))
+    else:
+        rows = [_block_row_classes(task) for task in tasks]
+
+    classes = np.unique(np.concatenate([v for v, _ in rows]))
+    present = np.zeros((len(rows), rows[0][1].shape[0], len(classes)), dtype = bool)
+    for i, (v, p) in enumerate(rows):
+        present[i][:, np.searchsorted(classes, v)] = p
+
+    tmp = fname.with_suffix('.npz.tmp')
+    with open(tmp, 'wb') as f:
+        np.savez(f, classes = classes, present = present)
+    tmp.replace(fname)
+
+    return(classes, present)
+
+def polygonize_class(path, out_dir, value, tile_size = 4096, n_workers = 1, compression = 'zstd'):
+    """
+    Polygonize all pixels of a raster equal to value, window by window.
+
+    Windows without value (see tile_index) are skipped. The other windows are read and
+    polygonized in a process pool, and every worker writes the polygons of its window
+    to <out_dir>/tile_row=<row>/tile_col=<col>/part-0.parquet. Polygons crossing window borders
+    are split at the border, so dissolve them if whole patches are needed.
+
+    The tile index and the finished windows are recorded in <out_dir>/_manifest.json, so an
+    interrupted run continues with the missing windows. The output can be read with
+    read_polygons.
+
+    Parameters:
+      path : str or Path
+          Path of the raster.
+      out_dir : str or Path
+          Directory of the partitioned GeoParquet dataset.
+      value : int
+          Pixel value to polygonize, e.g. 2210 for vineyards in LUISA.
+      tile_size : int, default 4096
+          Same as in tile_index.
+      n_workers : int, default 1
+          Number of worker processes.
+      compression : str, default 'zstd'
+          Parquet compression codec.
+
+    Returns:
+      n_polygons : int
+          Number of polygons in the dataset.
+    """
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(exist_ok = True, parents = True)
+    manifest_file = Path(out_dir, '_manifest.json')
+    settings = {'value': int(value), 'tile_size': int(tile_size)}
+
+    if manifest_file.is_file():
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if manifest['settings'] != settings:
+            raise ValueError(f'{out_dir} was written with different settings: {manifest["settings"]}')
+        tiles = pd.DataFrame(manifest['tiles'])
+    else:
+        tiles = tile_index(path, tile_size = tile_size, value = value, n_workers = n_workers)
+        tiles['n_polygons'] = np.where(tiles['candidate'], -1, 0)
+        with rasterio.open(path) as src:
+            manifest = {'settings': settings, 'crs': src.crs.to_wkt()}
+
+    todo = tiles.index[tiles['n_polygons'] < 0]
+    logger.info(f'Polygonizing {len(todo)} of {len(tiles)} windows with {n_workers} worker(s)')
+
+    tasks = [
+        (path, value, tiles.loc[i, ['row_off', 'col_off', 'height', 'width']].tolist(),
+         _partition_path(out_dir, tiles.loc[i, 'tile_row'], tiles.loc[i, 'tile_col']), compression)
+        for i in todo
+    ]
+
+    def write_manifest():
+        manifest['tiles'] = tiles.to_dict(orient = 'list')
+        tmp = manifest_file.with_suffix('.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, default = int)
+        os.replace(tmp, manifest_file)
+
+    write_manifest()
+    if n_workers > 1:
+        with ProcessPoolExecutor(n_workers) as pool:
+            for i, n in zip(todo, pool.map(_polygonize_window, tasks)):
+                tiles.loc[i, 'n_polygons'] = n
+                write_manifest()
+    else:
+        for i, task in zip(todo, tasks):
+            tiles.loc[i, 'n_polygons'] = _polygonize_window(task)
+            write_manifest()
+
+    return(int(tiles['n_polygons'].sum()))
+
+def read_polygons(out_dir, bbox = None):
+    """
+    Read polygons written by polygonize_class.
+
+    Parameters:
+      bbox : tuple, optional
+          (minx, miny, maxx, maxy) in the crs of the raster. Only polygons whose bounding box
+          intersects bbox are read.
+
+    Returns:
+      polygons : geopandas.GeoDataFrame
+          Columns id, tile_row, tile_col and geometry.
+    """
+
+    files = sorted(Path(out_dir).glob('tile_row=*/tile_col=*/part-0.parquet'))
+    with open(Path(out_dir, '_manifest.json')) as f:
+        crs = json.load(f)['crs']
+
+    parts = []
+    for fname in files:
+        part = gpd.read_parquet(fname, bbox = bbox)
+        part['tile_row'] = int(fname.parent.parent.name.split('=')[1])
+        part['tile_col'] = int(fname.parent.name.split('=')[1])
+        parts.append(part)
+
+    if len(parts) == 0:
+        return(gpd.GeoDataFrame({'id': [], 'tile_row': [], 'tile_col': []}, geometry = [], crs = crs))
+
+    polygons = pd.concat(parts, ignore_index = True)
+    polygons.insert(0, 'id', np.arange(len(polygons)))
+
+    return(polygons[['id', 'tile_row', 'tile_col', 'geometry']])
+
+def _partition_path(out_dir, tile_row, tile_col):
+    return(Path(out_dir, f'tile_row={int(tile_row)}', f'tile_col={int(tile_col)}', 'part-0.parquet'))
+
+def _block_row_classes(task):
+
+    path, row_off, bh, bw = task
+
+    with rasterio.open(path) as src:
+        arr = src.read(1, window = Window(0, row_off, src.width, min(bh, src.height - row_off)))
+
+    ##Presence of every value of the row per block column, counted with one bincount
+    values, inv = np.unique(arr, return_inverse = True)
+    block_col = np.broadcast_to(np.arange(arr.shape[1]) // bw, arr.shape)
+    counts = np.bincount(block_col.ravel() * len(values) + inv.ravel(), minlength = (block_col[0, -1] + 1) * len(values))
+
+    return(values, counts.reshape(-1, len(values)) > 0)
+
+def _polygonize_window(task):
+
+    path, value, (row_off, col_off, height, width), fname, compression = task
+
+    window = Window(col_off, row_off, width, height)
+    with rasterio.open(path) as src:
+        mask = src.read(1, window = window) == value
+        transform = src.window_transform(window)
+        crs = src.crs
+
+    if not mask.any():
+        return(0)
+
+    geoms = [shapely.geometry.shape(geom) for geom, _ in shapes(mask.view(np.uint8), mask = mask, transform = transform)]
+    gdf = gpd.GeoDataFrame(geometry = geoms, crs = crs)
+
+    fname.parent.mkdir(exist_ok = True, parents = True)
+    tmp = fname.with_suffix('.parquet.tmp')
+    gdf.to_parquet(tmp, compression = compression, write_covering_bbox = True)
+    os.replace(tmp, fname)
+
+    return(len(gdf))
@@ -0,0 +1,66 @@
+import threading
+import queue
+import logging
+
+logger = logging.getLogger(__name__)
+
+def prefetch(func, items, depth = 1):
+    """
+    Apply func to items in a background thread, staying at most depth items ahead of the consumer.
+
+    The result for the next item is produced while the caller processes the current one. A new
+    item is only started once the caller has taken the previous results, so at most depth results
+    are produced or waiting in addition to the one being processed. Exceptions raised by func are
+    re-raised in the caller.
+
+    Parameters:
+      func : callable
+          Function producing the data for one item, e.g. downloading and opening files.
+      items : iterable
+          Items to process in order.
+      depth : int, default 1
+          Number of items produced ahead. With depth 0, items are produced sequentially in the
+          calling thread.
+
+    Yields:
+      (item, result) tuples in the order of items.
+    """
+
+    if depth < 1:
+        for item in items:
+            yield(item, func(item))
+        return
+
+    slots = threading.Semaphore(depth)
+    results = queue.Queue()
+    stop = threading.Event()
+    done = object()
+
+    def _producer():
+        try:
+            for item in items:
+                slots.acquire()
+                if stop.is_set():
+                    return
+                logger.debug(f'Prefetching {item}')
+                results.put((item, func(item), None))
+        except Exception as e:
+            results.put((None, None, e))
+        results.put(done)
+
+    thread = threading.Thread(target = _producer, daemon = True)
+    thread.start()
+
+    try:
+        while True:
+            res = results.get()
+            if res is done:
+                break
+            item, value, error = res
+            if error is not None:
+                raise error
+            slots.release()
+            yield(item, value)
+    finally:
+        stop.set()
+        slots.release()
@@ -0,0 +1,82 @@
+import xarray as xr
+import fsspec
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import logging
+
+logger = logging.getLogger(__name__)
+
+def open_remote_dataset(urls, aoi, cache_dir, block_size = 2**20, n_threads = 1, chunks = None):
+    """
+    Read the AOI subset of remote NetCDF4/HDF5 files with HTTP range requests.
+
+    Only the HDF5 chunks that intersect the AOI (plus the file metadata) are requested. Fetched
+    blocks are kept in a local block cache, so repeated reads of the same region cost no network
+    I/O. Network volume therefore scales with the AOI instead of the global file size.
+
+    Parameters:
+      urls : list
+          Urls of the NetCDF files. Servers must support HTTP range requests.
+      aoi : tuple
+          A tuple (minx, miny, maxx, maxy) used to sub-select lon and lat.
+      cache_dir : str or Path
+          Directory of the local block cache.
+      block_size : int, default 1 MiB
+          Size of the blocks fetched and cached.
+      n_threads : int, default 1
+          Number of files read concurrently.
+      chunks : dict, optional
+          If given, the files are opened lazily with these dask chunks and only the chunks that
+          are computed are fetched. The remote files stay open until ds.close() is called.
+
+    Returns:
+      ds : xarray.Dataset
+          The combined AOI subset, loaded into memory if chunks is None.
+    """
+
+    if (not isinstance(aoi, tuple)):
+        raise ValueError(f"aoi must be provided as tuple. Got {type(aoi)}")
+
+    Path(cache_dir).mkdir(exist_ok = True, parents = True)
+    fs = fsspec.filesystem(
+        'blockcache',
+        target_protocol = 'https' if urls[0].startswith('https') else 'http',
+        cache_storage = str(cache_dir),
+        check_files = False,
+    )
+
+    logger.info(f'Reading AOI subset of {len(urls)} remote files')
+    with ThreadPoolExecutor(n_threads) as pool:
+        ds_list = list(pool.map(lambda url: _read_subset(fs, url, aoi, block_size, chunks), urls))
+
+    ds = xr.combine_by_coords(ds_list, join='override', combine_attrs='override')
+    if chunks is not None:
+        ##The lazily opened files are read when the chunks are computed, so close them together
+        ds.set_close(lambda: [i.close() for i in ds_list])
+
+    return(ds)
+
+def _read_subset(fs, url, aoi, block_size, chunks = None):
+
+    minx, miny, maxx, maxy = aoi
+    logger.debug("Reading remote file: %s", url)
+
+    f = fs.open(url.split('#')[0], mode = 'rb', block_size = block_size)
+    try:
+        ds_tmp = xr.open_dataset(f, engine = 'h5netcdf', chunks = chunks)
+    except BaseException:
+        f.close()
+        raise
+    ds_sub = ds_tmp.sel(lat=slice(miny, maxy), lon=slice(minx, maxx))
+
+    def close():
+        ds_tmp.close()
+        f.close()
+
+    if chunks is None:
+        ds_sub = ds_sub.load()
+        close()
+    else:
+        ds_sub.set_close(close)
+
+    return(ds_sub)
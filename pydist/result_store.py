@@ -0,0 +1,126 @@
+import pandas as pd
+import json
+import os
+from pathlib import Path
+from urllib.parse import quote
+import logging
+
+logger = logging.getLogger(__name__)
+
+class ResultStore:
+    """
+    Parquet dataset of aggregated results, partitioned by year and variety.
+
+    Each (year, variety) pair is written to its own file <root>/year=<year>/<variety_col>=<variety>/part-0.parquet,
+    which is replaced if the pair is written again. A small JSON manifest records the finished
+    pairs, so resume checks do not have to read the results. Pairs are only added to the
+    manifest after their files are written, so an interrupted run leaves no duplicates.
+
+    Parameters:
+      root : str or Path
+          Directory of the dataset.
+      variety_col : str, default 'Prime'
+          Column holding the variety name.
+      compression : str, default 'zstd'
+          Parquet compression codec.
+    """
+
+    def __init__(self, root, variety_col = 'Prime', compression = 'zstd'):
+
+        self.root = Path(root)
+        self.variety_col = variety_col
+        self.compression = compression
+        self.manifest_file = Path(self.root, '_manifest.json')
+
+        self.root.mkdir(exist_ok = True, parents = True)
+        self._done = self._read_manifest()
+
+    def is_done(self, year, variety):
+        """True if results for year and variety were written."""
+        return((int(year), str(variety)) in self._done)
+
+    def done(self):
+        """Set of all finished (year, variety) pairs."""
+        return(set(self._done))
+
+    def write(self, tbl, variety, years):
+        """
+        Write the results of one variety and mark all years as finished.
+
+        Parameters:
+          tbl : pandas.DataFrame
+              Results with a year column. The variety column is set to variety.
+          variety : str
+              Name of the variety.
+          years : list
+              Years covered by tbl. Years without rows in tbl are marked as finished as well.
+        """
+
+        tbl = tbl.assign(**{self.variety_col: variety})
+        for year in years:
+            tbl_year = tbl.loc[tbl['year'] == year].drop(columns = ['year', self.variety_col])
+            fname = self.partition_path(year, variety)
+            fname.parent.mkdir(exist_ok = True, parents = True)
+
+            tmp = fname.with_suffix('.parquet.tmp')
+            tbl_year.to_parquet(tmp, index = False, compression = self.compression)
+            os.replace(tmp, fname)
+
+        self._done.update((int(y), str(variety)) for y in years)
+        self._write_manifest()
+
+    def read(self, variety = None, years = None):
+        """
+        Read results, optionally only for a variety and a list of years.
+
+        Returns:
+          tbl : pandas.DataFrame
+              Results with year and variety columns. Empty if nothing matches.
+        """
+
+        filters = []
+        if variety is not None:
+            filters.append((self.variety_col, '==', variety))
+        if years is not None:
+            filters.append(('year', 'in', [int(i) for i in years]))
+
+        if not any(self.root.glob('year=*')):
+            return(pd.DataFrame())
+
+        tbl = pd.read_parquet(self.root, filters = filters if len(filters) > 0 else None, partitioning = 'hive')
+        tbl['year'] = tbl['year'].astype(int)
+        tbl[self.variety_col] = tbl[self.variety_col].astype(str)
+
+        return(tbl)
+
+    def import_csv(self, filename):
+        """
+        Import results appended to a single csv file by earlier versions of 2_climatic_indices.py.
+
+        Rows written twice by restarted runs are dropped. Every (year, variety) pair contained in
+        the file is marked as finished.
+        """
+
+        tbl = pd.read_csv(filename, index_col = 0).drop_duplicates()
+        for variety, tbl_var in tbl.groupby(self.variety_col):
+            self.write(tbl_var, variety, sorted(tbl_var['year'].unique()))
+
+        logger.info(f'Imported {len(tbl)} rows from {filename}')
+
+    def partition_path(self, year, variety):
+        """File holding the results of year and variety."""
+        return(Path(self.root, f'year={int(year)}', f'{self.variety_col}={quote(str(variety), safe = "")}', 'part-0.parquet'))
+
+    def _read_manifest(self):
+
+        if not self.manifest_file.is_file():
+            return(set())
+        with open(self.manifest_file) as f:
+            return({(int(y), str(v)) for y, v in json.load(f)['done']})
+
+    def _write_manifest(self):
+
+        tmp = self.manifest_file.with_suffix('.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'done': sorted(self._done)}, f)
+        os.replace(tmp, self.manifest_file)
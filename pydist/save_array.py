@@ -1,7 +1,7 @@
 import netCDF4
 import xarray as xr
+import pandas as pd
 from pathlib import Path
-import datetime
 import warnings
 import numpy as np
 
@@ -23,7 +23,26 @@ import numpy as np
 #     print(ds['var'].max(['lon', 'lat']))
 ####
 
-def save_array(data, filename, unlimited_dim = None, overwrite = False):
+def save_array(data, filename, unlimited_dim = None, overwrite = False, zlib = True, complevel = 4, chunks = None):
+    """
+    Write data to a NetCDF file or append it along unlimited_dim if the file exists.
+
+    Parameters:
+      data : xarray.DataArray or xarray.Dataset
+          Data to write.
+      filename : str or Path
+          Output file.
+      unlimited_dim : str
+          Dimension along which data is appended.
+      overwrite : bool, default False
+          If True, slices of unlimited_dim already in the file are overwritten. Otherwise they
+          are skipped.
+      zlib, complevel :
+          Compression of the data variables when the file is created.
+      chunks : dict, optional
+          Chunk size per dimension used when the file is created. Dimensions not contained
+          are stored in one chunk, unlimited_dim defaults to 1.
+    """
 
     if not isinstance(unlimited_dim, str):
         raise ValueError(f'Unlimited_dim must be a string! Got {type(unlimited_dim)}')
@@ -37,53 +56,79 @@ def save_array(data, filename, unlimited_dim = None, overwrite = False):
         filename = Path(filename)
 
     if not filename.is_file():
-        data.to_netcdf(filename, mode='w', unlimited_dims = [unlimited_dim]) #, encoding = {param: dict(zlib = True, complevel = 9)}
+        encoding = {var: _variable_encoding(data[var], unlimited_dim, zlib, complevel, chunks) for var in data.data_vars}
+        data.to_netcdf(filename, mode='w', unlimited_dims = [unlimited_dim], encoding = encoding)
     else:
-        _append_to_netcdf(filename, data, unlimited_dim = unlimited_dim, overwrite = overwrite)
+        _append_to_netcdf(filename, data, unlimited_dim = unlimited_dim, overwrite = overwrite, zlib = zlib, complevel = complevel)
+
+def _variable_encoding(arr, unlimited_dim, zlib, complevel, chunks):
+
+    encoding = {'zlib': zlib, 'complevel': complevel}
+    if chunks is not None:
+        chunks = {unlimited_dim: 1, **chunks}
+        encoding['chunksizes'] = tuple(min(chunks.get(d, arr.sizes[d]), arr.sizes[d]) for d in arr.dims)
+
+    return(encoding)
 
 # based on: https://github.com/pydata/xarray/issues/1672
-def _append_to_netcdf(filename, ds_to_append, unlimited_dim, overwrite = False):
+def _append_to_netcdf(filename, ds_to_append, unlimited_dim, overwrite = False, zlib = True, complevel = 4):
 
     with netCDF4.Dataset(filename, mode='a') as nc:
 
         nc_coord = nc[unlimited_dim]
 
-        if ds_to_append[unlimited_dim].dtype == np.dtype('<M8[ns]'):
+        ##Read the existing coordinate only once
+        nc_values = np.asarray(nc_coord[:])
+
+        if np.issubdtype(ds_to_append[unlimited_dim].dtype, np.datetime64):
             ##Transform datetime values to netCDF units
-            dt_coords = [
-                datetime.datetime(j, m, d)
-                for d, m, j in zip(
-                    ds_to_append[unlimited_dim].dt.day.values,
-                    ds_to_append[unlimited_dim].dt.month.values,
-                    ds_to_append[unlimited_dim].dt.year.values,
-                )
-            ]
-            dt_num = netCDF4.date2num(
-                dt_coords, units=nc_coord.units, calendar=nc_coord.calendar
+            dt_num, _, _ = xr.coding.times.encode_cf_datetime(
+                ds_to_append[unlimited_dim].values,
+                units = nc_coord.units,
+                calendar = getattr(nc_coord, 'calendar', 'standard'),
             )
         else:
-            dt_num = list( ds_to_append[unlimited_dim].values )
+            dt_num = ds_to_append[unlimited_dim].values
+        dt_num = np.asarray(dt_num)
 
-        contained_dt = [i in nc_coord[:] for i in dt_num]
+        ##Position of each slice in the file, -1 if not yet contained. Duplicates use the last position.
+        nc_index = pd.Index(nc_values[::-1]).drop_duplicates()
+        nc_pos = nc_index.get_indexer(dt_num)
+        contained_dt = nc_pos >= 0
+        nc_pos[contained_dt] = len(nc_values) - 1 - nc_pos[contained_dt]
 
         if not overwrite:
-            if all(contained_dt):
+            if contained_dt.all():
                 raise ValueError(f"All slices in dimension {unlimited_dim} already contained in output file!")
-            elif any(contained_dt):
+            elif contained_dt.any():
                 warnings.warn(f"Some slices of dimension {unlimited_dim} already contained in output file! Only new slices are written.")
 
                 ##Remove already contained coords
-                ds_to_append = ds_to_append.sel({unlimited_dim: [not i for i in contained_dt]})
-                dt_num = [dt_num[i] for i,j in enumerate(contained_dt) if not j]
+                ds_to_append = ds_to_append.isel({unlimited_dim: ~contained_dt})
+                dt_num = dt_num[~contained_dt]
+                nc_pos = nc_pos[~contained_dt]
+                contained_dt = contained_dt[~contained_dt]
+
+        ##New slices are appended at the end of the unlimited dimension
+        nc_pos[~contained_dt] = len(nc_values) + np.arange((~contained_dt).sum())
+
+        ##Write in increasing order, as one slice if the positions are contiguous
+        order = np.argsort(nc_pos, kind = 'stable')
+        nc_pos = nc_pos[order]
+        ds_to_append = ds_to_append.isel({unlimited_dim: order})
+        if np.all(np.diff(nc_pos) == 1):
+            nc_idx = slice(int(nc_pos[0]), int(nc_pos[-1]) + 1)
+        else:
+            nc_idx = nc_pos
 
-        for var_name in ds_to_append.keys():
+        nc_coord[nc_idx] = dt_num[order]
 
-            if not var_name in nc.variables:
-                #TODO: Support adding new variables to file
-                warnings.warn(f"Variable {var_name} not found in existing nc file. Adding new variables is not supported.")
-                continue
+        for var_name in ds_to_append.data_vars:
 
             expand_data = ds_to_append[var_name]
+
+            if not var_name in nc.variables:
+                _create_variable(nc, expand_data, zlib, complevel)
             nc_variable = nc[var_name]
 
             # Ensure the same encoding as was previously stored.
@@ -95,20 +140,23 @@ def _append_to_netcdf(filename, ds_to_append, unlimited_dim, overwrite = False):
 
             data_encoded = xr.conventions.encode_cf_variable(expand_data.variable)
 
-            nc_idx = []
-            l = 0
-            for i in dt_num:
-                if i in nc_coord[:]:
-                    nc_idx.append([c for c,j in enumerate(nc_coord[:]) if j == i][-1])
-                else:
-                    nc_idx.append(len(nc_coord[:])+l)
-                    l += 1
-
             left_slices = list(nc_variable.dimensions).index(unlimited_dim)
             nc_slice = (
                 (slice(None),) * left_slices
                 + (nc_idx, )
-                + (slice(None),) * (len(nc.dimensions) - left_slices - 1)
+                + (slice(None),) * (nc_variable.ndim - left_slices - 1)
             )
             nc_variable[nc_slice] = data_encoded.transpose(*nc_variable.dimensions).data
-            nc_coord[nc_idx] = dt_num
+
+def _create_variable(nc, arr, zlib, complevel):
+
+    missing = [d for d in arr.dims if d not in nc.dimensions]
+    if len(missing) > 0:
+        raise ValueError(f"Dimension(s) {', '.join(missing)} of variable {arr.name} not found in existing nc file.")
+
+    encoded = xr.conventions.encode_cf_variable(arr.variable)
+    attrs = dict(encoded.attrs)
+    fill_value = attrs.pop('_FillValue', np.nan if np.issubdtype(encoded.dtype, np.floating) else None)
+
+    nc_variable = nc.createVariable(arr.name, encoded.dtype, encoded.dims, zlib = zlib, complevel = complevel, fill_value = fill_value)
+    nc_variable.setncatts(attrs)
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import logging
+
+logger = logging.getLogger(__name__)
+
+def compress_pixels(mask, *objects, pixel_dim = 'pixel', x_dim = 'lon', y_dim = 'lat'):
+    """
+    Compress the spatial dimensions of xarray objects to a 1-D vector of pixels.
+
+    Parameters:
+      mask : xarray.DataArray
+          Boolean array with dimensions (y_dim, x_dim). Only pixels where mask is True are kept.
+      *objects : xarray.DataArray or xarray.Dataset
+          Objects on the same grid as mask.
+      pixel_dim : str, default 'pixel'
+          Name of the new dimension. The original coordinates are kept as non-dimension
+          coordinates along it, so the objects can be scattered back with expand_pixels.
+
+    Returns:
+      out : tuple
+          The compressed objects in the same order as provided.
+    """
+
+    if set(mask.dims) != {x_dim, y_dim}:
+        raise ValueError(f'mask must have the dimensions {y_dim} and {x_dim}. Got {mask.dims}')
+
+    iy, ix = np.nonzero(mask.transpose(y_dim, x_dim).values)
+    logger.debug(f'Compressing grid of {mask.size} cells to {len(iy)} pixels')
+
+    indexers = {
+        y_dim: xr.DataArray(iy, dims = pixel_dim),
+        x_dim: xr.DataArray(ix, dims = pixel_dim),
+    }
+
+    out = []
+    for arr in objects:
+        out.append(arr.isel(indexers))
+
+    return(tuple(out))
+
+def expand_pixels(obj, template, pixel_dim = 'pixel', x_dim = 'lon', y_dim = 'lat'):
+    """
+    Scatter an object compressed with compress_pixels back onto the grid of template.
+
+    Parameters:
+      obj : xarray.DataArray or xarray.Dataset
+          Compressed object with the dimension pixel_dim and the coordinates y_dim and x_dim along it.
+      template : xarray.DataArray or xarray.Dataset
+          Object providing the target grid coordinates. Cells not contained in obj are NaN.
+
+    Returns:
+      out : xarray.DataArray or xarray.Dataset
+          Object with pixel_dim replaced by (y_dim, x_dim).
+    """
+
+    if isinstance(obj, xr.Dataset):
+        return(obj.map(expand_pixels, template = template, pixel_dim = pixel_dim, x_dim = x_dim, y_dim = y_dim))
+
+    iy = pd.Index(template[y_dim].values).get_indexer(obj[y_dim].values)
+    ix = pd.Index(template[x_dim].values).get_indexer(obj[x_dim].values)
+    if (iy < 0).any() or (ix < 0).any():
+        raise ValueError('Pixel coordinates not found in template grid.')
+
+    obj = obj.drop_vars([x_dim, y_dim]).transpose(..., pixel_dim)
+    dims = obj.dims[:-1]
+    shp = obj.shape[:-1] + (template[y_dim].size, template[x_dim].size)
+
+    values = np.full(shp, np.nan, dtype = np.result_type(obj.dtype, np.float32))
+    values[..., iy, ix] = obj.values
+
+    coords = {k: v for k, v in obj.coords.items() if pixel_dim not in v.dims}
+    coords.update({y_dim: template[y_dim], x_dim: template[x_dim]})
+
+    return(xr.DataArray(values, dims = dims + (y_dim, x_dim), coords = coords, name = obj.name, attrs = obj.attrs))
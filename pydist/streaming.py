@@ -0,0 +1,252 @@
+import numpy as np
+import xarray as xr
+from itertools import product
+import logging
+
+from .prefetch import prefetch
+from .aggregation import LauPartials, merge_lau_partials, _pixel_weights
+
+logger = logging.getLogger(__name__)
+
+INDICES = ['gdd', 'gdd_opt', 'pr_sum', 'pr_max', 'days_max', 'days_min', 'tasmin', 'tasmax']
+
+class StreamingIndices:
+    """
+    Online calculation of veraison dates and LAU aggregated window indices from daily data in time order.
+
+    Each call to update folds a block of days (e.g. one monthly file) into per-pixel state: the
+    running temperature sum, the day where Fcrit is reached per variety and, for vineyard pixels
+    only, a rolling buffer of the last window days of all variables. Once the window of a
+    variety is complete, its indices are calculated from the buffer and added to area weighted
+    sums per LAU, so no pixel indices are kept. Peak memory is one block plus the buffer of
+    window days of the vineyard pixels, the int16 crossing day per variety and pixel and the
+    sums per LAU, variety and index.
+
+    Parameters:
+      Fcrits : dict
+          Critical temperature sums per variety.
+      ids, weights : xarray.DataArray
+          LAU id and vineyard area share of each pixel, on the same grid as the data. Indices
+          are only calculated for pixels with an id.
+      veraison_min, veraison_max : int
+          Indices are only calculated for veraison dates within [veraison_min, veraison_max).
+      window : int
+          Number of days after veraison (including the veraison date) to consider.
+    """
+
+    def __init__(self, Fcrits, ids, weights, veraison_min = 214, veraison_max = 275, window = 45):
+
+        self.varieties = list(Fcrits.keys())
+        self.Fcrits = np.array([Fcrits[i] for i in self.varieties], dtype = np.float64)
+        self.veraison_min = veraison_min
+        self.veraison_max = veraison_max
+        self.window = window
+
+        self.template = ids
+        self.pixels, self.lau_ids, self.lau_pix, self.w = _pixel_weights(ids, weights, ids.dims)
+        self.weight = np.bincount(self.lau_pix, weights = self.w, minlength = len(self.lau_ids))
+
+        self.year = None
+
+    def update(self, ds):
+        """
+        Fold the days of ds (variables tas, tasmax, tasmin and pr) into the state.
+
+        Returns:
+          results : list
+              Output of finalize for each year completed by ds, usually empty.
+        """
+
+        ##Check if necessary dims are present
+        if not 'time' in ds.dims:
+            raise ValueError('Time dimension not found in dataset.')
+
+        ds = ds[['tas', 'tasmax', 'tasmin', 'pr']].transpose('time', *self.template.dims)
+        if ds.tas.shape[1:] != self.template.shape:
+            raise ValueError(f'Grid of ds {ds.tas.shape[1:]} does not match the grid of ids {self.template.shape}.')
+
+        years = ds.time.dt.year.values
+        doys = ds.time.dt.dayofyear.values
+        if (self.year is not None) and (years[0] < self.year):
+            raise ValueError(f'Data must be provided in time order. Got year {years[0]} after {self.year}.')
+
+        results = []
+        arrs = {var: ds[var].values.reshape(ds.time.size, -1) for var in ds.data_vars}
+        for t in range(ds.time.size):
+            if years[t] != self.year:
+                if self.year is not None:
+                    results.append(self.finalize())
+                self._reset(years[t])
+            self._step(doys[t], arrs['tas'][t], *(arrs[k][t, self.pixels] for k in ['tas', 'tasmax', 'tasmin', 'pr']))
+
+        return(results)
+
+    def finalize(self, variety_dim = 'variety'):
+        """
+        Complete the current year and return its results.
+
+        Returns:
+          year : int
+              Year of the results.
+          veraison : xarray.DataArray
+              Unmasked day of year of veraison as float32, NaN if Fcrit is not reached, with
+              dimensions (variety, year, ...).
+          lau_idx : xarray.Dataset
+              Area weighted indices gdd, gdd_opt, pr_sum, pr_max, days_max, days_min, tasmin
+              and tasmax per LAU with dimensions (id, variety, year).
+        """
+
+        if self.year is None:
+            raise ValueError('No data was provided since the last call of finalize.')
+
+        ##Windows extending beyond the last day are calculated from the available days
+        if self.n_days > 0:
+            self._resolve_until(self.buffer_doy[(self.n_days - 1) % self.window])
+
+        veraison = self.cross_doy.astype(np.float32)
+        veraison[self.cross_doy == 0] = np.nan
+        veraison = xr.DataArray(
+            veraison.reshape((len(self.Fcrits), ) + self.template.shape),
+            dims = (variety_dim, ) + self.template.dims,
+            coords = {variety_dim: self.varieties, **self.template.coords},
+            name = 'veraison',
+        ).expand_dims(year = [self.year], axis = 1)
+
+        template = {'vars': INDICES, 'dims': [variety_dim], 'shape': [len(self.Fcrits)], 'coords': {variety_dim: self.varieties}}
+        lau_idx = merge_lau_partials(
+            [LauPartials(self.lau_ids, self.weight, self.value_sum, self.n_valid, template)], lau_ids = self.lau_ids
+        ).expand_dims(year = [self.year], axis = -1)
+
+        year = self.year
+        self.year = None
+        self.buffer = None
+        self.cross_doy = None
+
+        return(year, veraison, lau_idx)
+
+    def _reset(self, year):
+
+        n_pix = self.template.size
+        shp = (len(self.lau_ids), len(INDICES) * len(self.Fcrits))
+
+        self.year = year
+        self.tas_sum = np.zeros(n_pix)
+        ##Day of year where Fcrit is reached, 0 if not reached yet
+        self.cross_doy = np.zeros((len(self.Fcrits), n_pix), dtype = np.int16)
+        ##Weighted sums and number of valid values per LAU, with one column per index and variety
+        self.value_sum = np.zeros(shp)
+        self.n_valid = np.zeros(shp)
+
+        ##Ring buffer of the last window days of the vineyard pixels, allocated with the dtype of the data
+        self.buffer = None
+        self.buffer_doy = np.full(self.window, -1)
+        self.n_days = 0
+        self.resolved = self.veraison_min - 1
+
+    def _step(self, doy, tas_all, tas, tasmax, tasmin, pr):
+
+        if self.buffer is None:
+            self.buffer = {k: np.full((self.window, v.size), np.nan, dtype = v.dtype) for k, v in zip(['tas', 'tasmax', 'tasmin', 'pr'], [tas, tasmax, tasmin, pr])}
+        i = self.n_days % self.window
+        for k, v in zip(['tas', 'tasmax', 'tasmin', 'pr'], [tas, tasmax, tasmin, pr]):
+            self.buffer[k][i] = v
+        self.buffer_doy[i] = doy
+        self.n_days += 1
+
+        ##Update temperature sum and veraison dates of all pixels
+        if doy >= 60:
+            self.tas_sum += np.nan_to_num(np.clip(tas_all, 0, None))
+            crossed = (self.cross_doy == 0) & (self.tas_sum[None, :] >= self.Fcrits[:, None])
+            self.cross_doy[crossed] = doy
+
+        ##Windows that started window - 1 days ago are complete
+        self._resolve_until(doy - self.window + 1)
+
+    def _resolve_until(self, last_start):
+
+        for start in range(self.resolved + 1, min(last_start, self.veraison_max - 1) + 1):
+            self._resolve(start)
+        self.resolved = max(self.resolved, last_start)
+
+    def _resolve(self, start):
+
+        ##Days of the buffer within the window of veraison dates equal to start
+        rows = np.flatnonzero((self.buffer_doy >= start) & (self.buffer_doy < start + self.window))
+        cross_doy = self.cross_doy[:, self.pixels]
+        n_var = len(self.Fcrits)
+
+        for v in range(n_var):
+            pix = np.flatnonzero(cross_doy[v] == start)
+            if len(pix) == 0:
+                continue
+
+            tas, tasmax, tasmin, pr = (self.buffer[k][np.ix_(rows, pix)] for k in ['tas', 'tasmax', 'tasmin', 'pr'])
+            n_tas, n_pr = (~np.isnan(tas)).sum(axis = 0), (~np.isnan(pr)).sum(axis = 0)
+
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                res = {
+                    'gdd': np.where(n_tas > 0, np.nansum(np.clip(tas - 10, 0, None), axis = 0, dtype = np.float64), np.nan),
+                    'gdd_opt': np.where(n_tas > 0, np.nansum(np.clip(tas - 25, 0, None), axis = 0, dtype = np.float64), np.nan),
+                    'pr_sum': np.where(n_pr > 0, np.nansum(pr, axis = 0, dtype = np.float64), np.nan),
+                    'pr_max': np.fmax.reduce(pr, axis = 0, initial = np.nan),
+                    'days_max': (tasmax > 40).sum(axis = 0).astype(np.float64),
+                    'days_min': (tasmin < 10).sum(axis = 0).astype(np.float64),
+                    'tasmin': np.nansum(tasmin, axis = 0, dtype = np.float64) / (~np.isnan(tasmin)).sum(axis = 0),
+                    'tasmax': np.nansum(tasmax, axis = 0, dtype = np.float64) / (~np.isnan(tasmax)).sum(axis = 0),
+                }
+
+            ##Fold the pixel values into the LAU sums, same as partial_lau_sums
+            lau, w = self.lau_pix[pix], self.w[pix]
+            for i, k in enumerate(INDICES):
+                valid = ~np.isnan(res[k])
+                col = i * n_var + v
+                self.value_sum[:, col] += np.bincount(lau, weights = w * np.where(valid, res[k], 0), minlength = len(self.lau_ids))
+                self.n_valid[:, col] += np.bincount(lau, weights = valid, minlength = len(self.lau_ids))
+
+def stream_chelsa_indices(Fcrits, ids, weights, variables, resolution, years, months = np.arange(3, 13), veraison_min = 214, veraison_max = 275, window = 45, prefetch_depth = 1, **kwargs):
+    """
+    Calculate veraison dates and LAU aggregated window indices from CHELSA-W5E5 files month by month.
+
+    Each monthly file is loaded with load_chelsa_w5e5, folded into a StreamingIndices state and
+    dropped. The next month is loaded in the background while the current one is processed, also
+    across years. The results of each year are yielded as soon as its last month is folded.
+
+    Parameters:
+      Fcrits : dict
+          Critical temperature sums per variety.
+      ids, weights : xarray.DataArray
+          LAU id and vineyard area share of each pixel, aligned to the grid of the files.
+      variables, resolution, years, months :
+          Passed to load_chelsa_w5e5. Must include tas, tasmax, tasmin and pr.
+      prefetch_depth : int, default 1
+          Number of months loaded ahead.
+      **kwargs
+          Passed to load_chelsa_w5e5, e.g. aoi or n_threads.
+
+    Yields:
+      (year, veraison, lau_idx) tuples as returned by StreamingIndices.finalize.
+    """
+
+    from .get_climate import load_chelsa_w5e5
+
+    if isinstance(years, int):
+        years = [years]
+
+    state = StreamingIndices(Fcrits, ids, weights, veraison_min, veraison_max, window)
+
+    def _load_month(item):
+        y, m = item
+        ds, release = load_chelsa_w5e5(variables, resolution, [y], months = [m], return_release = True, **kwargs)
+        try:
+            return(ds.load())
+        finally:
+            release()
+
+    for (y, m), ds in prefetch(_load_month, list(product(years, months)), depth = prefetch_depth):
+        logger.debug(f'Folding {y}-{m:02} into streaming state')
+        for year, veraison, lau_idx in state.update(ds):
+            yield(year, veraison.rio.write_crs(4326), lau_idx)
+        del ds
+
+    year, veraison, lau_idx = state.finalize()
+    yield(year, veraison.rio.write_crs(4326), lau_idx)
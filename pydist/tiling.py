@@ -0,0 +1,194 @@
+import numpy as np
+import xarray as xr
+from concurrent.futures import ProcessPoolExecutor
+import logging
+
+from .get_climatic_window import calc_phen_dates, calc_window_indices, _PREFIX_DTYPES, _PREFIX_TERMS
+from .aggregation import partial_lau_sums, merge_lau_partials
+from .veraison_store import open_veraison
+
+logger = logging.getLogger(__name__)
+
+##Bytes of the cumulative sums held per input day by calc_prefix_sums
+_PREFIX_BYTES = sum(np.dtype(i).itemsize for i in _PREFIX_DTYPES.values())
+##Float64 values held per variety and year: the veraison date, its masked copy, the two
+##cumulative sums gathered per term and the window indices
+_VARIETY_BYTES = 8 * (2 + 2 * len(_PREFIX_DTYPES) + len(_PREFIX_TERMS))
+
+def plan_tiles(ds, memory_budget, n_workers = 1, n_varieties = 1, x_dim = 'lon', y_dim = 'lat'):
+    """
+    Split the grid of ds into spatial tiles whose working set fits into a memory budget.
+
+    The working set of a pixel is estimated from the number of days and variables of ds as
+    float64, the cumulative sums used for the window indices and the veraison dates and
+    indices of all varieties and years.
+
+    Parameters:
+      ds : xarray.Dataset
+          Daily climate data, usually opened lazily.
+      memory_budget : int
+          Memory in bytes available for all workers together.
+      n_workers : int, default 1
+          Number of tiles processed at the same time.
+      n_varieties : int, default 1
+          Number of varieties processed per tile.
+
+    Returns:
+      tiles : list
+          Dictionaries of y_dim and x_dim slices that can be passed to isel.
+    """
+
+    ny, nx = ds.sizes[y_dim], ds.sizes[x_dim]
+    n_years = len(np.unique(ds.time.dt.year.values))
+    bytes_per_pixel = ds.sizes['time'] * (len(ds.data_vars) * 8 + _PREFIX_BYTES) + n_varieties * n_years * _VARIETY_BYTES
+    max_pixels = max(1, int(memory_budget / n_workers / bytes_per_pixel))
+
+    ##Square tiles, widened along x_dim if the grid is narrower along y_dim
+    tile_y = min(ny, max(1, int(np.sqrt(max_pixels))))
+    tile_x = min(nx, max(1, max_pixels // tile_y))
+
+    tiles = [
+        {y_dim: slice(y, min(y + tile_y, ny)), x_dim: slice(x, min(x + tile_x, nx))}
+        for y in range(0, ny, tile_y) for x in range(0, nx, tile_x)
+    ]
+    logger.debug(f'Split grid of {ny}x{nx} pixels into {len(tiles)} tiles of up to {tile_y}x{tile_x} pixels')
+
+    return(tiles)
+
+def run_tiled(ds, Fcrits, ids, weights, memory_budget, store, n_workers = 1, veraison_min = 214, veraison_max = 275, window = 45, x_dim = 'lon', y_dim = 'lat'):
+    """
+    Calculate veraison dates and LAU aggregated window indices tile by tile.
+
+    Each tile of ds is loaded, processed for all varieties and dropped, so only n_workers tiles
+    are held in memory at any time. Per tile, the veraison dates are written to a Zarr store as
+    int16 and the area weighted sums per LAU are returned instead of the pixel indices, which
+    are merged once all tiles are done. Tiles are processed in a process pool if n_workers > 1.
+
+    Parameters:
+      ds : xarray.Dataset
+          Daily climate data with the variables tas, tasmax, tasmin and pr. Should be opened
+          lazily, e.g. with use_dask=True, so tiles are only read by the workers.
+      Fcrits : dict
+          Critical temperature sums per variety.
+      ids, weights : xarray.DataArray
+          LAU id and vineyard area share of each pixel, on the same grid as ds.
+      memory_budget : int
+          Memory in bytes available for all workers together.
+      store : str or Path
+          Path of the Zarr store the veraison dates are written to. An existing store is
+          overwritten.
+      n_workers : int, default 1
+          Number of worker processes.
+      veraison_min, veraison_max : int
+          Indices are only calculated for veraison dates within [veraison_min, veraison_max).
+      window : int
+          Number of days after veraison (including the veraison date) to consider.
+
+    Returns:
+      veraison : xarray.DataArray
+          Unmasked day of year of veraison with dimensions (variety, year, y_dim, x_dim), lazily
+          opened from store.
+      lau_idx : xarray.Dataset
+          Area weighted indices per LAU with dimensions (id, variety, year).
+    """
+
+    tiles = plan_tiles(ds, memory_budget, n_workers, n_varieties = len(Fcrits), x_dim = x_dim, y_dim = y_dim)
+    _create_tile_store(store, ds, Fcrits, tiles[0], x_dim, y_dim)
+    tasks = [
+        (ds.isel(tile), ids.isel(tile), weights.isel(tile), Fcrits, veraison_min, veraison_max, window, store, tile)
+        for tile in tiles
+    ]
+
+    logger.info(f'Processing {len(tiles)} tiles with {n_workers} worker(s)')
+    if n_workers > 1:
+        with ProcessPoolExecutor(n_workers) as pool:
+            results = list(pool.map(_process_tile, tasks))
+    else:
+        results = [_process_tile(task) for task in tasks]
+
+    return(open_veraison(store), merge_lau_partials(results))
+
+def run_blocks(ds, Fcrits, ids, weights, memory_budget, store, veraison_min = 214, veraison_max = 275, window = 45, x_dim = 'lon', y_dim = 'lat'):
+    """
+    Dask version of run_tiled that processes one spatial chunk of ds per task.
+
+    ds is rechunked to a single chunk along time and persisted once. As each chunk then holds
+    all days, the spatial chunks are sized with plan_tiles so that the working set of one task
+    fits into memory_budget. One task per chunk computes the veraison dates of all varieties
+    and the partial LAU sums, and all tasks are submitted in a single dask.compute call, so the
+    data is read only once per year chunk.
+
+    Parameters:
+      ds : xarray.Dataset
+          Dask-backed daily climate data with the variables tas, tasmax, tasmin and pr.
+      memory_budget : int
+          Memory in bytes available for one task.
+      Fcrits, ids, weights, store, veraison_min, veraison_max, window :
+          Same as in run_tiled.
+
+    Returns:
+      veraison, lau_idx :
+          Same as in run_tiled.
+    """
+
+    import dask
+
+    ##The spatial chunks of the files are sized for short time chunks and are too large once all
+    ##days are in one chunk, so the blocks are the tiles of the memory budget
+    tiles = plan_tiles(ds, memory_budget, n_varieties = len(Fcrits), x_dim = x_dim, y_dim = y_dim)
+    tile_y, tile_x = (tiles[0][i].stop - tiles[0][i].start for i in (y_dim, x_dim))
+    ds = ds[['tas', 'tasmax', 'tasmin', 'pr']].chunk({'time': -1, y_dim: tile_y, x_dim: tile_x}).persist()
+    _create_tile_store(store, ds, Fcrits, tiles[0], x_dim, y_dim)
+
+    logger.info(f'Submitting {len(tiles)} blocks')
+    tasks = [
+        dask.delayed(_tile_indices)(ds.isel(tile), ids.isel(tile), weights.isel(tile), Fcrits, veraison_min, veraison_max, window, store, tile)
+        for tile in tiles
+    ]
+    results = dask.compute(*tasks)
+
+    return(open_veraison(store), merge_lau_partials(list(results)))
+
+def _create_tile_store(store, ds, Fcrits, tile, x_dim, y_dim):
+
+    import dask.array as da
+
+    ##Empty store in the layout of write_veraison with one chunk per tile, filled by the tiles
+    years = np.unique(ds.time.dt.year.values)
+    shp = (len(Fcrits), len(years), ds.sizes[y_dim], ds.sizes[x_dim])
+    chunks = (len(Fcrits), len(years), tile[y_dim].stop - tile[y_dim].start, tile[x_dim].stop - tile[x_dim].start)
+    template = xr.Dataset(
+        {'veraison': (('variety', 'year', y_dim, x_dim), da.full(shp, -1, dtype = np.int16, chunks = chunks))},
+        coords = {'variety': list(Fcrits.keys()), 'year': years, y_dim: ds[y_dim].values, x_dim: ds[x_dim].values},
+    )
+    encoding = {'veraison': {'dtype': 'int16', '_FillValue': -1, 'chunks': chunks}}
+    template.to_zarr(store, mode = 'w', compute = False, consolidated = True, encoding = encoding)
+
+def _process_tile(task):
+
+    import dask
+
+    ds, ids, weights, Fcrits, veraison_min, veraison_max, window, store, tile = task
+
+    ##Read the tile in the worker without spawning further threads
+    with dask.config.set(scheduler = 'synchronous'):
+        ds = ds[['tas', 'tasmax', 'tasmin', 'pr']].load()
+
+    return(_tile_indices(ds, ids, weights, Fcrits, veraison_min, veraison_max, window, store, tile))
+
+def _tile_indices(ds, ids, weights, Fcrits, veraison_min, veraison_max, window, store, tile):
+
+    phen_doy = calc_phen_dates(ds.tas, Fcrits)
+
+    ##Only the veraison dates of the tile are written, the coordinates are already in the store
+    veraison = phen_doy.rename('veraison').transpose('variety', 'year', *tile.keys()).to_dataset()
+    veraison.drop_vars(list(veraison.coords)).to_zarr(store, region = {'variety': slice(None), 'year': slice(None), **tile})
+
+    ##Tiles without vineyards only provide the layout of the partial sums
+    if not ids.notnull().any():
+        ds, phen_doy, ids, weights = (i.isel({k: slice(0, 0) for k in tile}) for i in (ds, phen_doy, ids, weights))
+
+    phen_masked = phen_doy.where((phen_doy >= veraison_min) & (phen_doy < veraison_max))
+    clim_idx = calc_window_indices(ds, phen_masked, window)
+
+    return(partial_lau_sums(clim_idx, ids, weights))
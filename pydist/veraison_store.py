@@ -0,0 +1,84 @@
+import xarray as xr
+import numpy as np
+from pathlib import Path
+import warnings
+import logging
+
+logger = logging.getLogger(__name__)
+
+def stored_veraison_years(store):
+    """Years contained in a veraison store. Empty if the store does not exist."""
+
+    if not Path(store).exists():
+        return([])
+    with xr.open_zarr(store, consolidated = True) as ds:
+        return(ds.year.values.tolist())
+
+def write_veraison(veraison, store, chunks = None):
+    """
+    Write veraison dates of all varieties to a single Zarr store, appending along year.
+
+    Days of year are stored as int16 with -1 for missing values. Years already contained in
+    the store are skipped.
+
+    Parameters:
+      veraison : xarray.DataArray
+          Day of year of veraison with dimensions (variety, year, lat, lon).
+      store : str or Path
+          Path of the Zarr store.
+      chunks : dict, optional
+          Chunk size per dimension used when the store is created. Dimensions not contained are
+          stored in one chunk, year defaults to 1. Use small lat/lon chunks spanning all years
+          for reading time series of single pixels, and large lat/lon chunks for reading maps.
+    """
+
+    veraison = veraison.rename('veraison').transpose('variety', 'year', 'lat', 'lon')
+    veraison = veraison.drop_vars([i for i in veraison.coords if i not in veraison.dims])
+
+    done = stored_veraison_years(store)
+    contained = np.isin(veraison.year.values, done)
+    if contained.all():
+        raise ValueError(f"All years already contained in {store}!")
+    elif contained.any():
+        warnings.warn(f"Some years already contained in {store}! Only new years are written.")
+        veraison = veraison.isel(year = ~contained)
+
+    ds = veraison.to_dataset()
+
+    if len(done) == 0:
+        chunks = {'year': 1, **(chunks or {})}
+        chunksizes = [ds.sizes[d] if chunks.get(d, -1) < 1 else min(chunks[d], ds.sizes[d]) for d in veraison.dims]
+    else:
+        with xr.open_zarr(store, consolidated = True) as ds_store:
+            if ds_store.variety.values.tolist() != ds.variety.values.tolist():
+                raise ValueError(f'Varieties of veraison do not match the varieties in {store}.')
+            chunksizes = ds_store['veraison'].encoding['chunks']
+
+    ##Dask arrays are written chunk by chunk instead of being loaded at once
+    if veraison.chunks is not None:
+        ds = ds.chunk(dict(zip(veraison.dims, chunksizes)))
+
+    if len(done) == 0:
+        encoding = {'veraison': {'dtype': 'int16', '_FillValue': -1, 'chunks': tuple(chunksizes)}}
+        ds.to_zarr(store, mode = 'w', consolidated = True, encoding = encoding)
+    else:
+        ds.to_zarr(store, append_dim = 'year', consolidated = True)
+
+    logger.debug(f"Wrote veraison dates for year(s) {', '.join(ds.year.values.astype(str))} to {store}")
+
+def open_veraison(store, variety = None, years = None):
+    """
+    Lazily open a store written by write_veraison.
+
+    Returns:
+      veraison : xarray.DataArray
+          Day of year of veraison as float, NaN for missing values.
+    """
+
+    veraison = xr.open_zarr(store, consolidated = True)['veraison']
+    if variety is not None:
+        veraison = veraison.sel(variety = variety)
+    if years is not None:
+        veraison = veraison.sel(year = list(years))
+
+    return(veraison)
@@ -0,0 +1,110 @@
+import asyncio
+import threading
+import pytest
+from aiohttp import web
+
+class FileServer:
+    """
+    Local HTTP stand-in for the ISIMIP file server.
+
+    Serves in-memory files with a strong ETag and supports Range and If-Range requests. Every
+    request is recorded with its headers, and responses can be delayed, slowed down or cut off
+    to test timeouts and resumed downloads.
+    """
+
+    def __init__(self):
+        self.files = dict()
+        self.etags = dict()
+        self.requests = []
+        self.delay = 0
+        self.chunk_delay = 0
+        self.chunk_size = 2**16
+        self.truncate = dict()
+        self.active = 0
+        self.max_active = 0
+        self.port = None
+
+    def put(self, name, data, etag):
+        self.files[name] = data
+        self.etags[name] = etag
+
+    def url(self, name):
+        return(f'http://127.0.0.1:{self.port}/{name}')
+
+    def requested(self, name):
+        return([i for i in self.requests if i['name'] == name])
+
+    async def handle(self, request):
+
+        name = request.match_info['name']
+        self.requests.append({'name': name, 'headers': dict(request.headers)})
+        if name not in self.files:
+            raise web.HTTPNotFound()
+
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+            data, etag = self.files[name], self.etags[name]
+
+            ##Partial content only if the client's copy is still current
+            start = 0
+            range_header, if_range = request.headers.get('Range'), request.headers.get('If-Range')
+            if (range_header is not None) and (if_range is None or if_range == etag):
+                start = int(range_header.split('=')[1].split('-')[0])
+                if start >= len(data):
+                    raise web.HTTPRequestRangeNotSatisfiable()
+
+            resp = web.StreamResponse(status = 206 if start > 0 else 200, headers = {'ETag': etag})
+            resp.content_length = len(data) - start
+            if start > 0:
+                resp.headers['Content-Range'] = f'bytes {start}-{len(data) - 1}/{len(data)}'
+            await resp.prepare(request)
+
+            ##Cut the connection once after n bytes
+            stop = len(data)
+            if name in self.truncate:
+                stop = min(stop, start + self.truncate.pop(name))
+
+            for i in range(start, stop, self.chunk_size):
+                await resp.write(data[i:min(i + self.chunk_size, stop)])
+                await asyncio.sleep(self.chunk_delay)
+            if stop < len(data):
+                request.transport.close()
+                return(resp)
+
+            await resp.write_eof()
+            return(resp)
+        finally:
+            self.active -= 1
+
+@pytest.fixture
+def file_server():
+
+    server = FileServer()
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+
+    app = web.Application()
+    app.router.add_get('/{name}', server.handle)
+    runner = web.AppRunner(app)
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        loop.run_until_complete(site.start())
+        server.port = site._server.sockets[0].getsockname()[1]
+        started.set()
+        loop.run_forever()
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+
+    thread = threading.Thread(target = run, daemon = True)
+    thread.start()
+    started.wait()
+
+    yield server
+
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(timeout = 10)
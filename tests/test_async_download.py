@@ -0,0 +1,56 @@
+import asyncio
+import threading
+
+from pydist.file_cache import FileCache
+from pydist.async_download import download_files, TransferStats
+
+def test_slow_transfer_is_not_aborted(file_server, tmp_path):
+
+    ##The transfer takes longer than the timeout, but every read is within it
+    file_server.put('a.nc', bytes(200000), '"a1"')
+    file_server.chunk_size, file_server.chunk_delay = 20000, 0.15
+
+    (fname, error), = download_files([file_server.url('a.nc')], FileCache(tmp_path), timeout = 1)
+    assert error is None
+    assert fname.stat().st_size == 200000
+
+def test_stalled_server_times_out(file_server, tmp_path):
+
+    file_server.put('a.nc', bytes(1000), '"a1"')
+    file_server.delay = 3
+
+    (fname, error), = download_files([file_server.url('a.nc')], FileCache(tmp_path), attempts = 1, timeout = 0.5)
+    assert error is not None
+    assert fname == file_server.url('a.nc')
+
+def test_chunks_are_written_off_the_event_loop(file_server, tmp_path, monkeypatch):
+
+    file_server.put('a.nc', bytes(300000), '"a1"')
+
+    threads = []
+    to_thread = asyncio.to_thread
+    async def record_thread(func, *args):
+        def run():
+            threads.append(threading.get_ident())
+            return(func(*args))
+        return(await to_thread(run))
+    monkeypatch.setattr(asyncio, 'to_thread', record_thread)
+
+    (_, error), = download_files([file_server.url('a.nc')], FileCache(tmp_path), chunk_size = 2**15)
+    assert error is None
+    assert len(threads) > 0
+    assert threading.get_ident() not in threads
+
+def test_connections_per_host_and_progress(file_server, tmp_path):
+
+    names = [f'{i}.nc' for i in range(8)]
+    for name in names:
+        file_server.put(name, bytes(50000), f'"{name}"')
+    file_server.chunk_size, file_server.chunk_delay = 10000, 0.02
+
+    stats = TransferStats()
+    results = download_files([file_server.url(i) for i in names], FileCache(tmp_path), max_per_host = 2, progress = stats)
+    assert all(error is None for _, error in results)
+    assert file_server.max_active <= 2
+    assert stats.bytes == 8 * 50000
+    assert all(done == total == 50000 for done, total in stats.files.values())
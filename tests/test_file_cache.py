@@ -0,0 +1,101 @@
+import os
+import pytest
+
+from pydist.file_cache import FileCache, shared_cache
+from pydist.async_download import download_files
+
+def _data(n, seed = 0):
+    return(bytes((i * 31 + seed) % 251 for i in range(n)))
+
+def test_download_is_cached(file_server, tmp_path):
+
+    file_server.put('a.nc', _data(300000), '"a1"')
+    cache = FileCache(tmp_path)
+
+    (fname, error), = download_files([file_server.url('a.nc')], cache)
+    assert error is None
+    assert fname.read_bytes() == file_server.files['a.nc']
+
+    ##Hits cost no network I/O
+    assert download_files([file_server.url('a.nc')], cache)[0] == (fname, None)
+    assert len(file_server.requests) == 1
+
+    ##Access times are only written by flush
+    mtime = os.stat(cache.index_file).st_mtime_ns
+    assert cache.get(file_server.url('a.nc')) == fname
+    assert os.stat(cache.index_file).st_mtime_ns == mtime
+    cache.flush()
+    assert os.stat(cache.index_file).st_mtime_ns != mtime
+
+def test_interrupted_download_is_resumed(file_server, tmp_path):
+
+    file_server.put('a.nc', _data(300000), '"a1"')
+    file_server.truncate['a.nc'] = 100000
+    cache = FileCache(tmp_path)
+    url = file_server.url('a.nc')
+
+    assert download_files([url], cache, attempts = 1)[0][1] is not None
+    assert cache.part_path(url).stat().st_size == 100000
+
+    (fname, error), = download_files([url], cache)
+    assert error is None
+    assert fname.read_bytes() == file_server.files['a.nc']
+
+    resumed = file_server.requested('a.nc')[-1]['headers']
+    assert resumed['Range'] == 'bytes=100000-'
+    assert resumed['If-Range'] == '"a1"'
+    assert not cache.part_path(url).exists()
+    assert not cache.validator_path(url).exists()
+
+def test_changed_file_is_downloaded_again(file_server, tmp_path):
+
+    file_server.put('a.nc', _data(300000), '"a1"')
+    file_server.truncate['a.nc'] = 100000
+    cache = FileCache(tmp_path)
+    url = file_server.url('a.nc')
+
+    assert download_files([url], cache, attempts = 1)[0][1] is not None
+
+    ##The server ignores the range for an outdated ETag and sends the new file
+    file_server.put('a.nc', _data(250000, seed = 7), '"a2"')
+    (fname, error), = download_files([url], cache)
+    assert error is None
+    assert fname.read_bytes() == file_server.files['a.nc']
+    assert file_server.requested('a.nc')[-1]['headers']['If-Range'] == '"a1"'
+
+def test_pinned_files_are_not_evicted(file_server, tmp_path):
+
+    names = ['a.nc', 'b.nc', 'c.nc']
+    for i, name in enumerate(names):
+        file_server.put(name, _data(100000, seed = i), f'"{name}"')
+    urls = [file_server.url(i) for i in names]
+
+    ##The batch is larger than the quota, but all of its files stay while it is pinned
+    cache = FileCache(tmp_path, quota = 150000)
+    with cache.pinned(urls):
+        results = download_files(urls, cache)
+        assert all(error is None for _, error in results)
+        assert all(fname.is_file() for fname, _ in results)
+
+    cache.evict()
+    assert cache.size() <= 150000
+
+def test_shared_cache_respects_pins_of_other_batches(file_server, tmp_path):
+
+    for i, name in enumerate(['a.nc', 'b.nc', 'c.nc']):
+        file_server.put(name, _data(100000, seed = i), f'"{name}"')
+
+    cache = shared_cache(tmp_path, quota = 150000)
+    assert shared_cache(tmp_path, quota = 150000) is cache
+
+    ##A batch still being read keeps its file while the next batch is downloaded
+    release = cache.pin([file_server.url('a.nc')])
+    (first, _), = download_files([file_server.url('a.nc')], cache)
+    download_files([file_server.url('b.nc'), file_server.url('c.nc')], cache)
+    assert first.is_file()
+
+    release()
+    release()
+    cache.evict()
+    assert not first.is_file()
+    assert cache.size() <= 150000